@@ -0,0 +1,207 @@
+#!/usr/bin/python2
+
+"""
+Open-coded against compact (liblogger.py --compact) wrappers.
+
+A synthetic library with many functions and a driver calling all of
+them are built in a temporary folder, then both kinds of wrappers are
+generated for it and compared: size of the generated source, time to
+compile it, size of the resulting library and the time per call with
+the wrapper preloaded in text (logging to /dev/null), profile and
+binary modes.
+
+Requires a C compiler ($CC, defaults to cc) with pthreads.
+"""
+
+import sys
+import os
+import optparse
+import shutil
+import subprocess
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+liblogger_py = os.path.join(os.path.dirname(benchmarks_dir), "liblogger.py")
+
+# declaration, definition and call of each kind of function, %d is its index
+signatures = [
+    ("int bench_f%d(int a, int b);",
+     "int bench_f%d(int a, int b) { return a + b; }",
+     "acc += bench_f%d(acc, (int)i);"),
+    ("void *bench_f%d(const char *s, unsigned long n);",
+     "void *bench_f%d(const char *s, unsigned long n) "
+     "{ return (char *)s + n; }",
+     "bench_f%d(\"bench\", i & 3);"),
+    ("double bench_f%d(double v, float f);",
+     "double bench_f%d(double v, float f) { return v * f; }",
+     "bench_f%d(i, 0.5f);"),
+    ("void bench_f%d(void *p);",
+     "void bench_f%d(void *p) { (void)p; }",
+     "bench_f%d(&acc);"),
+    ("long bench_f%d(long a, short b, unsigned char c);",
+     "long bench_f%d(long a, short b, unsigned char c) "
+     "{ return a + b + c; }",
+     "acc += bench_f%d(i, 1, 2);"),
+    ]
+
+driver = """\
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#include "bench.h"
+
+int main(int argc, char *argv[])
+{
+    long i, iterations;
+    int acc = 0;
+    struct timespec t0, t1;
+
+    if (argc < 2)
+        return 1;
+    iterations = atol(argv[1]);
+
+    clock_gettime(CLOCK_MONOTONIC, &t0);
+    for (i = 0; i < iterations; i++) {
+%s
+    }
+    clock_gettime(CLOCK_MONOTONIC, &t1);
+
+    printf("%%f\\n", (t1.tv_sec - t0.tv_sec) + (t1.tv_nsec - t0.tv_nsec) / 1e9);
+    return acc == 42;
+}
+"""
+
+# name: extra CFLAGS for the wrapper
+modes = [
+    ("text", ["-D_log_bench_LOGFILE=\"/dev/null\""]),
+    ("profile", ["-D_log_bench_LOG_PROFILE=1",
+                 "-D_log_bench_LOG_PROFILE_FILE=\"/dev/null\""]),
+    ("binary", ["-D_log_bench_LOG_BINARY=1"]),
+    ]
+
+kinds = [
+    ("open-coded", []),
+    ("compact", ["--compact"]),
+    ]
+
+
+def run(cmd, **kargs):
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, **kargs)
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        raise SystemExit("ERROR: %s failed" % (" ".join(cmd),))
+    return out
+
+
+def write(filename, contents):
+    f = open(filename, "w")
+    f.write(contents)
+    f.close()
+
+
+def build(workdir, cc, n_functions):
+    decls = ["#ifndef BENCH_H", "#define BENCH_H"]
+    defs = ["#include \"bench.h\""]
+    calls = []
+    for i in xrange(n_functions):
+        decl, definition, call = signatures[i % len(signatures)]
+        decls.append(decl % (i,))
+        defs.append(definition % (i,))
+        calls.append("        " + call % (i,))
+    decls.append("#endif")
+    write(os.path.join(workdir, "bench.h"), "\n".join(decls) + "\n")
+    write(os.path.join(workdir, "bench.c"), "\n".join(defs) + "\n")
+    write(os.path.join(workdir, "driver.c"), driver % ("\n".join(calls),))
+    run([cc, "-O2", "-shared", "-fPIC", "bench.c", "-o", "libbench.so"],
+        cwd=workdir)
+    run([cc, "-O2", "driver.c", "-o", "driver", "-L.", "-lbench"],
+        cwd=workdir)
+
+
+def generate(workdir, cc, kind, options):
+    source = "log-bench-%s.c" % (kind,)
+    run([sys.executable, liblogger_py] + options +
+        ["bench.h", "libbench.so", source], cwd=workdir)
+    path = os.path.join(workdir, source)
+    f = open(path)
+    lines = len(f.readlines())
+    f.close()
+    result = {"source": source, "bytes": os.path.getsize(path),
+              "lines": lines, "compile": {}, "library": {}}
+    for mode, cflags in modes:
+        so = "log-bench-%s-%s.so" % (kind, mode)
+        t0 = time.time()
+        run([cc, "-O2", "-shared", "-fPIC", "-I."] + cflags +
+            [source, "-o", so, "-ldl", "-lpthread"], cwd=workdir)
+        result["compile"][mode] = time.time() - t0
+        result["library"][mode] = so
+    return result
+
+
+def measure(workdir, so, iterations, n_functions):
+    env = dict(os.environ)
+    env["LD_LIBRARY_PATH"] = workdir
+    if so:
+        env["LD_PRELOAD"] = os.path.join(workdir, so)
+    for f in os.listdir(workdir):
+        if f.endswith(".trace"):
+            os.unlink(os.path.join(workdir, f))
+    p = subprocess.Popen([os.path.join(workdir, "driver"), str(iterations)],
+                         stdout=subprocess.PIPE, cwd=workdir, env=env)
+    out = p.communicate()[0]
+    return float(out.strip()) * 1e9 / (iterations * n_functions)
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-f", "--functions", action="store", type="int",
+                      default=500,
+                      help="Functions in the synthetic library")
+    parser.add_option("-n", "--iterations", action="store", type="int",
+                      default=200,
+                      help="Loop iterations, each one calls every function")
+    parser.add_option("-k", "--keep", action="store_true", default=False,
+                      help="Keep the temporary build folder")
+
+    options, args = parser.parse_args()
+    cc = os.environ.get("CC", "cc")
+
+    workdir = tempfile.mkdtemp(prefix="liblogger-bench-")
+    try:
+        build(workdir, cc, options.functions)
+        results = [(kind, generate(workdir, cc, kind, opts))
+                   for kind, opts in kinds]
+
+        print "%d functions" % (options.functions,)
+        print "%-22s%14s%14s" % ("", "open-coded", "compact")
+        print "%-22s%14d%14d" % ("source bytes", results[0][1]["bytes"],
+                                 results[1][1]["bytes"])
+        print "%-22s%14d%14d" % ("source lines", results[0][1]["lines"],
+                                 results[1][1]["lines"])
+        for mode, cflags in modes:
+            print "%-22s%14.2f%14.2f" % ("compile %s (s)" % (mode,),
+                                         results[0][1]["compile"][mode],
+                                         results[1][1]["compile"][mode])
+        for mode, cflags in modes:
+            sizes = [os.path.getsize(os.path.join(workdir,
+                                                  r["library"][mode]))
+                     for kind, r in results]
+            print "%-22s%14d%14d" % ("%s .so bytes" % (mode,),
+                                     sizes[0], sizes[1])
+
+        direct = measure(workdir, None, options.iterations,
+                         options.functions)
+        print "%-22s%14.1f%14.1f" % ("direct call (ns)", direct, direct)
+        for mode, cflags in modes:
+            times = [measure(workdir, r["library"][mode],
+                             options.iterations, options.functions)
+                     for kind, r in results]
+            print "%-22s%14.1f%14.1f" % ("%s call (ns)" % (mode,),
+                                         times[0], times[1])
+    finally:
+        if options.keep:
+            print "build folder: %s" % (workdir,)
+        else:
+            shutil.rmtree(workdir)
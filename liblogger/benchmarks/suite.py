@@ -0,0 +1,228 @@
+#!/usr/bin/python2
+
+"""
+Benchmark suite tracking the performance of liblogger over time.
+
+Synthetic headers (see synthetic.py) are used to time, in process, the
+steps of the generator: header_tokenize(), header_tree() and
+generate(), the latter for open-coded and compact wrappers. Headers are
+made bigger by each --scales factor, so the growth is visible too.
+
+Then the stand-in library of the header and its driver are built, the
+wrapper is generated and compiled in text (logging to /dev/null),
+binary, profile and compact modes and the time per call of the driver
+with each of them preloaded is compared to direct calls.
+
+Results are written as JSON, to stdout or --output, with the versions
+and parameters used:
+
+    ./suite.py -o results-$(date +%Y%m%d).json
+
+Requires a C compiler ($CC, defaults to cc) with pthreads for the
+preload part.
+"""
+
+import sys
+import os
+import optparse
+import shutil
+import StringIO
+import subprocess
+import tempfile
+import time
+import datetime
+import json
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+liblogger_dir = os.path.dirname(benchmarks_dir)
+liblogger_py = os.path.join(liblogger_dir, "liblogger.py")
+
+sys.path.insert(0, liblogger_dir)
+sys.path.insert(0, benchmarks_dir)
+
+import liblogger
+import synthetic
+
+# name: liblogger.py options, extra CFLAGS for the wrapper
+modes = [
+    ("text", [], ["-D_log_synthetic_LOGFILE=\"/dev/null\""]),
+    ("binary", [], ["-D_log_synthetic_LOG_BINARY=1"]),
+    ("profile", [], ["-D_log_synthetic_LOG_PROFILE=1",
+                     "-D_log_synthetic_LOG_PROFILE_FILE=\"/dev/null\""]),
+    ("compact-text", ["--compact"],
+     ["-D_log_synthetic_LOGFILE=\"/dev/null\""]),
+    ]
+
+
+def run(cmd, **kargs):
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, **kargs)
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        raise SystemExit("ERROR: %s failed" % (" ".join(cmd),))
+    return out
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {"min": samples[0],
+            "median": samples[len(samples) // 2],
+            "max": samples[-1]}
+
+
+def quiet(function, *args):
+    """Call function hiding the notes generators print."""
+    old_stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        return function(*args)
+    finally:
+        sys.stdout = old_stdout
+
+
+def time_generator(workdir, lib, repeat):
+    header = lib.write(workdir)["header"]
+    outfile = os.path.join(workdir, "log-synthetic.c")
+    samples = {"header_tokenize": [], "header_tree": [], "generate": [],
+               "generate_compact": []}
+
+    for i in xrange(repeat):
+        t0 = time.time()
+        tokens = liblogger.header_tokenize(header, None)
+        samples["header_tokenize"].append(time.time() - t0)
+
+        types = liblogger.TypeRegistry()
+        t0 = time.time()
+        header_contents = liblogger.header_tree(header, None, types)
+        samples["header_tree"].append(time.time() - t0)
+
+        for key, compact in (("generate", False),
+                             ("generate_compact", True)):
+            job = {"header": header, "libname": "libsynthetic.so",
+                   "compact": compact}
+            ctxt = liblogger.make_context(job, header_contents, types, None)
+            t0 = time.time()
+            quiet(liblogger.generate, outfile, ctxt)
+            samples[key].append(time.time() - t0)
+
+    result = dict(lib.counts)
+    result["header_bytes"] = os.path.getsize(header)
+    result["tokens"] = len(tokens)
+    result["wrapped_functions"] = len(ctxt["functions"])
+    result["output_bytes"] = os.path.getsize(outfile)
+    result["seconds"] = dict((k, summary(v)) for k, v in samples.iteritems())
+    return result
+
+
+def measure(workdir, so, iterations, n_functions, repeat):
+    env = dict(os.environ)
+    env["LD_LIBRARY_PATH"] = workdir
+    if so:
+        env["LD_PRELOAD"] = os.path.join(workdir, so)
+    samples = []
+    for i in xrange(repeat):
+        for f in os.listdir(workdir):
+            if f.endswith(".trace"):
+                os.unlink(os.path.join(workdir, f))
+        out = run([os.path.join(workdir, "driver"), str(iterations)],
+                  cwd=workdir, env=env)
+        samples.append(float(out.strip()) * 1e9 /
+                       (iterations * n_functions))
+    return summary(samples)
+
+
+def time_preload(workdir, lib, cc, iterations, repeat):
+    lib.write(workdir)
+    run([cc, "-O2", "-shared", "-fPIC", "synthetic.c", "-o",
+         "libsynthetic.so"], cwd=workdir)
+    run([cc, "-O2", "driver.c", "-o", "driver", "-L.", "-lsynthetic"],
+        cwd=workdir)
+    n_functions = len(lib.functions)
+
+    result = dict(lib.counts)
+    result.update({"iterations": iterations, "ns_per_call": {},
+                   "overhead_ns": {}})
+    direct = measure(workdir, None, iterations, n_functions, repeat)
+    result["ns_per_call"]["direct"] = direct
+    for name, options, cflags in modes:
+        source = "log-synthetic-%s.c" % (name,)
+        so = "log-synthetic-%s.so" % (name,)
+        run([sys.executable, liblogger_py] + options +
+            ["synthetic.h", "libsynthetic.so", source], cwd=workdir)
+        run([cc, "-O2", "-shared", "-fPIC", "-I."] + cflags +
+            [source, "-o", so, "-ldl", "-lpthread"], cwd=workdir)
+        times = measure(workdir, so, iterations, n_functions, repeat)
+        result["ns_per_call"][name] = times
+        result["overhead_ns"][name] = times["median"] - direct["median"]
+    return result
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    synthetic.add_options(parser)
+    parser.add_option("--scales", action="store", default="1,4,16",
+                      help=("Comma separated factors applied to the counts "
+                            "of the synthetic header to time the generator"))
+    parser.add_option("-r", "--repeat", action="store", type="int",
+                      default=3,
+                      help="Runs of every measure, min/median/max are kept")
+    parser.add_option("-n", "--iterations", action="store", type="int",
+                      default=200,
+                      help="Driver loop iterations, each one calls every "
+                      "function")
+    parser.add_option("--skip-generator", action="store_true",
+                      default=False, help="Don't time the generator")
+    parser.add_option("--skip-preload", action="store_true", default=False,
+                      help="Don't build and time the preloaded wrappers")
+    parser.add_option("-o", "--output", action="store", default=None,
+                      help="Write the JSON results to this file")
+    parser.add_option("-k", "--keep", action="store_true", default=False,
+                      help="Keep the temporary build folder")
+
+    options, args = parser.parse_args()
+    try:
+        scales = [int(x) for x in options.scales.split(",")]
+    except ValueError, e:
+        raise SystemExit("Invalid --scales: %s" % (options.scales,))
+    cc = os.environ.get("CC", "cc")
+
+    results = {
+        "liblogger": liblogger.__version__,
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "date": datetime.datetime.now().isoformat(),
+        "repeat": options.repeat,
+        }
+
+    workdir = tempfile.mkdtemp(prefix="liblogger-suite-")
+    try:
+        if not options.skip_generator:
+            results["generator"] = []
+            for scale in scales:
+                lib = synthetic.from_options(options, scale)
+                directory = os.path.join(workdir, "generator-%d" % (scale,))
+                os.mkdir(directory)
+                results["generator"].append(
+                    time_generator(directory, lib, options.repeat))
+
+        if not options.skip_preload:
+            directory = os.path.join(workdir, "preload")
+            os.mkdir(directory)
+            results["cc"] = cc
+            results["preload"] = time_preload(
+                directory, synthetic.from_options(options), cc,
+                options.iterations, options.repeat)
+    finally:
+        if options.keep:
+            sys.stderr.write("build folder: %s\n" % (workdir,))
+        else:
+            shutil.rmtree(workdir)
+
+    out = sys.stdout
+    if options.output:
+        out = open(options.output, "w")
+    json.dump(results, out, indent=2, sort_keys=True,
+              separators=(",", ": "))
+    out.write("\n")
+    if options.output:
+        out.close()
@@ -0,0 +1,269 @@
+#!/usr/bin/python2
+
+"""
+Synthetic headers and matching stand-in libraries for benchmarks.
+
+A SyntheticLibrary has the given number of functions, structs, enums,
+chains of nested typedefs and function pointer typedefs, mixed the way
+real headers do: structs contain anonymous unions and structs, point to
+each other and use the enums and typedefs, functions take and return
+all of them. The same seed always gives the same header.
+
+Besides the header, it writes the stand-in library defining every
+function (they do nothing) and a driver calling all of them in a loop,
+which prints the seconds it took. Used by suite.py, run it alone to get
+the files:
+
+    ./synthetic.py -f 1000 -s 200 /tmp/synthetic
+"""
+
+import os
+import optparse
+import random
+
+# typedef chains start from one of these, "pointer" ones take NULL
+chain_bases = [
+    ("int", False),
+    ("unsigned long", False),
+    ("double", False),
+    ("short", False),
+    ("void *", True),
+    ]
+
+# function pointer typedefs: signature, callback the driver passes
+callback_kinds = [
+    ("int (*%s)(void *data, int n)", "synthetic_cb_int"),
+    ("void (*%s)(const char *s)", "synthetic_cb_str"),
+    ]
+
+driver_head = """\
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#include "%(header)s"
+
+static int synthetic_cb_int(void *data, int n) { (void)data; return n; }
+static void synthetic_cb_str(const char *s) { (void)s; }
+
+int main(int argc, char *argv[])
+{
+    long i, iterations;
+    struct timespec t0, t1;
+
+    if (argc < 2)
+        return 1;
+    iterations = atol(argv[1]);
+
+    clock_gettime(CLOCK_MONOTONIC, &t0);
+    for (i = 0; i < iterations; i++) {
+"""
+
+driver_tail = """\
+    }
+    clock_gettime(CLOCK_MONOTONIC, &t1);
+
+    printf("%f\\n", (t1.tv_sec - t0.tv_sec) + (t1.tv_nsec - t0.tv_nsec) / 1e9);
+    return 0;
+}
+"""
+
+
+class SyntheticLibrary(object):
+    def __init__(self, functions=500, structs=50, enums=20, typedefs=20,
+                 typedef_depth=3, function_pointers=10, seed=0,
+                 prefix="synthetic"):
+        self.prefix = prefix
+        self.counts = {"functions": functions, "structs": structs,
+                       "enums": enums, "typedefs": typedefs,
+                       "typedef_depth": typedef_depth,
+                       "function_pointers": function_pointers,
+                       "seed": seed}
+        rnd = random.Random(seed)
+        p = prefix
+
+        self.enums = ["%s_e%d" % (p, i) for i in xrange(enums)]
+        self.structs = ["%s_s%d_t" % (p, i) for i in xrange(structs)]
+        self.callbacks = []
+        for i in xrange(function_pointers):
+            kind = callback_kinds[i % len(callback_kinds)]
+            self.callbacks.append(("%s_cb%d" % (p, i), kind[0], kind[1]))
+        # name of the last typedef of each chain, base is pointer
+        self.chains = []
+        self.chain_decls = []
+        for i in xrange(typedefs):
+            base, is_pointer = chain_bases[i % len(chain_bases)]
+            previous = base
+            for level in xrange(max(typedef_depth, 1)):
+                name = "%s_t%d_%d" % (p, i, level)
+                space = " " * (previous[-1] != "*")
+                self.chain_decls.append("typedef %s%s%s;" %
+                                        (previous, space, name))
+                previous = name
+            self.chains.append((previous, is_pointer))
+
+        # kind of every parameter and return value: (C type, kind)
+        self.param_kinds = [("int", "int"), ("unsigned long", "ulong"),
+                            ("double", "double"), ("float", "float"),
+                            ("const char *", "string"), ("void *", "null")]
+        self.param_kinds += [("%s *" % (s,), "null") for s in self.structs]
+        self.param_kinds += [("enum %s" % (e,), "enum") for e in self.enums]
+        self.param_kinds += [(c, is_pointer and "null" or "number")
+                             for c, is_pointer in self.chains]
+        self.param_kinds += [(c, cb) for c, decl, cb in self.callbacks]
+        return_kinds = [("void", None), ("int", "int"), ("double", "double"),
+                        ("void *", "null"), ("const char *", "string")]
+        return_kinds += [k for k in self.param_kinds
+                         if k[1] in ("null", "enum", "number")]
+
+        self.struct_members = []
+        for i, s in enumerate(self.structs):
+            members = ["int id;", "const char *name;"]
+            members.append("%s *next;" % (rnd.choice(self.structs),))
+            if self.enums:
+                members.append("enum %s mode;" % (rnd.choice(self.enums),))
+            if self.chains:
+                members.append("%s value;" % (rnd.choice(self.chains)[0],))
+            if self.callbacks:
+                members.append("%s cb;" % (rnd.choice(self.callbacks)[0],))
+            members.append("union { int i; float f; void *p; } u;")
+            members.append("struct { long x; long y; "
+                           "struct { short a; short b; } inner; } nested;")
+            members.append("char tag[8];")
+            self.struct_members.append(members)
+
+        self.functions = []
+        for i in xrange(functions):
+            ret = rnd.choice(return_kinds)
+            params = [rnd.choice(self.param_kinds)
+                      for j in xrange(rnd.randint(0, 5))]
+            self.functions.append(("%s_f%d" % (p, i), ret, params))
+
+    def header(self):
+        guard = "%s_H" % (self.prefix.upper(),)
+        counts = ", ".join("%s=%s" % x for x in sorted(self.counts.items()))
+        lines = ["/* synthetic header, %s */" % (counts,),
+                 "#ifndef %s" % (guard,), "#define %s" % (guard,), ""]
+        for i, e in enumerate(self.enums):
+            lines.append("enum %s { %s_A, %s_B = %d, %s_C };" %
+                         (e, e.upper(), e.upper(), 1 << (i % 16), e.upper()))
+        lines.extend(self.chain_decls)
+        for name, decl, cb in self.callbacks:
+            lines.append("typedef %s;" % (decl % (name,),))
+        for s in self.structs:
+            lines.append("typedef struct %s %s;" % (s[:-2], s))
+        for s, members in zip(self.structs, self.struct_members):
+            lines.append("struct %s {" % (s[:-2],))
+            lines.extend("    %s" % (m,) for m in members)
+            lines.append("};")
+        for name, ret, params in self.functions:
+            lines.append("%s %s(%s);" % (ret[0], name,
+                                         self.params_decl(params)))
+        lines.append("")
+        lines.append("#endif")
+        return "\n".join(lines) + "\n"
+
+    def params_decl(self, params):
+        if not params:
+            return "void"
+        decls = []
+        for i, (ctype, kind) in enumerate(params):
+            if ctype.endswith("*"):
+                decls.append("%sp%d" % (ctype, i))
+            else:
+                decls.append("%s p%d" % (ctype, i))
+        return ", ".join(decls)
+
+    def library(self, header_name):
+        lines = ["#include \"%s\"" % (header_name,)]
+        for name, ret, params in self.functions:
+            lines.append("%s %s(%s)" % (ret[0], name,
+                                        self.params_decl(params)))
+            lines.append("{")
+            for i in xrange(len(params)):
+                lines.append("    (void)p%d;" % (i,))
+            if ret[0] != "void":
+                lines.append("    return 0;")
+            lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def argument(self, ctype, kind):
+        if kind in ("int", "ulong", "number"):
+            return "(%s)i" % (ctype,)
+        elif kind == "double":
+            return "1.5"
+        elif kind == "float":
+            return "0.5f"
+        elif kind == "string":
+            return "\"synthetic\""
+        elif kind == "enum":
+            return "(%s)0" % (ctype,)
+        elif kind == "null":
+            return "NULL"
+        return kind # a callback
+
+    def driver(self, header_name):
+        lines = [driver_head % {"header": header_name}]
+        for name, ret, params in self.functions:
+            args = [self.argument(ctype, kind) for ctype, kind in params]
+            lines.append("        %s(%s);\n" % (name, ", ".join(args)))
+        lines.append(driver_tail)
+        return "".join(lines)
+
+    def write(self, directory):
+        """Write <prefix>.h, <prefix>.c and driver.c to directory."""
+        files = {}
+        header_name = "%s.h" % (self.prefix,)
+        for key, filename, contents in (
+            ("header", header_name, self.header()),
+            ("library", "%s.c" % (self.prefix,), self.library(header_name)),
+            ("driver", "driver.c", self.driver(header_name))):
+            path = os.path.join(directory, filename)
+            f = open(path, "w")
+            f.write(contents)
+            f.close()
+            files[key] = path
+        return files
+
+
+def add_options(parser):
+    parser.add_option("-f", "--functions", action="store", type="int",
+                      default=500, help="Functions in the header")
+    parser.add_option("-s", "--structs", action="store", type="int",
+                      default=50, help="Structs in the header")
+    parser.add_option("-e", "--enums", action="store", type="int",
+                      default=20, help="Enums in the header")
+    parser.add_option("-t", "--typedefs", action="store", type="int",
+                      default=20, help="Chains of nested typedefs")
+    parser.add_option("-d", "--typedef-depth", action="store", type="int",
+                      default=3, help="Typedefs in each chain")
+    parser.add_option("-p", "--function-pointers", action="store",
+                      type="int", default=10,
+                      help="Function pointer typedefs")
+    parser.add_option("--seed", action="store", type="int", default=0,
+                      help="Seed used to mix types and functions")
+
+
+def from_options(options, scale=1):
+    """SyntheticLibrary with the counts of options times scale."""
+    return SyntheticLibrary(functions=options.functions * scale,
+                            structs=options.structs * scale,
+                            enums=options.enums * scale,
+                            typedefs=options.typedefs * scale,
+                            typedef_depth=options.typedef_depth,
+                            function_pointers=options.function_pointers *
+                            scale,
+                            seed=options.seed)
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options] <directory>"
+    parser = optparse.OptionParser(usage=usage)
+    add_options(parser)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        raise SystemExit("Missing parameter: directory")
+    if not os.path.isdir(args[0]):
+        os.makedirs(args[0])
+    files = from_options(options).write(args[0])
+    for key in ("header", "library", "driver"):
+        print "%-8s %s" % (key, files[key])
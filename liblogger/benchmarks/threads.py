@@ -0,0 +1,179 @@
+#!/usr/bin/python2
+
+"""
+Logging throughput of generated wrappers with 1, 4 and 16 threads.
+
+A tiny library and a driver are built in a temporary folder, the
+library wrapper is generated by liblogger.py and compiled in several
+modes, then the driver is run with each of them preloaded. Every thread
+calls the wrapped functions in a loop, logging to a file, and the total
+number of calls per second is reported.
+
+Requires a C compiler ($CC, defaults to cc) with pthreads.
+"""
+
+import sys
+import os
+import optparse
+import shutil
+import subprocess
+import tempfile
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+liblogger_py = os.path.join(os.path.dirname(benchmarks_dir), "liblogger.py")
+
+header = """\
+#ifndef BENCH_H
+#define BENCH_H
+typedef struct _Bench Bench;
+int bench_add(int a, int b);
+void *bench_ptr(Bench *b, unsigned long n);
+double bench_scale(double v, float f);
+#endif
+"""
+
+library = """\
+#include "bench.h"
+int bench_add(int a, int b) { return a + b; }
+void *bench_ptr(Bench *b, unsigned long n) { return (char *)b + n; }
+double bench_scale(double v, float f) { return v * f; }
+"""
+
+driver = """\
+#include <stdio.h>
+#include <stdlib.h>
+#include <pthread.h>
+#include <time.h>
+#include "bench.h"
+
+static long iterations;
+
+static void *worker(void *data)
+{
+    long i;
+    int acc = 0;
+    for (i = 0; i < iterations; i++) {
+        acc = bench_add(acc, (int)i);
+        bench_ptr(data, i);
+        bench_scale(i, 0.5f);
+    }
+    return NULL;
+}
+
+int main(int argc, char *argv[])
+{
+    int i, n_threads;
+    pthread_t *threads;
+    struct timespec t0, t1;
+
+    if (argc < 3)
+        return 1;
+    n_threads = atoi(argv[1]);
+    iterations = atol(argv[2]);
+    threads = calloc(n_threads, sizeof(pthread_t));
+
+    clock_gettime(CLOCK_MONOTONIC, &t0);
+    for (i = 0; i < n_threads; i++)
+        pthread_create(threads + i, NULL, worker, threads + i);
+    for (i = 0; i < n_threads; i++)
+        pthread_join(threads[i], NULL);
+    clock_gettime(CLOCK_MONOTONIC, &t1);
+
+    printf("%f\\n", (t1.tv_sec - t0.tv_sec) + (t1.tv_nsec - t0.tv_nsec) / 1e9);
+    return 0;
+}
+"""
+
+CALLS_PER_ITERATION = 3
+
+# name: extra CFLAGS for the wrapper
+modes = [
+    ("locked", ["-D_log_bench_HAVE_THREADS=1"]),
+    ("buffered", ["-D_log_bench_LOG_BUFFERED=1"]),
+    ("buffered-mmap", ["-D_log_bench_LOG_BUFFERED=1",
+                       "-D_log_bench_LOG_MMAP=1"]),
+    ("binary", ["-D_log_bench_LOG_BINARY=1"]),
+    ]
+
+
+def run(cmd, **kargs):
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, **kargs)
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        raise SystemExit("ERROR: %s failed" % (" ".join(cmd),))
+    return out
+
+
+def write(filename, contents):
+    f = open(filename, "w")
+    f.write(contents)
+    f.close()
+
+
+def build(workdir, cc):
+    write(os.path.join(workdir, "bench.h"), header)
+    write(os.path.join(workdir, "bench.c"), library)
+    write(os.path.join(workdir, "driver.c"), driver)
+    run([cc, "-O2", "-shared", "-fPIC", "bench.c", "-o", "libbench.so"],
+        cwd=workdir)
+    run([cc, "-O2", "driver.c", "-o", "driver", "-L.", "-lbench",
+         "-lpthread"], cwd=workdir)
+    run([sys.executable, liblogger_py, "bench.h", "libbench.so",
+         "log-bench.c"], cwd=workdir)
+
+    wrappers = []
+    for name, cflags in modes:
+        logfile = os.path.join(workdir, "%s.log" % (name,))
+        so = "log-bench-%s.so" % (name,)
+        run([cc, "-O2", "-shared", "-fPIC", "-I."] + cflags +
+            ["-D_log_bench_LOGFILE=\"%s\"" % (logfile,),
+             "log-bench.c", "-o", so, "-ldl", "-lpthread"], cwd=workdir)
+        wrappers.append((name, so, logfile))
+    return wrappers
+
+
+def measure(workdir, so, logfile, n_threads, iterations):
+    env = dict(os.environ)
+    env["LD_LIBRARY_PATH"] = workdir
+    env["LD_PRELOAD"] = os.path.join(workdir, so)
+    if os.path.exists(logfile):
+        os.unlink(logfile)
+    for f in os.listdir(workdir):
+        if f.endswith(".trace"):
+            os.unlink(os.path.join(workdir, f))
+    out = run([os.path.join(workdir, "driver"), str(n_threads),
+               str(iterations)], cwd=workdir, env=env)
+    elapsed = float(out.strip())
+    return n_threads * iterations * CALLS_PER_ITERATION / elapsed
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-n", "--iterations", action="store", type="int",
+                      default=20000,
+                      help="Loop iterations per thread (3 calls each)")
+    parser.add_option("-t", "--threads", action="store", default="1,4,16",
+                      help="Comma separated thread counts")
+    parser.add_option("-k", "--keep", action="store_true", default=False,
+                      help="Keep the temporary build folder")
+
+    options, args = parser.parse_args()
+    threads = [int(x) for x in options.threads.split(",")]
+    cc = os.environ.get("CC", "cc")
+
+    workdir = tempfile.mkdtemp(prefix="liblogger-bench-")
+    try:
+        wrappers = build(workdir, cc)
+        print "calls per second"
+        print "%-14s%s" % ("mode", "".join("%14s" % ("%d threads" % n)
+                                           for n in threads))
+        for name, so, logfile in wrappers:
+            results = [measure(workdir, so, logfile, n, options.iterations)
+                       for n in threads]
+            print "%-14s%s" % (name, "".join("%14.0f" % r for r in results))
+    finally:
+        if options.keep:
+            print "build folder: %s" % (workdir,)
+        else:
+            shutil.rmtree(workdir)
@@ -0,0 +1,524 @@
+#!/usr/bin/python2
+
+"""
+Summarize text logs written by liblogger wrappers, of any size.
+
+The log is mmap-ed and scanned with a single compiled regular
+expression, nothing but the summaries is kept in memory: per function
+calls, return checker hits and (when logged with <prefix>_LOG_TIMESTAMP)
+call durations, the most frequent values of the arguments and the
+number of calls per time window. Enter and exit lines are paired per
+thread to measure durations.
+
+Argument values are counted with a bounded table per parameter (the
+"space saving" algorithm), counts of values that had to be evicted are
+over-estimated by at most the reported error. Non-NULL pointers are
+counted together unless --raw-pointers is given.
+
+With --jobs the file is split at line boundaries and each part is
+scanned by its own process, calls crossing parts are paired when the
+results are merged.
+"""
+
+import sys
+import os
+import re
+import mmap
+import fnmatch
+import optparse
+import multiprocessing
+
+# [timestamp] <indentation>[T:thread][D:depth]<color>LOG? <text>
+record_re = re.compile(r"^(?:\[ *(\d+)\.(\d+)\] )?[^\n]*?(?:\[T:(\d+)\])?"
+                       r"(?:\[D:\d+\])?(?:\033\[[0-9;]*m)?LOG([<>!]) "
+                       r"?([^\n]*)$", re.M)
+color_re = re.compile(r"\033\[[0-9;]*m")
+param_re = re.compile(r"(?:^|, )([^=]*?) ?\b(\w+)=(\"[^\"]*\"|[^,]*)")
+# values printed by the builtin formatters, what follows is a checker
+value_re = re.compile(r"(0x[0-9a-f]+|-?\d+(?:\.\d+)?(?:e[+-]\d+)?"
+                      r"(?: \(.\))?|-?inf|-?nan|\(nil\)|\(null\)|true|false|"
+                      r"\"[^\"]*\")(.*)$", re.S)
+
+MAX_PENDING = 1024 # unpaired calls remembered per thread
+WINDOW_TOP = 3 # busiest functions kept per closed time window
+
+
+class FunctionStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.returns = 0
+        self.failures = 0
+        self.messages = {}
+        self.timed = 0
+        self.total = 0 # microseconds
+        self.max = 0
+
+    def add_duration(self, us):
+        self.timed += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def mean(self):
+        if not self.timed:
+            return 0
+        return float(self.total) / self.timed
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.returns += other.returns
+        self.failures += other.failures
+        for msg, n in other.messages.iteritems():
+            self.messages[msg] = self.messages.get(msg, 0) + n
+        self.timed += other.timed
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+
+class ValueTable(object):
+    """Approximate most frequent values in at most capacity entries."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {} # value: [count, error]
+        self.total = 0
+
+    def add(self, value, n=1, error=0):
+        self.total += n
+        entry = self.counts.get(value)
+        if entry is not None:
+            entry[0] += n
+            entry[1] += error
+        elif len(self.counts) < self.capacity:
+            self.counts[value] = [n, error]
+        else:
+            victim = min(self.counts, key=lambda v: self.counts[v][0])
+            low = self.counts.pop(victim)[0]
+            self.counts[value] = [low + n, low + error]
+
+    def merge(self, other):
+        total = self.total
+        for value, (n, error) in other.counts.iteritems():
+            self.add(value, n, error)
+        self.total = total + other.total
+
+    def top(self, n):
+        items = sorted(self.counts.iteritems(), key=lambda x: x[1][0],
+                       reverse=True)
+        return [(v, c, e) for v, (c, e) in items[:n]]
+
+
+class Window(object):
+    def __init__(self, start):
+        self.start = start
+        self.calls = 0
+        self.failures = 0
+        self.functions = {}
+
+    def truncate(self):
+        items = sorted(self.functions.iteritems(), key=lambda x: x[1],
+                       reverse=True)
+        self.functions = dict(items[:WINDOW_TOP])
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.failures += other.failures
+        for name, n in other.functions.iteritems():
+            self.functions[name] = self.functions.get(name, 0) + n
+
+
+class Analysis(object):
+    """Summaries of a log, or of a part of it.
+
+    Calls still in progress at the end (pending) and returns of calls
+    that started before (orphans) are kept per thread so consecutive
+    parts can be merged.
+    """
+    def __init__(self, arg_patterns, capacity, window, raw_pointers):
+        self.arg_patterns = arg_patterns
+        self.capacity = capacity
+        self.window = window
+        self.raw_pointers = raw_pointers
+        self.records = 0
+        self.messages = 0
+        self.unpaired = 0
+        self.first = None
+        self.last = None
+        self.functions = {}
+        self.args = {}
+        self.windows = {}
+        self.current_window = None
+        self.first_window = None
+        self.pending = {}
+        self.orphans = {}
+        self.tabulated = {}
+
+    def function(self, name):
+        st = self.functions.get(name)
+        if st is None:
+            st = self.functions[name] = FunctionStats(name)
+        return st
+
+    def tabulate(self, name):
+        """Names of the parameters of function name to count values of."""
+        params = self.tabulated.get(name)
+        if params is None:
+            params = []
+            for pattern in self.arg_patterns:
+                func, param = (pattern.split(":", 1) + ["*"])[:2]
+                if fnmatch.fnmatchcase(name, func):
+                    params.append(param)
+            self.tabulated[name] = params
+        return params
+
+    def add_args(self, name, params_str, params):
+        for m in param_re.finditer(params_str):
+            type, param, value = m.groups()
+            for pattern in params:
+                if fnmatch.fnmatchcase(param, pattern):
+                    break
+            else:
+                continue
+            if not self.raw_pointers and "*" in type and \
+                    value.startswith("0x"):
+                value = "<non-NULL>"
+            key = (name, param)
+            table = self.args.get(key)
+            if table is None:
+                table = self.args[key] = ValueTable(self.capacity)
+            table.add(value)
+
+    def window_of(self, timestamp):
+        key = timestamp // (self.window * 1000000)
+        w = self.windows.get(key)
+        if w is None:
+            w = self.windows[key] = Window(key * self.window)
+            if self.first_window is None:
+                self.first_window = key
+        if key != self.current_window:
+            # the first window may continue in the previous part
+            previous = self.windows.get(self.current_window)
+            if previous and self.current_window != self.first_window:
+                previous.truncate()
+            self.current_window = key
+        return w
+
+    def enter(self, thread, name, timestamp):
+        stack = self.pending.setdefault(thread, [])
+        if len(stack) >= MAX_PENDING:
+            del stack[0]
+            self.unpaired += 1
+        stack.append((name, timestamp))
+
+    def exit(self, thread, name, timestamp):
+        stack = self.pending.get(thread)
+        if stack:
+            if stack[-1][0] != name:
+                for i in xrange(len(stack) - 1, -1, -1):
+                    if stack[i][0] == name:
+                        # calls above never returned, or lines were lost
+                        self.unpaired += len(stack) - i - 1
+                        del stack[i + 1:]
+                        break
+                else:
+                    self.unpaired += len(stack)
+                    del stack[:]
+            if stack:
+                start = stack.pop()[1]
+                if timestamp is not None and start is not None:
+                    self.function(name).add_duration(timestamp - start)
+                return
+        orphans = self.orphans.setdefault(thread, [])
+        if len(orphans) >= MAX_PENDING:
+            self.unpaired += 1
+        else:
+            orphans.append((name, timestamp))
+
+    def scan(self, data, start, end):
+        for m in record_re.finditer(data, start, end):
+            sec, usec, thread, kind, text = m.groups()
+            self.records += 1
+            if "\033" in text:
+                text = color_re.sub("", text)
+            if sec is not None:
+                timestamp = int(sec) * 1000000 + int(usec)
+                if self.first is None:
+                    self.first = timestamp
+                self.last = timestamp
+            else:
+                timestamp = None
+
+            if kind == "!":
+                self.messages += 1
+                continue
+
+            idx = text.find("(")
+            space = text.find(" ")
+            if idx < 0 or (0 <= space < idx):
+                idx = space
+            if idx < 0:
+                name = text
+            else:
+                name = text[:idx]
+
+            if kind == ">":
+                st = self.function(name)
+                st.calls += 1
+                if timestamp is not None and self.window:
+                    w = self.window_of(timestamp)
+                    w.calls += 1
+                    w.functions[name] = w.functions.get(name, 0) + 1
+                params = self.tabulate(name)
+                if params and text.endswith(")") and idx == len(name):
+                    self.add_args(name, text[idx + 1:-1], params)
+                self.enter(thread, name, timestamp)
+                continue
+
+            st = self.function(name)
+            st.returns += 1
+            self.exit(thread, name, timestamp)
+            ret = text.find(" = (", len(name))
+            if ret < 0:
+                continue
+            out = text.rfind("output-parameters=(")
+            if out > ret:
+                text = text[:out]
+            # skip the return type, it may have parenthesis itself
+            level = 0
+            for i in xrange(ret + 3, len(text)):
+                c = text[i]
+                if c == "(":
+                    level += 1
+                elif c == ")":
+                    level -= 1
+                    if level == 0:
+                        break
+            m = value_re.match(text, i + 1)
+            if m and m.group(2):
+                msg = m.group(2)
+                st.failures += 1
+                st.messages[msg] = st.messages.get(msg, 0) + 1
+                if timestamp is not None and self.window:
+                    self.window_of(timestamp).failures += 1
+
+    def merge(self, other):
+        """Add the results of other, a part that follows this one."""
+        self.records += other.records
+        self.messages += other.messages
+        self.unpaired += other.unpaired
+        if self.first is None:
+            self.first = other.first
+        if other.last is not None:
+            self.last = other.last
+        for name, st in other.functions.iteritems():
+            self.function(name).merge(st)
+        for key, table in other.args.iteritems():
+            if key in self.args:
+                self.args[key].merge(table)
+            else:
+                self.args[key] = table
+        for key, w in other.windows.iteritems():
+            if key in self.windows:
+                self.windows[key].merge(w)
+            else:
+                self.windows[key] = w
+
+        for thread, orphans in other.orphans.iteritems():
+            stack = self.pending.get(thread, [])
+            left = []
+            for name, timestamp in orphans:
+                if stack and stack[-1][0] == name:
+                    start = stack.pop()[1]
+                    if timestamp is not None and start is not None:
+                        self.function(name).add_duration(timestamp - start)
+                else:
+                    self.unpaired += len(stack)
+                    del stack[:]
+                    left.append((name, timestamp))
+            if left:
+                self.orphans.setdefault(thread, []).extend(left)
+        for thread, stack in other.pending.iteritems():
+            self.pending.setdefault(thread, []).extend(stack)
+
+    def unpaired_total(self):
+        n = self.unpaired
+        for stack in self.pending.itervalues():
+            n += len(stack)
+        for orphans in self.orphans.itervalues():
+            n += len(orphans)
+        return n
+
+
+def open_map(filename):
+    f = open(filename, "rb")
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return "", 0
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ), size
+    finally:
+        f.close()
+
+
+def split(filename, n_parts):
+    """Offsets splitting filename in about n_parts at line boundaries."""
+    data, size = open_map(filename)
+    offsets = [0]
+    for i in xrange(1, n_parts):
+        pos = data.find("\n", max(size * i // n_parts, offsets[-1]))
+        if pos < 0:
+            break
+        offsets.append(pos + 1)
+    offsets.append(size)
+    return offsets
+
+
+def analyze_part(work):
+    filename, start, end, options = work
+    analysis = Analysis(*options)
+    data, size = open_map(filename)
+    analysis.scan(data, start, end)
+    return analysis
+
+
+def analyze(filename, options, n_processes=1):
+    offsets = split(filename, n_processes)
+    work = [(filename, start, end, options)
+            for start, end in zip(offsets, offsets[1:])]
+    if len(work) > 1:
+        pool = multiprocessing.Pool(len(work))
+        parts = pool.map(analyze_part, work)
+        pool.close()
+        pool.join()
+    else:
+        parts = map(analyze_part, work)
+    analysis = parts[0]
+    for part in parts[1:]:
+        analysis.merge(part)
+    return analysis
+
+
+def fmt_time(us):
+    if us >= 1e6:
+        return "%.2fs" % (us / 1e6)
+    elif us >= 1e3:
+        return "%.2fms" % (us / 1e3)
+    return "%dus" % us
+
+
+def fmt_timestamp(us):
+    return "[%5lu.%06lu]" % (us // 1000000, us % 1000000)
+
+
+sort_keys = {
+    "name": (lambda st: st.name, False),
+    "calls": (lambda st: st.calls, True),
+    "failures": (lambda st: st.failures, True),
+    "total": (lambda st: st.total, True),
+    "mean": (lambda st: st.mean(), True),
+    "max": (lambda st: st.max, True),
+    }
+
+
+def report(analysis, out, sort="calls", limit=0, top=5):
+    out.write("%d records, %d LOG! messages" %
+              (analysis.records, analysis.messages))
+    if analysis.first is not None:
+        out.write(", %s to %s" % (fmt_timestamp(analysis.first),
+                                  fmt_timestamp(analysis.last)))
+    out.write(", %d calls not paired\n\n" % (analysis.unpaired_total(),))
+
+    key, reverse = sort_keys[sort]
+    stats = sorted(analysis.functions.values(), key=key, reverse=reverse)
+    if limit:
+        stats = stats[:limit]
+    width = max([len("function")] + [len(st.name) for st in stats])
+    fmt = "%%-%ds %%10s %%10s %%10s %%10s %%10s\n" % (width,)
+    out.write(fmt % ("function", "calls", "failures", "total", "mean",
+                     "max"))
+    for st in stats:
+        out.write(fmt % (st.name, st.calls, st.failures, fmt_time(st.total),
+                         fmt_time(st.mean()), fmt_time(st.max)))
+
+    failed = [st for st in stats if st.failures]
+    if failed:
+        out.write("\nreturn checker hits\n")
+        for st in failed:
+            for msg, n in sorted(st.messages.iteritems(), key=lambda x: x[1],
+                                 reverse=True):
+                out.write("  %-*s %10d  %s\n" % (width, st.name, n, msg))
+
+    if analysis.args:
+        out.write("\nmost frequent argument values\n")
+        names = set(st.name for st in stats)
+        for name, param in sorted(analysis.args):
+            if name not in names:
+                continue
+            table = analysis.args[(name, param)]
+            out.write("  %s(%s), %d values\n" % (name, param, table.total))
+            for value, n, error in table.top(top):
+                if error:
+                    out.write("    %10d (+/-%d)  %s\n" % (n, error, value))
+                else:
+                    out.write("    %10d  %s\n" % (n, value))
+
+    if analysis.windows:
+        out.write("\ncalls per %ds window\n" % (analysis.window,))
+        for key in sorted(analysis.windows):
+            w = analysis.windows[key]
+            busiest = sorted(w.functions.iteritems(), key=lambda x: x[1],
+                             reverse=True)[:WINDOW_TOP]
+            out.write("  %s %10d calls %6d failures  %s\n" %
+                      (fmt_timestamp(w.start * 1000000), w.calls, w.failures,
+                       ", ".join("%s %d" % x for x in busiest)))
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options] <log file>"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-s", "--sort", action="store", default="calls",
+                      choices=sorted(sort_keys.keys()),
+                      help="Sort by one of: %s (default: calls)" %
+                      ", ".join(sorted(sort_keys.keys())))
+    parser.add_option("-n", "--limit", action="store", type="int",
+                      default=0,
+                      help="Show only the first N functions")
+    parser.add_option("-a", "--args", action="append", default=None,
+                      metavar="FUNCTION[:PARAMETER]",
+                      help=("Count values of matching arguments, shell "
+                            "patterns, may be repeated (default: all)"))
+    parser.add_option("-A", "--no-args", action="store_true", default=False,
+                      help="Do not count argument values")
+    parser.add_option("-k", "--top", action="store", type="int", default=5,
+                      help="Values shown per argument")
+    parser.add_option("--capacity", action="store", type="int", default=64,
+                      help="Distinct values tracked per argument")
+    parser.add_option("--raw-pointers", action="store_true", default=False,
+                      help="Count each pointer value on its own")
+    parser.add_option("-w", "--window", action="store", type="int",
+                      default=60,
+                      help="Seconds per time window, 0 to disable")
+    parser.add_option("-j", "--jobs", action="store", type="int", default=1,
+                      help="Split the log among this many processes")
+
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        raise SystemExit("Missing parameters, see --help")
+
+    if options.no_args:
+        patterns = []
+    else:
+        patterns = options.args or ["*"]
+    capacity = max(options.capacity, options.top)
+    analysis_options = (patterns, capacity, options.window,
+                        options.raw_pointers)
+    try:
+        analysis = analyze(args[0], analysis_options, max(options.jobs, 1))
+    except (IOError, EnvironmentError), e:
+        raise SystemExit("ERROR: %s" % (e,))
+
+    try:
+        report(analysis, sys.stdout, options.sort, options.limit,
+               options.top)
+    except IOError, e:
+        pass # closed pipe
@@ -0,0 +1,289 @@
+#!/usr/bin/python2
+
+"""
+Rebuild call trees from traces of wrappers built with
+<prefix>_LOG_CALL_TREE and report where time is spent.
+
+Both binary traces (<prefix>_LOG_BINARY) and text logs are accepted,
+text logs must have been written with <prefix>_LOG_TIMESTAMP. Every
+record carries the call depth of its thread, so calls made from
+callbacks (library -> our code -> library) are attributed to the call
+they happened in.
+
+For every function the inclusive time (with the wrapped calls it made,
+outermost call only when recursive) and the exclusive time (without
+them) are reported, sorted by exclusive time. With --tree the merged
+call paths are shown too.
+"""
+
+import sys
+import os
+import imp
+import re
+import optparse
+
+decode = imp.load_source(
+    "liblogger_decode",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "liblogger-decode.py"))
+
+text_record = re.compile(r"^\[\s*(\d+)\.(\d+)\] .*?(?:\[T:(\d+)\])?"
+                         r"\[D:(\d+)\].*?LOG([<>]) ([A-Za-z0-9_:]+)")
+
+
+class CallTreeError(Exception):
+    pass
+
+
+class Stats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.inclusive = 0
+        self.exclusive = 0
+        self.children = {} # only used for paths
+
+    def mean(self):
+        if not self.calls:
+            return 0
+        return float(self.exclusive) / self.calls
+
+
+class Frame(object):
+    __slots__ = ("name", "start", "children", "path")
+
+    def __init__(self, name, start, path):
+        self.name = name
+        self.start = start
+        self.children = 0
+        self.path = path
+
+
+class CallTree(object):
+    """Per function and per call path totals.
+
+    Feed records with enter(), exit() and lost(), records of each thread
+    must be in time order. Threads can be any hashable key.
+    """
+    def __init__(self):
+        self.functions = {}
+        self.root = Stats(None)
+        self.stacks = {}
+        self.mismatches = 0
+
+    def function(self, name):
+        st = self.functions.get(name)
+        if st is None:
+            st = self.functions[name] = Stats(name)
+        return st
+
+    def enter(self, thread, depth, name, timestamp):
+        stack = self.stacks.setdefault(thread, [])
+        if len(stack) > depth:
+            # exits were lost, the calls never returned for us
+            self.mismatches += 1
+            del stack[depth:]
+        if stack:
+            parent = stack[-1].path
+        else:
+            parent = self.root
+        path = parent.children.get(name)
+        if path is None:
+            path = parent.children[name] = Stats(name)
+        stack.append(Frame(name, timestamp, path))
+
+    def exit(self, thread, depth, name, timestamp):
+        stack = self.stacks.get(thread)
+        if not stack:
+            self.mismatches += 1
+            return
+        if len(stack) > depth + 1:
+            self.mismatches += 1
+            del stack[depth + 1:]
+        frame = stack.pop()
+        if frame.name != name:
+            self.mismatches += 1
+            return
+
+        elapsed = timestamp - frame.start
+        exclusive = elapsed - frame.children
+        if stack:
+            stack[-1].children += elapsed
+
+        for st in (self.function(name), frame.path):
+            st.calls += 1
+            st.exclusive += exclusive
+        frame.path.inclusive += elapsed
+        for f in stack:
+            if f.name == name:
+                break # recursive, counted by the outermost call
+        else:
+            self.function(name).inclusive += elapsed
+
+    def lost(self, thread):
+        """Records of thread were dropped, forget its calls in progress."""
+        if self.stacks.get(thread):
+            self.mismatches += 1
+        self.stacks[thread] = []
+
+    def total(self):
+        return sum(st.inclusive for st in self.root.children.itervalues())
+
+
+def load_binary(filename, tree):
+    trace = decode.Trace(filename)
+    names = trace.function_names
+    records = list(trace)
+    records.sort(key=lambda r: r[5])
+    for function, type, error, thread, depth, timestamp, ret, args in records:
+        if type == decode.BINARY_DROPPED:
+            tree.lost((filename, thread))
+            continue
+        if not depth:
+            raise CallTreeError("%s was not recorded with "
+                                "<prefix>_LOG_CALL_TREE" % (filename,))
+        if function >= len(names):
+            continue
+        if type == decode.BINARY_ENTER:
+            tree.enter((filename, thread), depth - 1, names[function],
+                       timestamp)
+        elif type == decode.BINARY_EXIT:
+            tree.exit((filename, thread), depth - 1, names[function],
+                      timestamp)
+
+
+def load_text(filename, tree):
+    found = False
+    f = open(filename)
+    for line in f:
+        m = text_record.match(line)
+        if not m:
+            continue
+        found = True
+        sec, usec, thread, depth, kind, name = m.groups()
+        timestamp = int(sec) * 1000000000 + int(usec) * 1000
+        thread = (filename, thread)
+        if kind == ">":
+            tree.enter(thread, int(depth), name, timestamp)
+        else:
+            tree.exit(thread, int(depth), name, timestamp)
+    f.close()
+    if not found:
+        raise CallTreeError("%s has no records with timestamp and depth, "
+                            "was it logged with <prefix>_LOG_TIMESTAMP and "
+                            "<prefix>_LOG_CALL_TREE?" % (filename,))
+
+
+def load(filename, tree):
+    f = open(filename, "rb")
+    magic = f.read(len(decode.BINARY_MAGIC))
+    f.close()
+    if magic == decode.BINARY_MAGIC:
+        load_binary(filename, tree)
+    else:
+        load_text(filename, tree)
+
+
+def fmt_time(ns):
+    if ns >= 1e9:
+        return "%.2fs" % (ns / 1e9)
+    elif ns >= 1e6:
+        return "%.2fms" % (ns / 1e6)
+    elif ns >= 1e3:
+        return "%.2fus" % (ns / 1e3)
+    return "%dns" % ns
+
+
+def percent(part, total):
+    if not total:
+        return "-"
+    return "%.1f%%" % (100.0 * part / total)
+
+
+sort_keys = {
+    "name": (lambda st: st.name, False),
+    "calls": (lambda st: st.calls, True),
+    "inclusive": (lambda st: st.inclusive, True),
+    "exclusive": (lambda st: st.exclusive, True),
+    "mean": (lambda st: st.mean(), True),
+    }
+
+
+def report(tree, out, sort="exclusive", limit=0):
+    key, reverse = sort_keys[sort]
+    stats = sorted(tree.functions.values(), key=key, reverse=reverse)
+    if limit:
+        stats = stats[:limit]
+    total = tree.total()
+
+    width = max([len("function")] + [len(st.name) for st in stats])
+    fmt = "%%-%ds %%10s %%10s %%7s %%10s %%10s\n" % (width,)
+    out.write(fmt % ("function", "calls", "exclusive", "", "inclusive",
+                     "mean excl"))
+    for st in stats:
+        out.write(fmt % (st.name, st.calls, fmt_time(st.exclusive),
+                         percent(st.exclusive, total),
+                         fmt_time(st.inclusive), fmt_time(st.mean())))
+
+
+def report_tree(tree, out, min_percent=0.0):
+    total = tree.total()
+
+    def show(st, level):
+        out.write("%s%s  calls=%d inclusive=%s (%s) exclusive=%s\n" %
+                  ("  " * level, st.name, st.calls, fmt_time(st.inclusive),
+                   percent(st.inclusive, total), fmt_time(st.exclusive)))
+        children = sorted(st.children.values(), key=lambda c: c.inclusive,
+                          reverse=True)
+        for child in children:
+            if total and 100.0 * child.inclusive / total < min_percent:
+                continue
+            show(child, level + 1)
+
+    children = sorted(tree.root.children.values(), key=lambda c: c.inclusive,
+                      reverse=True)
+    for st in children:
+        if total and 100.0 * st.inclusive / total < min_percent:
+            continue
+        show(st, 0)
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options] <trace or log> [trace or log ...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-s", "--sort", action="store", default="exclusive",
+                      choices=sorted(sort_keys.keys()),
+                      help="Sort by one of: %s (default: exclusive)" %
+                      ", ".join(sorted(sort_keys.keys())))
+    parser.add_option("-n", "--limit", action="store", type="int",
+                      default=0,
+                      help="Show only the first N functions")
+    parser.add_option("-t", "--tree", action="store_true", default=False,
+                      help="Show the call tree after the functions")
+    parser.add_option("-m", "--min-percent", action="store", type="float",
+                      default=0.0,
+                      help=("Hide call tree paths under this percentage "
+                            "of the total time"))
+
+    options, args = parser.parse_args()
+    if not args:
+        raise SystemExit("Missing parameters, see --help")
+
+    tree = CallTree()
+    try:
+        for filename in args:
+            load(filename, tree)
+    except (IOError, decode.TraceError, CallTreeError), e:
+        raise SystemExit("ERROR: %s" % (e,))
+
+    try:
+        report(tree, sys.stdout, options.sort, options.limit)
+        if options.tree:
+            sys.stdout.write("\n")
+            report_tree(tree, sys.stdout, options.min_percent)
+        if tree.mismatches:
+            sys.stdout.write("\n%d calls could not be matched, records "
+                             "were lost or the trace is partial\n" %
+                             (tree.mismatches,))
+    except IOError, e:
+        pass # closed pipe
@@ -0,0 +1,351 @@
+#!/usr/bin/python2
+
+"""
+Decode binary traces written by wrappers built with <prefix>_LOG_BINARY.
+
+The header and configuration given to liblogger.py to generate the
+wrapper must be given again, they are used to name and format the
+parameters, as well as the other libraries of a module (--library).
+The output is the same LOG> and LOG< text the wrapper would print
+without <prefix>_LOG_BINARY.
+
+Since only raw values are recorded, strings and output parameters are
+not dereferenced: strings are shown as pointers and output parameters
+are omitted.
+"""
+
+import sys
+import os
+import optparse
+import struct
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import liblogger
+
+BINARY_MAGIC = "LLBT"
+BINARY_VERSION = 1
+BINARY_ENTER = 1
+BINARY_EXIT = 2
+BINARY_DROPPED = 3
+BINARY_SIZES = 4 # buffer sizes for liblogger-replay, not shown
+
+# must match struct <prefix>_binary_record, args follow
+record_head = struct.Struct("=IHHiIQQQ")
+
+
+class TraceError(Exception):
+    pass
+
+
+def to_signed(value, bits):
+    value &= (1 << bits) - 1
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+
+def to_unsigned(value, bits):
+    return value & ((1 << bits) - 1)
+
+
+def to_double(value):
+    return struct.unpack("=d", struct.pack("=Q", value))[0]
+
+
+def fmt_char(value):
+    c = to_unsigned(value, 8)
+    return "%d (%c)" % (to_signed(c, 8), chr(c))
+
+
+def fmt_alternate(fmt, value):
+    # C's # flag doesn't prefix zero
+    if value == 0:
+        return "0"
+    return fmt % value
+
+
+def fmt_pointer(value):
+    if value == 0:
+        return "(nil)"
+    return "%#x" % value
+
+
+def fmt_errno(value):
+    value = to_signed(value, 32)
+    return "%d %s" % (value, os.strerror(value))
+
+
+def fmt_bool(value):
+    if value & 0xffffffff:
+        return "true"
+    return "false"
+
+
+# value formatting of the builtin formatters, by name without prefix
+builtin_formatters = {
+    "log_fmt_int": lambda v: "%d" % to_signed(v, 32),
+    "log_fmt_uint": lambda v: "%u" % to_unsigned(v, 32),
+    "log_fmt_hex_int": lambda v: fmt_alternate("%#x", to_unsigned(v, 32)),
+    "log_fmt_errno": fmt_errno,
+    "log_fmt_octal_int": lambda v: fmt_alternate("%#o", to_unsigned(v, 32)),
+    "log_fmt_char": fmt_char,
+    "log_fmt_uchar": lambda v: "%u" % to_unsigned(v, 8),
+    "log_fmt_hex_char": lambda v: fmt_alternate("%#x", to_unsigned(v, 8)) +
+        " (%c)" % chr(to_unsigned(v, 8)),
+    "log_fmt_octal_char": lambda v: fmt_alternate("%#o", to_unsigned(v, 8)) +
+        " (%c)" % chr(to_unsigned(v, 8)),
+    "log_fmt_short": lambda v: "%d" % to_signed(v, 16),
+    "log_fmt_ushort": lambda v: "%u" % to_unsigned(v, 16),
+    "log_fmt_hex_short": lambda v: fmt_alternate("%#x", to_unsigned(v, 16)),
+    "log_fmt_long": lambda v: "%d" % to_signed(v, 64),
+    "log_fmt_ulong": lambda v: "%u" % v,
+    "log_fmt_hex_long": lambda v: fmt_alternate("%#x", v),
+    "log_fmt_long_long": lambda v: "%d" % to_signed(v, 64),
+    "log_fmt_ulong_long": lambda v: "%u" % v,
+    "log_fmt_hex_long_long": lambda v: fmt_alternate("%#x", v),
+    "log_fmt_bool": fmt_bool,
+    "log_fmt_string": fmt_pointer,
+    "log_fmt_double": lambda v: "%g" % to_double(v),
+    "log_fmt_pointer": fmt_pointer,
+    }
+
+# message of the builtin checkers, by name without prefix
+builtin_checkers = {
+    "log_checker_null": lambda v, e: v and "NULL was expected",
+    "log_checker_non_null": lambda v, e: not v and "non-NULL was expected",
+    "log_checker_zero": lambda v, e: v and "ZERO was expected",
+    "log_checker_non_zero": lambda v, e: not v and "non-ZERO was expected",
+    "log_checker_false": lambda v, e: v and "FALSE was expected",
+    "log_checker_true": lambda v, e: not v and "TRUE was expected",
+    "log_checker_errno": lambda v, e: not e and os.strerror(e),
+    }
+
+
+def builtin_name(name, ctxt):
+    start = ctxt["prefix"] + "_"
+    if name and name.startswith(start):
+        return name[len(start):]
+    return name
+
+
+def value_formatter(formatter, kind, ctxt):
+    """Python version of the C formatter, custom ones are not known."""
+    func = builtin_formatters.get(builtin_name(formatter, ctxt))
+    if func:
+        if kind == "double" and func is not builtin_formatters["log_fmt_double"]:
+            # value was stored as double, recorded bits are meaningless
+            return lambda v: "%g" % to_double(v)
+        return func
+    if kind == "pointer":
+        return fmt_pointer
+    elif kind == "double":
+        return builtin_formatters["log_fmt_double"]
+    return builtin_formatters["log_fmt_hex_long_long"]
+
+
+class FunctionDecoder(object):
+    def __init__(self, func, ctxt):
+        self.name = liblogger.function_log_name(func, ctxt)
+        self.params = []
+        func.parameters_unnamed_fix(ctxt["prefix"] + "_p_")
+        if func.has_parameters():
+            for p in func.parameters:
+                name, type = liblogger.parameter_name_type(p)
+                formatter = liblogger.get_type_formatter(func.name, name,
+                                                         type, ctxt)
+                if "[" in type:
+                    kind = "pointer"
+                else:
+                    kind = liblogger.get_type_raw_kind(p.type, p.pointer,
+                                                       ctxt)
+                self.params.append(
+                    (type, name, value_formatter(formatter, kind, ctxt)))
+
+        self.ret_type = str(func.ret_type) + " *" * func.ret_pointer
+        self.ret = None
+        self.checker = None
+        if self.ret_type != "void":
+            formatter = liblogger.get_type_formatter(func.name, "return",
+                                                     self.ret_type, ctxt)
+            kind = liblogger.get_type_raw_kind(func.ret_type, func.ret_pointer,
+                                               ctxt)
+            self.ret = value_formatter(formatter, kind, ctxt)
+            checker = liblogger.get_return_checker(func.name, self.ret_type,
+                                                   ctxt)
+            if checker:
+                self.checker = builtin_checkers.get(builtin_name(checker,
+                                                                 ctxt))
+
+    def params_str(self, args):
+        if not self.params:
+            return ""
+        params = []
+        for (type, name, formatter), value in zip(self.params, args):
+            params.append("%s %s=%s" % (type, name, formatter(value)))
+        return "(%s)" % (", ".join(params),)
+
+    def enter_str(self, args):
+        return "LOG> %s%s" % (self.name, self.params_str(args))
+
+    def exit_str(self, args, ret, error):
+        s = "LOG< %s%s" % (self.name, self.params_str(args))
+        if self.ret:
+            s += " = (%s)%s" % (self.ret_type, self.ret(ret))
+            if self.checker:
+                msg = self.checker(ret, error)
+                if msg:
+                    s += msg
+        return s
+
+
+class Trace(object):
+    """Binary trace file, iterate to get its records as tuples:
+
+    (function, type, error, thread, depth, timestamp, ret, args)
+
+    depth is the call depth plus one for wrappers built with
+    <prefix>_LOG_CALL_TREE, zero otherwise.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        if self.file.read(4) != BINARY_MAGIC:
+            raise TraceError("%s is not a liblogger binary trace" % filename)
+        (self.version, self.record_size, self.max_args,
+         n_functions) = struct.unpack("=4I", self.file.read(16))
+        if self.version != BINARY_VERSION:
+            raise TraceError("unsupported trace version %d" % self.version)
+        self.args = struct.Struct("=%dQ" % self.max_args)
+        if record_head.size + self.args.size != self.record_size:
+            raise TraceError("unexpected record size %d" % self.record_size)
+
+        self.function_names = []
+        buf = ""
+        while len(self.function_names) < n_functions:
+            idx = buf.find("\0")
+            if idx < 0:
+                data = self.file.read(4096)
+                if not data:
+                    raise TraceError("truncated function names")
+                buf += data
+                continue
+            self.function_names.append(buf[:idx])
+            buf = buf[idx + 1:]
+        self.pending = buf
+
+    def __iter__(self):
+        size = self.record_size
+        head_size = record_head.size
+        buf = self.pending
+        while True:
+            data = self.file.read(size * 1024)
+            buf += data
+            n = len(buf) // size
+            if not data and not n:
+                break
+            for i in xrange(n):
+                off = i * size
+                (function, type, n_args, error, depth, thread, timestamp,
+                 ret) = record_head.unpack_from(buf, off)
+                args = self.args.unpack_from(buf, off + head_size)[:n_args]
+                yield (function, type, error, thread, depth, timestamp, ret,
+                       args)
+            buf = buf[n * size:]
+        if buf:
+            print >> sys.stderr, "WARNING: trace ends with a partial record"
+
+
+def decode(trace, decoders, out, show_timestamp=False, sort=True):
+    records = iter(trace)
+    if sort:
+        # per thread buffers are flushed one after the other
+        records = list(records)
+        records.sort(key=lambda r: r[5])
+
+    main_thread = None
+    for function, type, error, thread, depth, timestamp, ret, args in records:
+        if type == BINARY_SIZES:
+            continue
+        if main_thread is None:
+            main_thread = thread
+
+        line = []
+        if show_timestamp:
+            line.append("[%5lu.%06lu] " % (timestamp // 1000000000,
+                                            timestamp % 1000000000 // 1000))
+        if thread != main_thread:
+            line.append("[T:%lu]" % (thread,))
+        if depth:
+            line.append("[D:%d]" % (depth - 1,))
+
+        if type == BINARY_DROPPED:
+            line.append("LOG! %d records dropped" % (ret,))
+        elif function >= len(decoders):
+            line.append("LOG? unknown function id %d" % (function,))
+        elif type == BINARY_ENTER:
+            line.append(decoders[function].enter_str(args))
+        elif type == BINARY_EXIT:
+            line.append(decoders[function].exit_str(args, ret, error))
+        else:
+            line.append("LOG? unknown record type %d" % (type,))
+        out.write("".join(line))
+        out.write("\n")
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options] <header.h> <libname.so> <trace>"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-c", "--config", action="store", default=None,
+                      help="Configuration file given to liblogger.py")
+    parser.add_option("-p", "--prefix", action="store", default=None,
+                      help="Prefix given to liblogger.py")
+    parser.add_option("-t", "--timestamp", action="store_true",
+                      default=False,
+                      help="Show record timestamps")
+    parser.add_option("-n", "--no-sort", action="store_true", default=False,
+                      help=("Keep records in file order, grouped by thread "
+                            "flushes, instead of sorting by timestamp"))
+    parser.add_option("-C", "--cache-dir", action="store", default=None,
+                      help="Reuse parsed headers from this cache directory")
+    parser.add_option("-L", "--library", action="append", default=[],
+                      metavar="HEADER:LIBNAME",
+                      help="Library given to liblogger.py, may be repeated")
+
+    options, args = parser.parse_args()
+    try:
+        header, libname, tracefile = args
+    except ValueError, e:
+        raise SystemExit("Missing parameters, see --help")
+
+    job = {"header": header, "libname": libname, "prefix": options.prefix}
+    try:
+        job["libraries"] = liblogger.parse_libraries(options.library)
+    except ValueError, e:
+        raise SystemExit("Invalid --library: %s" % (e,))
+    cfg = liblogger.load_config(options.config)
+    cache = None
+    if options.cache_dir:
+        cache = liblogger.ParseCache(options.cache_dir)
+    ctxt = liblogger.make_module_context(job, cfg, cache)
+
+    try:
+        trace = Trace(tracefile)
+    except (IOError, TraceError), e:
+        raise SystemExit("ERROR: %s" % (e,))
+
+    if ctxt.get("libraries"):
+        funcs = liblogger.select_module_functions(ctxt)
+    else:
+        funcs = liblogger.select_functions(ctxt)
+    names = [liblogger.function_log_name(func, ctxt) for func in funcs]
+    if names != trace.function_names:
+        raise SystemExit("ERROR: trace functions do not match %s, was it "
+                         "generated with different options?" % (header,))
+
+    decoders = [FunctionDecoder(func, liblogger.function_context(func, ctxt))
+                for func in funcs]
+    try:
+        decode(trace, decoders, sys.stdout, options.timestamp,
+               not options.no_sort)
+    except IOError, e:
+        pass # closed pipe
@@ -0,0 +1,176 @@
+#!/usr/bin/python2
+
+"""
+Report latency histograms written by wrappers built with
+<prefix>_LOG_PROFILE.
+
+Each profile file holds one dump per exit or signal, the last complete
+one of each file is used. Given several files (ie: one per process) the
+histograms are added. For every function the number of calls, total
+and mean time plus p50, p99 and max latencies are shown. Percentiles
+are estimated from the power of 2 buckets.
+"""
+
+import sys
+import optparse
+
+PROFILE_MAGIC = "# liblogger-profile"
+PROFILE_VERSION = 1
+
+
+class ProfileError(Exception):
+    pass
+
+
+class FunctionStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = {}
+
+    def add(self, calls, total, max_ns, buckets):
+        self.calls += calls
+        self.total += total
+        self.max = max(self.max, max_ns)
+        for b, n in buckets.iteritems():
+            self.buckets[b] = self.buckets.get(b, 0) + n
+
+    def mean(self):
+        if not self.calls:
+            return 0
+        return float(self.total) / self.calls
+
+    def percentile(self, p):
+        """Latency under which p percent of calls took, in nanoseconds.
+
+        Interpolates linearly inside the bucket, never above max.
+        """
+        if not self.calls:
+            return 0
+        rank = self.calls * p / 100.0
+        seen = 0
+        for b in sorted(self.buckets):
+            n = self.buckets[b]
+            if seen + n >= rank:
+                if b == 0:
+                    return 0
+                low = 1 << (b - 1)
+                high = 1 << b
+                value = low + (high - low) * (rank - seen) / n
+                return min(value, self.max)
+            seen += n
+        return self.max
+
+
+def parse_dump_line(line, stats):
+    parts = line.split()
+    if len(parts) < 4:
+        raise ProfileError("invalid line: %r" % (line,))
+    name = parts[0]
+    calls, total, max_ns = [int(x) for x in parts[1:4]]
+    buckets = {}
+    for part in parts[4:]:
+        b, n = part.split(":")
+        buckets[int(b)] = int(n)
+    st = stats.get(name)
+    if st is None:
+        st = stats[name] = FunctionStats(name)
+    st.add(calls, total, max_ns, buckets)
+
+
+def last_dump(filename):
+    """Lines of the last complete dump of filename."""
+    last = None
+    current = None
+    f = open(filename)
+    for line in f:
+        line = line.rstrip("\n")
+        if line.startswith(PROFILE_MAGIC):
+            version = int(line.split()[2])
+            if version != PROFILE_VERSION:
+                raise ProfileError("%s: unsupported version %d" %
+                                   (filename, version))
+            current = []
+        elif line == "# end":
+            if current is not None:
+                last = current
+            current = None
+        elif current is not None:
+            current.append(line)
+    f.close()
+    if last is None:
+        raise ProfileError("%s: no complete profile" % (filename,))
+    return last
+
+
+def load(filenames):
+    stats = {}
+    for filename in filenames:
+        for line in last_dump(filename):
+            parse_dump_line(line, stats)
+    return stats.values()
+
+
+def fmt_time(ns):
+    if ns >= 1e9:
+        return "%.2fs" % (ns / 1e9)
+    elif ns >= 1e6:
+        return "%.2fms" % (ns / 1e6)
+    elif ns >= 1e3:
+        return "%.2fus" % (ns / 1e3)
+    return "%dns" % ns
+
+
+sort_keys = {
+    "name": (lambda st: st.name, False),
+    "calls": (lambda st: st.calls, True),
+    "total": (lambda st: st.total, True),
+    "mean": (lambda st: st.mean(), True),
+    "p50": (lambda st: st.percentile(50), True),
+    "p99": (lambda st: st.percentile(99), True),
+    "max": (lambda st: st.max, True),
+    }
+
+
+def report(stats, out, sort="total", limit=0):
+    key, reverse = sort_keys[sort]
+    stats = sorted(stats, key=key, reverse=reverse)
+    if limit:
+        stats = stats[:limit]
+
+    width = max([len("function")] + [len(st.name) for st in stats])
+    fmt = "%%-%ds %%10s %%10s %%10s %%10s %%10s %%10s\n" % (width,)
+    out.write(fmt % ("function", "calls", "total", "mean", "p50", "p99",
+                     "max"))
+    for st in stats:
+        out.write(fmt % (st.name, st.calls, fmt_time(st.total),
+                         fmt_time(st.mean()), fmt_time(st.percentile(50)),
+                         fmt_time(st.percentile(99)), fmt_time(st.max)))
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options] <file.profile> [file.profile ...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-s", "--sort", action="store", default="total",
+                      choices=sorted(sort_keys.keys()),
+                      help="Sort by one of: %s (default: total)" %
+                      ", ".join(sorted(sort_keys.keys())))
+    parser.add_option("-n", "--limit", action="store", type="int",
+                      default=0,
+                      help="Show only the first N functions")
+
+    options, args = parser.parse_args()
+    if not args:
+        raise SystemExit("Missing parameters, see --help")
+
+    try:
+        stats = load(args)
+    except (IOError, ValueError, ProfileError), e:
+        raise SystemExit("ERROR: %s" % (e,))
+
+    try:
+        report(stats, sys.stdout, options.sort, options.limit)
+    except IOError, e:
+        pass # closed pipe
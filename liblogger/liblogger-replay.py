@@ -0,0 +1,572 @@
+#!/usr/bin/python2
+
+"""
+Generate a C program that replays calls recorded by wrappers built with
+<prefix>_LOG_RECORD against the real library, timing every call.
+
+The header and configuration given to liblogger.py must be given again,
+the driver is generated from the same parsed functions and includes the
+header, so it is linked with the library to benchmark:
+
+    liblogger-replay.py mylib.h libmylib.so replay-mylib.c
+    cc -O2 -I. replay-mylib.c -o replay-mylib -lmylib
+    ./replay-mylib log_mylib.1234.trace
+
+Calls are issued from a single thread in timestamp order. Pointers are
+not recorded, so they are mapped: pointers returned by the library are
+given back when their recorded value is used again, other pointers get
+zero filled buffers of the recorded size (or a scratch buffer if it is
+unknown, see parameter-<name>-size) and callbacks are replaced by a
+function that does nothing. Functions that take or return aggregates by
+value cannot be replayed and are skipped.
+"""
+
+import sys
+import os
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import liblogger
+
+progname = "liblogger-replay.py"
+
+
+def is_function_pointer(type, pointer, ctxt):
+    """Like liblogger.get_type_raw_kind(), follows typedefs."""
+    seen = set()
+    while pointer == 0:
+        if isinstance(type, liblogger.FunctionPointer):
+            return True
+        elif isinstance(type, liblogger.Typedef):
+            pointer = type.pointer
+            type = type.reference
+            continue
+        name = " ".join(x for x in str(type).split(" ")
+                        if x not in ("const", "volatile"))
+        if name in seen:
+            return False
+        seen.add(name)
+        typedef = ctxt["types"].find(liblogger.Typedef, name)
+        if not typedef:
+            return False
+        type = typedef
+    return False
+
+
+def is_string(type):
+    return type.replace("const", "").replace(" ", "") in ("char*",
+                                                         "unsignedchar*")
+
+
+def argument_value(func, i, p, ctxt):
+    """C expression converting recorded argument i, None if impossible."""
+    name, type = liblogger.parameter_name_type(p)
+    if "[" in type:
+        type = type[:type.index("[")].strip() + " *"
+        kind = "pointer"
+    else:
+        kind = liblogger.get_type_raw_kind(p.type, p.pointer, ctxt)
+    repl = {"prefix": ctxt["prefix"], "type": type, "i": i}
+    if kind is None:
+        return None
+    elif kind == "double":
+        value = "%(prefix)s_replay_double(r->args[%(i)d])"
+    elif kind == "integer":
+        value = "r->args[%(i)d]"
+    elif is_function_pointer(p.type, p.pointer, ctxt):
+        value = "(void (*)(void))%(prefix)s_replay_noop"
+    else:
+        repl["string"] = int(is_string(type))
+        value = ("%(prefix)s_replay_pointer(r->args[%(i)d], "
+                 "sizes[%(i)d], %(string)d)")
+    return "%(prefix)s_REPLAY_ARG(%(type)s, a%(i)d, " % repl + \
+           value % repl + ");"
+
+
+def generate_call(f, func, ctxt):
+    """Writes the switch case replaying func, False if it can't be."""
+    func.parameters_unnamed_fix(ctxt["prefix"] + "_p_")
+    args = []
+    if func.has_parameters():
+        for i, p in enumerate(func.parameters):
+            arg = argument_value(func, i, p, ctxt)
+            if arg is None:
+                return False
+            args.append(arg)
+
+    ret_type = func.ret_type_str()
+    if ret_type == "void":
+        assign = ""
+    else:
+        kind = liblogger.get_type_raw_kind(func.ret_type, func.ret_pointer,
+                                           ctxt)
+        if kind is None:
+            return False
+        elif kind == "pointer":
+            assign = "ret = (uint64_t)(uintptr_t)"
+        elif kind == "double":
+            assign = "%s_replay_sink = " % (ctxt["prefix"],)
+        else:
+            assign = "ret = (uint64_t)"
+
+    repl = {"prefix": ctxt["prefix"],
+            "id": ctxt["function_ids"][func.name],
+            "name": func.name,
+            "assign": assign,
+            "args": ", ".join("a%d" % i for i in xrange(len(args))),
+            }
+    f.write("    case %(id)d: {\n" % repl)
+    for arg in args:
+        f.write("        %s\n" % (arg,))
+    f.write("""\
+        t0 = %(prefix)s_replay_now();
+        %(assign)s%(name)s(%(args)s);
+        break;
+    }
+""" % repl)
+    return True
+
+
+def generate_driver(outfile, ctxt):
+    funcs = liblogger.select_functions(ctxt)
+    ctxt["functions"] = funcs
+    ctxt["function_ids"] = dict((func.name, i) for i, func in enumerate(funcs))
+    repl = {"prefix": ctxt["prefix"],
+            "header": ctxt["header"],
+            "progname": progname,
+            "timestamp": liblogger.timestamp,
+            "function_table": liblogger.generate_function_table(ctxt),
+            }
+    pointers = []
+    for func in funcs:
+        kind = liblogger.get_type_raw_kind(func.ret_type, func.ret_pointer,
+                                           ctxt)
+        pointers.append(str(int(kind == "pointer")))
+    repl["returns_pointer"] = ", ".join(pointers)
+
+    f = open(outfile, "w")
+    f.write("""\
+/* this file was auto-generated from %(header)s by %(progname)s.
+ * %(timestamp)s
+ *
+ * usage: <program> <trace> [repetitions]
+ */
+
+""" % repl)
+    cfg = ctxt["cfg"]
+    headers = None
+    if cfg:
+        try:
+            headers = cfg.get("global", "headers", vars=repl)
+        except Exception, e:
+            pass
+        if headers:
+            for h in headers.split(","):
+                f.write("#include <%s>\n" % h.strip())
+    if not headers:
+        f.write("#include <%(header)s>\n" % ctxt)
+
+    f.write("""
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <time.h>
+
+%(function_table)s
+#define %(prefix)s_BINARY_MAGIC "LLBT"
+#define %(prefix)s_BINARY_VERSION 1
+#define %(prefix)s_BINARY_ENTER 1
+#define %(prefix)s_BINARY_EXIT 2
+#define %(prefix)s_BINARY_DROPPED 3
+#define %(prefix)s_BINARY_SIZES 4
+
+/* buffer given to pointers of unknown size */
+#ifndef %(prefix)s_REPLAY_SCRATCH_SIZE
+#define %(prefix)s_REPLAY_SCRATCH_SIZE 4096
+#endif
+
+#define %(prefix)s_REPLAY_MAX_THREADS 256
+#define %(prefix)s_REPLAY_MAX_DEPTH 256
+#define %(prefix)s_REPLAY_LIBRARY_POINTER UINT64_MAX
+
+#define %(prefix)s_REPLAY_ARG(type, name, value) \\
+    __typeof__((type)0) name = (type)(value)
+
+/* record of any number of arguments, see liblogger-decode */
+struct %(prefix)s_record {
+    uint32_t function;
+    uint16_t type;
+    uint16_t n_args;
+    int32_t error;
+    uint32_t depth;
+    uint64_t thread;
+    uint64_t timestamp;
+    uint64_t ret;
+    uint64_t args[];
+};
+
+struct %(prefix)s_replay_thread {
+    uint64_t thread;
+    unsigned int depth;
+    uint64_t live[%(prefix)s_REPLAY_MAX_DEPTH]; /* returned values */
+    const uint64_t *sizes; /* of the next call */
+};
+
+struct %(prefix)s_replay_pointer_entry {
+    uint64_t recorded;
+    void *live;
+    uint64_t size;
+};
+
+static struct {
+    uint64_t calls;
+    uint64_t total;
+    uint64_t min;
+    uint64_t max;
+} %(prefix)s_replay_stats[%(prefix)s_N_FUNCTIONS];
+
+static struct %(prefix)s_replay_thread %(prefix)s_replay_threads[%(prefix)s_REPLAY_MAX_THREADS];
+static unsigned int %(prefix)s_replay_n_threads = 0;
+static struct %(prefix)s_replay_pointer_entry *%(prefix)s_replay_pointers = NULL;
+static size_t %(prefix)s_replay_pointers_size = 0; /* power of 2 */
+static size_t %(prefix)s_replay_pointers_used = 0;
+static volatile double %(prefix)s_replay_sink;
+
+/* returned pointers are given back when used as arguments */
+static const unsigned char %(prefix)s_replay_returns_pointer[%(prefix)s_N_FUNCTIONS] = {
+    %(returns_pointer)s
+};
+static const uint64_t %(prefix)s_replay_no_sizes[%(prefix)s_LOG_BINARY_MAX_ARGS];
+
+static uint64_t %(prefix)s_replay_now(void)
+{
+    struct timespec spec;
+    clock_gettime(CLOCK_MONOTONIC, &spec);
+    return (uint64_t)spec.tv_sec * 1000000000ULL + spec.tv_nsec;
+}
+
+static double %(prefix)s_replay_double(uint64_t value)
+{
+    double d;
+    memcpy(&d, &value, sizeof(d));
+    return d;
+}
+
+/* given instead of callbacks, their calls would go to the recording */
+static void %(prefix)s_replay_noop(void)
+{
+}
+
+static struct %(prefix)s_replay_pointer_entry *%(prefix)s_replay_pointer_find(uint64_t recorded)
+{
+    size_t mask = %(prefix)s_replay_pointers_size - 1;
+    size_t i = (recorded >> 4) * 11400714819323198485ULL;
+
+    for (i &= mask; ; i = (i + 1) & mask) {
+        struct %(prefix)s_replay_pointer_entry *e = %(prefix)s_replay_pointers + i;
+        if (!e->recorded || e->recorded == recorded)
+            return e;
+    }
+}
+
+static void %(prefix)s_replay_pointer_set(uint64_t recorded, void *live, uint64_t size)
+{
+    struct %(prefix)s_replay_pointer_entry *e;
+
+    if (%(prefix)s_replay_pointers_used * 2 >= %(prefix)s_replay_pointers_size) {
+        struct %(prefix)s_replay_pointer_entry *old = %(prefix)s_replay_pointers;
+        size_t i, old_size = %(prefix)s_replay_pointers_size;
+
+        %(prefix)s_replay_pointers_size = old_size ? old_size * 2 : 1024;
+        %(prefix)s_replay_pointers = calloc(%(prefix)s_replay_pointers_size,
+                                            sizeof(*old));
+        if (!%(prefix)s_replay_pointers) {
+            fputs("ERROR: out of memory.\\n", stderr);
+            exit(1);
+        }
+        for (i = 0; i < old_size; i++)
+            if (old[i].recorded)
+                *%(prefix)s_replay_pointer_find(old[i].recorded) = old[i];
+        free(old);
+    }
+
+    e = %(prefix)s_replay_pointer_find(recorded);
+    if (!e->recorded)
+        %(prefix)s_replay_pointers_used++;
+    e->recorded = recorded;
+    e->live = live;
+    e->size = size;
+}
+
+static void *%(prefix)s_replay_pointer(uint64_t recorded, uint64_t size, int string)
+{
+    struct %(prefix)s_replay_pointer_entry *e;
+    void *live;
+
+    if (!recorded)
+        return NULL;
+    if (%(prefix)s_replay_pointers_size) {
+        e = %(prefix)s_replay_pointer_find(recorded);
+        if (e->recorded && e->size >= size)
+            return e->live;
+    }
+
+    if (!size)
+        size = %(prefix)s_REPLAY_SCRATCH_SIZE;
+    live = calloc(1, size); /* never freed, the library may keep it */
+    if (!live) {
+        fputs("ERROR: out of memory.\\n", stderr);
+        exit(1);
+    }
+    if (string)
+        memset(live, 'x', size - 1);
+    %(prefix)s_replay_pointer_set(recorded, live, size);
+    return live;
+}
+
+static struct %(prefix)s_replay_thread *%(prefix)s_replay_thread_get(uint64_t thread)
+{
+    unsigned int i;
+    for (i = 0; i < %(prefix)s_replay_n_threads; i++)
+        if (%(prefix)s_replay_threads[i].thread == thread)
+            return %(prefix)s_replay_threads + i;
+    if (i == %(prefix)s_REPLAY_MAX_THREADS)
+        return NULL;
+    %(prefix)s_replay_n_threads++;
+    %(prefix)s_replay_threads[i].thread = thread;
+    return %(prefix)s_replay_threads + i;
+}
+
+/* returns the value returned by the library, *elapsed is set to the time
+ * taken by the call or to UINT64_MAX if the function can't be replayed.
+ */
+static uint64_t %(prefix)s_replay_call(unsigned int id, const struct %(prefix)s_record *r, const uint64_t *sizes, uint64_t *elapsed)
+{
+    uint64_t ret = 0, t0;
+
+    switch (id) {
+""" % repl)
+
+    skipped = []
+    for func in funcs:
+        if not generate_call(f, func, ctxt):
+            skipped.append(func.name)
+    for name in skipped:
+        f.write("    case %d: /* %s() uses aggregates by value */\n" %
+                (ctxt["function_ids"][name], name))
+    f.write("""\
+    default:
+        *elapsed = UINT64_MAX;
+        return 0;
+    }
+    *elapsed = %(prefix)s_replay_now() - t0;
+    (void)r;
+    (void)sizes;
+    return ret;
+}
+
+static int %(prefix)s_replay_compare(const void *a, const void *b)
+{
+    const struct %(prefix)s_record *ra = *(const struct %(prefix)s_record **)a;
+    const struct %(prefix)s_record *rb = *(const struct %(prefix)s_record **)b;
+    if (ra->timestamp < rb->timestamp)
+        return -1;
+    return ra->timestamp > rb->timestamp;
+}
+
+int main(int argc, char *argv[])
+{
+    FILE *fp;
+    char magic[4];
+    uint32_t hdr[4];
+    int *ids;
+    char *data = NULL;
+    size_t record_size, n_records = 0, allocated = 0, i;
+    const struct %(prefix)s_record **records;
+    uint64_t dropped = 0, skipped = 0, unknown = 0, total = 0;
+    unsigned int repetitions = 1, rep;
+
+    if (argc < 2) {
+        fprintf(stderr, "usage: %%s <trace> [repetitions]\\n", argv[0]);
+        return 2;
+    }
+    if (argc > 2)
+        repetitions = atoi(argv[2]);
+
+    fp = fopen(argv[1], "rb");
+    if (!fp) {
+        perror(argv[1]);
+        return 1;
+    }
+    if (fread(magic, 1, 4, fp) != 4 || fread(hdr, 4, 4, fp) != 4 ||
+        memcmp(magic, %(prefix)s_BINARY_MAGIC, 4) != 0 ||
+        hdr[0] != %(prefix)s_BINARY_VERSION) {
+        fprintf(stderr, "ERROR: %%s is not a recorded trace.\\n", argv[1]);
+        return 1;
+    }
+    record_size = hdr[1];
+    if (record_size != sizeof(struct %(prefix)s_record) + hdr[2] * sizeof(uint64_t) ||
+        hdr[2] > %(prefix)s_LOG_BINARY_MAX_ARGS) {
+        fprintf(stderr, "ERROR: unexpected record size %%zu.\\n", record_size);
+        return 1;
+    }
+
+    /* trace function ids to ours, by name */
+    ids = malloc(hdr[3] * sizeof(int));
+    for (i = 0; i < hdr[3]; i++) {
+        char name[%(prefix)s_FUNCTION_NAME_SIZE * 2];
+        size_t len = 0;
+        int c, j;
+        while ((c = fgetc(fp)) > 0)
+            if (len < sizeof(name) - 1)
+                name[len++] = c;
+        name[len] = '\\0';
+        ids[i] = -1;
+        for (j = 0; j < %(prefix)s_N_FUNCTIONS; j++)
+            if (strcmp(name, %(prefix)s_function_names[j]) == 0)
+                ids[i] = j;
+    }
+
+    for (;;) {
+        if (n_records == allocated) {
+            allocated = allocated ? allocated * 2 : 4096;
+            data = realloc(data, allocated * record_size);
+            if (!data) {
+                fputs("ERROR: out of memory.\\n", stderr);
+                return 1;
+            }
+        }
+        if (fread(data + n_records * record_size, record_size, 1, fp) != 1)
+            break;
+        n_records++;
+    }
+    fclose(fp);
+
+    /* per thread buffers are flushed one after the other */
+    records = malloc(n_records * sizeof(*records));
+    for (i = 0; i < n_records; i++)
+        records[i] = (const struct %(prefix)s_record *)(data + i * record_size);
+    qsort(records, n_records, sizeof(*records), %(prefix)s_replay_compare);
+
+    for (rep = 0; rep < repetitions; rep++) {
+        for (i = 0; i < n_records; i++) {
+            const struct %(prefix)s_record *r = records[i];
+            struct %(prefix)s_replay_thread *t;
+            uint64_t live, elapsed;
+            int id;
+
+            if (r->type == %(prefix)s_BINARY_DROPPED) {
+                dropped += r->ret;
+                continue;
+            }
+            id = r->function < hdr[3] ? ids[r->function] : -1;
+            t = %(prefix)s_replay_thread_get(r->thread);
+            if (id < 0 || !t) {
+                unknown++;
+                continue;
+            }
+
+            switch (r->type) {
+            case %(prefix)s_BINARY_SIZES:
+                t->sizes = r->args;
+                break;
+            case %(prefix)s_BINARY_ENTER:
+                live = %(prefix)s_replay_call(id, r, t->sizes ? t->sizes :
+                                              %(prefix)s_replay_no_sizes,
+                                              &elapsed);
+                t->sizes = NULL;
+                if (elapsed == UINT64_MAX) {
+                    skipped++;
+                } else {
+                    %(prefix)s_replay_stats[id].calls++;
+                    %(prefix)s_replay_stats[id].total += elapsed;
+                    if (!%(prefix)s_replay_stats[id].min ||
+                        elapsed < %(prefix)s_replay_stats[id].min)
+                        %(prefix)s_replay_stats[id].min = elapsed;
+                    if (elapsed > %(prefix)s_replay_stats[id].max)
+                        %(prefix)s_replay_stats[id].max = elapsed;
+                    total += elapsed;
+                }
+                if (t->depth < %(prefix)s_REPLAY_MAX_DEPTH)
+                    t->live[t->depth] = live;
+                t->depth++;
+                break;
+            case %(prefix)s_BINARY_EXIT:
+                if (!t->depth)
+                    break;
+                t->depth--;
+                if (t->depth < %(prefix)s_REPLAY_MAX_DEPTH && r->ret &&
+                    t->live[t->depth] &&
+                    %(prefix)s_replay_returns_pointer[id])
+                    %(prefix)s_replay_pointer_set(
+                        r->ret, (void *)(uintptr_t)t->live[t->depth],
+                        %(prefix)s_REPLAY_LIBRARY_POINTER);
+                break;
+            }
+        }
+    }
+
+    printf("%%-*s %%10s %%12s %%10s %%10s %%10s\\n",
+           %(prefix)s_FUNCTION_NAME_SIZE, "function", "calls", "total(ns)",
+           "mean(ns)", "min(ns)", "max(ns)");
+    for (i = 0; i < %(prefix)s_N_FUNCTIONS; i++) {
+        if (!%(prefix)s_replay_stats[i].calls)
+            continue;
+        printf("%%-*s %%10llu %%12llu %%10llu %%10llu %%10llu\\n",
+               %(prefix)s_FUNCTION_NAME_SIZE, %(prefix)s_function_names[i],
+               (unsigned long long)%(prefix)s_replay_stats[i].calls,
+               (unsigned long long)%(prefix)s_replay_stats[i].total,
+               (unsigned long long)(%(prefix)s_replay_stats[i].total /
+                                    %(prefix)s_replay_stats[i].calls),
+               (unsigned long long)%(prefix)s_replay_stats[i].min,
+               (unsigned long long)%(prefix)s_replay_stats[i].max);
+    }
+    printf("\\n%%llu ns in library calls, %%u repetitions\\n",
+           (unsigned long long)total, repetitions);
+    if (skipped || unknown || dropped)
+        printf("%%llu calls skipped, %%llu unknown records, "
+               "%%llu records dropped while recording\\n",
+               (unsigned long long)skipped, (unsigned long long)unknown,
+               (unsigned long long)dropped);
+
+    free(records);
+    free(data);
+    free(ids);
+    return 0;
+}
+""" % repl)
+    f.close()
+    return skipped
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options] <header.h> <libname.so> <outfile.c>"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-c", "--config", action="store", default=None,
+                      help="Configuration file given to liblogger.py")
+    parser.add_option("-p", "--prefix", action="store", default=None,
+                      help="Prefix given to liblogger.py")
+    parser.add_option("-C", "--cache-dir", action="store", default=None,
+                      help="Reuse parsed headers from this cache directory")
+
+    options, args = parser.parse_args()
+    try:
+        header, libname, outfile = args
+    except ValueError, e:
+        raise SystemExit("Missing parameters, see --help")
+
+    job = {"header": header, "libname": libname, "prefix": options.prefix}
+    cfg = liblogger.load_config(options.config)
+    if options.cache_dir:
+        cache = liblogger.ParseCache(options.cache_dir)
+        header_contents, types = cache.header_tree(header, cfg)
+    else:
+        types = liblogger.TypeRegistry()
+        header_contents = liblogger.header_tree(header, cfg, types)
+    ctxt = liblogger.make_context(job, header_contents, types, cfg)
+
+    for name in generate_driver(outfile, ctxt):
+        print "Ignored: %s() passes aggregates by value, not replayed" % \
+              (name,)
@@ -0,0 +1,229 @@
+#!/usr/bin/python2
+
+"""
+Live view of the counters exposed by wrappers built with
+<prefix>_LOG_COUNTERS.
+
+The traced process keeps per function counters in a POSIX shared memory
+segment (/dev/shm/<prefix>.<pid> by default), this tool maps it read
+only and periodically shows calls, calls per second, calls in flight,
+return checker failures and time spent, sorted like top(1). The traced
+process does no I/O for that, it only updates counters.
+"""
+
+import sys
+import os
+import optparse
+import mmap
+import struct
+import time
+
+SHM_DIR = "/dev/shm"
+COUNTERS_MAGIC = "LLCNT"
+COUNTERS_VERSION = 1
+
+# must match struct <prefix>_counters_header
+counters_header = struct.Struct("=8sIIIIIIQQ")
+# counters of struct <prefix>_counters_entry, after the name
+counters_entry = struct.Struct("=QqQQ")
+
+
+class CountersError(Exception):
+    pass
+
+
+class FunctionCounters(object):
+    def __init__(self, name, calls, in_flight, failures, total):
+        self.name = name
+        self.calls = calls
+        self.in_flight = in_flight
+        self.failures = failures
+        self.total = total
+        self.rate = 0.0
+
+    def mean(self):
+        if not self.calls:
+            return 0
+        return float(self.total) / self.calls
+
+
+class Segment(object):
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if size < counters_header.size:
+                raise CountersError("%s is too small" % (path,))
+            self.map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+        (magic, self.version, self.n_functions, self.entry_size,
+         self.name_size, self.entries_offset, reserved, self.pid,
+         self.start) = counters_header.unpack_from(self.map, 0)
+        if magic.rstrip("\0") != COUNTERS_MAGIC:
+            raise CountersError("%s is not a liblogger counters segment" %
+                                (path,))
+        if self.version != COUNTERS_VERSION:
+            raise CountersError("%s: unsupported version %d" %
+                                (path, self.version))
+        end = self.entries_offset + self.n_functions * self.entry_size
+        if end > size:
+            raise CountersError("%s is truncated" % (path,))
+
+        self.names = []
+        for i in xrange(self.n_functions):
+            off = self.entries_offset + i * self.entry_size
+            name = self.map[off:off + self.name_size]
+            self.names.append(name.split("\0", 1)[0])
+
+    def read(self):
+        buf = self.map[:]
+        counters = []
+        for i, name in enumerate(self.names):
+            off = self.entries_offset + i * self.entry_size + self.name_size
+            calls, in_flight, failures, total = \
+                counters_entry.unpack_from(buf, off)
+            counters.append(FunctionCounters(name, calls, in_flight,
+                                             failures, total))
+        return counters
+
+    def alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError, e:
+            return e.errno == 1 # EPERM, exists but not ours
+        return True
+
+
+def find_segments():
+    found = []
+    try:
+        names = os.listdir(SHM_DIR)
+    except OSError, e:
+        return found
+    for name in sorted(names):
+        if name.startswith("_log_"):
+            found.append(os.path.join(SHM_DIR, name))
+    return found
+
+
+def segment_path(arg):
+    if arg.isdigit():
+        for path in find_segments():
+            if path.endswith(".%s" % (arg,)):
+                return path
+        raise CountersError("no segment for pid %s" % (arg,))
+    if os.path.exists(arg):
+        return arg
+    return os.path.join(SHM_DIR, arg.lstrip("/"))
+
+
+def fmt_time(ns):
+    if ns >= 1e9:
+        return "%.2fs" % (ns / 1e9)
+    elif ns >= 1e6:
+        return "%.2fms" % (ns / 1e6)
+    elif ns >= 1e3:
+        return "%.2fus" % (ns / 1e3)
+    return "%dns" % ns
+
+
+sort_keys = {
+    "name": (lambda c: c.name, False),
+    "calls": (lambda c: c.calls, True),
+    "rate": (lambda c: c.rate, True),
+    "inflight": (lambda c: c.in_flight, True),
+    "failures": (lambda c: c.failures, True),
+    "total": (lambda c: c.total, True),
+    "mean": (lambda c: c.mean(), True),
+    }
+
+
+def show(segment, counters, out, sort, limit, clear):
+    key, reverse = sort_keys[sort]
+    counters = sorted([c for c in counters if c.calls], key=key,
+                      reverse=reverse)
+    if limit:
+        counters = counters[:limit]
+
+    if clear:
+        out.write("\033[H\033[2J")
+    out.write("pid %d  %s  %d functions, %d called\n\n" %
+              (segment.pid, segment.path, segment.n_functions,
+               len(counters)))
+    width = max([len("function")] + [len(c.name) for c in counters])
+    fmt = "%%-%ds %%12s %%10s %%8s %%8s %%10s %%10s\n" % (width,)
+    out.write(fmt % ("function", "calls", "calls/s", "inflight", "failures",
+                     "total", "mean"))
+    for c in counters:
+        out.write(fmt % (c.name, c.calls, "%.0f" % c.rate, c.in_flight,
+                         c.failures, fmt_time(c.total), fmt_time(c.mean())))
+    out.flush()
+
+
+def top(segment, out, interval, sort, limit, once):
+    previous = None
+    last = time.time()
+    while True:
+        counters = segment.read()
+        now = time.time()
+        if previous:
+            elapsed = now - last
+            for c, p in zip(counters, previous):
+                c.rate = (c.calls - p.calls) / elapsed
+        previous = counters
+        last = now
+
+        show(segment, counters, out, sort, limit, not once)
+        if once:
+            return
+        if not segment.alive():
+            out.write("\nprocess %d exited\n" % (segment.pid,))
+            return
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options] [<pid>|<segment name>]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-i", "--interval", action="store", type="float",
+                      default=1.0,
+                      help="Seconds between refreshes")
+    parser.add_option("-s", "--sort", action="store", default="total",
+                      choices=sorted(sort_keys.keys()),
+                      help="Sort by one of: %s (default: total)" %
+                      ", ".join(sorted(sort_keys.keys())))
+    parser.add_option("-n", "--limit", action="store", type="int",
+                      default=0,
+                      help="Show only the first N functions")
+    parser.add_option("-1", "--once", action="store_true", default=False,
+                      help="Print counters once and exit")
+    parser.add_option("-l", "--list", action="store_true", default=False,
+                      help="List known segments and exit")
+
+    options, args = parser.parse_args()
+
+    if options.list or not args:
+        segments = find_segments()
+        if options.list or len(segments) != 1:
+            for path in segments:
+                print path
+            if not segments:
+                raise SystemExit("no segments found in %s" % (SHM_DIR,))
+            raise SystemExit(0)
+        args = segments
+
+    try:
+        segment = Segment(segment_path(args[0]))
+    except (OSError, EnvironmentError, CountersError), e:
+        raise SystemExit("ERROR: %s" % (e,))
+
+    try:
+        top(segment, sys.stdout, options.interval, options.sort,
+            options.limit, options.once)
+    except KeyboardInterrupt:
+        pass
+    except IOError, e:
+        pass # closed pipe
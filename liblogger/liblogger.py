@@ -5,6 +5,15 @@ import os
 import optparse
 import datetime
 import re
+import time
+import hashlib
+import gc
+import traceback
+import zlib
+import itertools
+import multiprocessing
+import StringIO
+import cPickle as pickle
 from ConfigParser import SafeConfigParser as ConfigParser
 
 """
@@ -14,6 +23,15 @@ TODO:
 """
 
 re_doublespaces = re.compile('\s\s+')
+re_token_delimiters = re.compile('([,{}()])')
+re_attribute = re.compile("""\
+__attribute__\s*[(]{2}(\
+(\s+|[a-zA-Z0-9_ ]+|[a-zA-Z0-9_ ]+[(][^)]*[)]\s*){0,1}|\
+(([a-zA-Z0-9_ ]+|[a-zA-Z0-9_ ]+[(][^)]*[)]\s*),\
+([a-zA-Z0-9_ ]+|[a-zA-Z0-9_ ]+[(][^)]*[)]\s*))+\
+)[)]{2}""")
+
+__version__ = "0.2"
 
 timestamp = datetime.datetime.now().strftime("%A, %Y-%B-%d %H:%M:%S")
 progname = os.path.basename(sys.argv[0])
@@ -24,7 +42,7 @@ def header_tokenize(header_file, cfg):
     in_comment = False
     in_macro = False
     buf = []
-    for line in f.readlines():
+    for line in f:
         line = line.strip()
         if not line:
             continue
@@ -69,17 +87,10 @@ def header_tokenize(header_file, cfg):
 
     buf = " ".join(buf)
     tokens = []
-    attribute_regexp = re.compile("""\
-__attribute__\s*[(]{2}(\
-(\s+|[a-zA-Z0-9_ ]+|[a-zA-Z0-9_ ]+[(][^)]*[)]\s*){0,1}|\
-(([a-zA-Z0-9_ ]+|[a-zA-Z0-9_ ]+[(][^)]*[)]\s*),\
-([a-zA-Z0-9_ ]+|[a-zA-Z0-9_ ]+[(][^)]*[)]\s*))+\
-)[)]{2}""")
     for line in buf.split(";"):
         line = line.strip()
         if not line:
             continue
-        last_i = 0
         line = re_doublespaces.sub(' ', line)
         if ignore_tokens:
             line = ignore_tokens.sub("", line).strip()
@@ -87,18 +98,11 @@ __attribute__\s*[(]{2}(\
                 continue
         if line.startswith("static "):
             continue
-        line = attribute_regexp.sub("", line).strip()
-        for i, c in enumerate(line):
-            if c in (",", "{", "}", "(", ")"):
-                x = line[last_i:i].strip()
-                if x:
-                    tokens.append(x)
-                tokens.append(c)
-                last_i = i + 1
-
-        x = line[last_i:].strip()
-        if x:
-            tokens.append(x)
+        line = re_attribute.sub("", line).strip()
+        for x in re_token_delimiters.split(line):
+            x = x.strip()
+            if x:
+                tokens.append(x)
 
         tokens.append(";")
 
@@ -106,27 +110,9 @@ __attribute__\s*[(]{2}(\
     return tokens
 
 
-_types = {}
-_types_order = []
-
 class Type(object):
     cls = None
-
-    def __new__(cls, *args, **kargs):
-        # each named type should be a singleton, also attribute an unique id
-        name = kargs.get("name")
-        if name is None:
-            name = args[0]
-        lst = _types.setdefault(cls.cls, [])
-        if name is not None:
-            for c in lst:
-                if c.name == name:
-                    return c
-        o = object.__new__(cls)
-        o.id = len(lst)
-        lst.append(o)
-        _types_order.append(o)
-        return o
+    singleton = True # named types are unique per TypeRegistry
 
     def __init__(self, name, container=None):
         self.name = name
@@ -171,42 +157,6 @@ class Type(object):
             name = " " + name
         return "%s%s%s" % (prefix, self.cls, name)
 
-    @classmethod
-    def exists(cls, name):
-        return bool(cls.find(name))
-
-    @classmethod
-    def find(cls, name):
-        try:
-            lst = _types[cls.cls]
-        except KeyError:
-            return None
-        for c in lst:
-            if c.name == name:
-                return c
-        return None
-
-    @staticmethod
-    def get_by_name(name):
-        user_cls = {"enum": Enum, "struct": Struct, "union": Union}
-        for uc, cls in user_cls.iteritems():
-            if name.startswith(uc + " "):
-                n = name[len(uc) + 1:]
-                for t in _types.get(uc, ()):
-                    if t.name == n:
-                        return t
-                t = cls(n)
-                _types.setdefault(uc, []).append(t)
-                return t
-
-        for t in _types.get("builtin", ()):
-            if t.name == name:
-                return t
-        t = BuiltinType(name)
-        _types.setdefault("builtin", []).append(t)
-        return t
-
-
 class BuiltinType(Type):
     cls = "builtin"
     def __init__(self, name, container=None):
@@ -222,35 +172,6 @@ class BuiltinType(Type):
         return prefix + name
 
 
-for bi in ("char", "int",
-           "short", "short int",
-           "long", "long int",
-           "long long", "long long int"):
-    BuiltinType(bi)
-    BuiltinType("unsigned " + bi)
-    BuiltinType("signed " + bi)
-    BuiltinType("const " + bi)
-    BuiltinType("const " + "unsigned " + bi)
-    BuiltinType("const " + "signed " + bi)
-
-for bi in ("float", "double", "void"):
-    BuiltinType(bi)
-    BuiltinType("const " + bi)
-
-BuiltinType("long double")
-BuiltinType("const long double")
-
-for bi in (8, 16, 32, 64):
-    BuiltinType("int%d_t" % bi)
-    BuiltinType("uint%d_t" % bi)
-    BuiltinType("const int%d_t" % bi)
-    BuiltinType("const uint%d_t" % bi)
-
-for bi in ("bool", "_Bool", "Bool"):
-    BuiltinType(bi)
-    BuiltinType("const " + bi)
-
-
 class Enum(Type):
     cls = "enum"
     def __init__(self, name, container=None, members=None):
@@ -327,6 +248,7 @@ class Union(Group): cls = "union"
 
 class FunctionPointer(Type):
     cls = "function-pointer"
+    singleton = False
     def __init__(self, ret_type, parameters, ret_pointer=0, container=None):
         name = "%s%s (*)(%s)" % (ret_type, " *" * ret_pointer, ", ".join(
             x.type_formatter() for x in parameters))
@@ -370,6 +292,7 @@ class FunctionPointer(Type):
 
 class FunctionName(Type):
     cls = "function-name"
+    singleton = False
     def __init__(self, ret_type, name, parameters, ret_pointer=0,
                  container=None):
         Type.__init__(self, name, container)
@@ -440,6 +363,93 @@ class Typedef(Type):
         return self.reference.variable_formatter("", self.pointer)
 
 
+class TypeRegistry(object):
+    """Types known to a single parse.
+
+    Named types are singletons: creating a type with an already
+    registered name returns the existing instance (re-initialized, like
+    calling the class again would do). Lookups are dictionary based and
+    each parse should use its own registry so they don't see each
+    other's types.
+    """
+    def __init__(self):
+        self.types = {} # cls -> {name: type}
+        self.counts = {} # cls -> number of created types, used as id
+        self.order = [] # creation order, used to emit types file
+
+        for bi in ("char", "int",
+                   "short", "short int",
+                   "long", "long int",
+                   "long long", "long long int"):
+            self.new(BuiltinType, bi)
+            self.new(BuiltinType, "unsigned " + bi)
+            self.new(BuiltinType, "signed " + bi)
+            self.new(BuiltinType, "const " + bi)
+            self.new(BuiltinType, "const " + "unsigned " + bi)
+            self.new(BuiltinType, "const " + "signed " + bi)
+
+        for bi in ("float", "double", "void"):
+            self.new(BuiltinType, bi)
+            self.new(BuiltinType, "const " + bi)
+
+        self.new(BuiltinType, "long double")
+        self.new(BuiltinType, "const long double")
+
+        for bi in (8, 16, 32, 64):
+            self.new(BuiltinType, "int%d_t" % bi)
+            self.new(BuiltinType, "uint%d_t" % bi)
+            self.new(BuiltinType, "const int%d_t" % bi)
+            self.new(BuiltinType, "const uint%d_t" % bi)
+
+        for bi in ("bool", "_Bool", "Bool"):
+            self.new(BuiltinType, bi)
+            self.new(BuiltinType, "const " + bi)
+
+    def new(self, cls, *args, **kargs):
+        name = None
+        if cls.singleton:
+            name = kargs.get("name")
+            if name is None:
+                name = args[0]
+        named = self.types.setdefault(cls.cls, {})
+        o = None
+        if name is not None:
+            o = named.get(name)
+        if o is None:
+            o = object.__new__(cls)
+            o.id = self.counts.get(cls.cls, 0)
+            self.counts[cls.cls] = o.id + 1
+            if name is not None:
+                named[name] = o
+            self.order.append(o)
+        o.__init__(*args, **kargs)
+        return o
+
+    def find(self, cls, name):
+        try:
+            return self.types[cls.cls].get(name)
+        except KeyError:
+            return None
+
+    def exists(self, cls, name):
+        return bool(self.find(cls, name))
+
+    def get_by_name(self, name):
+        user_cls = {"enum": Enum, "struct": Struct, "union": Union}
+        for uc, cls in user_cls.iteritems():
+            if name.startswith(uc + " "):
+                n = name[len(uc) + 1:]
+                t = self.find(cls, n)
+                if t is None:
+                    t = self.new(cls, n)
+                return t
+
+        t = self.find(BuiltinType, name)
+        if t is None:
+            t = self.new(BuiltinType, name)
+        return t
+
+
 class Variable(object):
     def __init__(self, type, name, pointer=0):
         self.type = type
@@ -513,31 +523,31 @@ class Node(object):
             return "%s%s%s" % (self.enclosure[0], s, self.enclosure[1])
 
 
-def build_function_params(param_nodes, data):
+def build_function_params(param_nodes, data, types):
     params = []
     for p in param_nodes:
         for v in p.children:
-            for c in process_single(v, data, True):
+            for c in process_single(v, data, types, True):
                 if isinstance(c, Variable):
                     params.append(c)
     return params
 
 cls_mapper = {"enum": Enum, "struct": Struct, "union": Union}
-def process_single(n, data, allow_unamed_variables=False):
+def process_single(n, data, types, allow_unamed_variables=False):
     processed = []
     parts = n.children[0].split(" ")
     t = None
     if parts[0] == "typedef":
         tmp = Node([" ".join(parts[1:])] + n.children[1:], parent=n)
         var = None
-        for v in process_single(tmp, data):
+        for v in process_single(tmp, data, types):
             if isinstance(v, Variable):
                 if var is not None:
                     raise ValueError("typedef with more than one declaration?")
                 var = v
         if var is None:
             raise ValueError("typedef without type name?")
-        t = Typedef(var.name, var.type, var.pointer)
+        t = types.new(Typedef, var.name, var.type, var.pointer)
         processed.append(t)
         data[parts[0]][t.name] = t
 
@@ -565,7 +575,7 @@ def process_single(n, data, allow_unamed_variables=False):
                 t = None
 
             if not t:
-                t = cls_mapper[parts[0]](name)
+                t = types.new(cls_mapper[parts[0]], name)
                 if name:
                     data[parts[0]][name] = t
                 processed.append(t)
@@ -589,7 +599,7 @@ def process_single(n, data, allow_unamed_variables=False):
                                     enum_value = exp
                         t.add_member(enum_name, enum_value)
                 else:
-                    for c in process(m, data):
+                    for c in process(m, data, types):
                         c.container = t
                         if isinstance(c, Variable):
                             t.add_member(c)
@@ -600,7 +610,8 @@ def process_single(n, data, allow_unamed_variables=False):
             else:
                 t = data[parts[0]].get(name)
                 if not t:
-                    data[parts[0]][name] = t = cls_mapper[parts[0]](name)
+                    t = types.new(cls_mapper[parts[0]], name)
+                    data[parts[0]][name] = t
                     processed.append(t)
 
         if varname:
@@ -635,9 +646,9 @@ def process_single(n, data, allow_unamed_variables=False):
             ret_type = re_doublespaces.sub(" ",
                                            ret_type.replace("*", " ")).strip()
         name = n.children[-2].children[0].children[0].children[0][1:].strip()
-        params = build_function_params(n.children[-1].children, data)
-        ret_type = Type.get_by_name(ret_type)
-        t = FunctionPointer(ret_type, params, ret_pointer)
+        params = build_function_params(n.children[-1].children, data, types)
+        ret_type = types.get_by_name(ret_type)
+        t = types.new(FunctionPointer, ret_type, params, ret_pointer)
         for p in params:
             p.container = t
 
@@ -664,9 +675,9 @@ def process_single(n, data, allow_unamed_variables=False):
                                            ret_type.replace("*", " ")).strip()
 
         name = x[-1]
-        params = build_function_params(n.children[-1].children, data)
-        ret_type = Type.get_by_name(ret_type)
-        t = FunctionName(ret_type, name, params, ret_pointer)
+        params = build_function_params(n.children[-1].children, data, types)
+        ret_type = types.get_by_name(ret_type)
+        t = types.new(FunctionName, ret_type, name, params, ret_pointer)
         for p in params:
             p.container = t
         processed.append(t)
@@ -685,20 +696,21 @@ def process_single(n, data, allow_unamed_variables=False):
             pointer = 0
 
         name = parts.pop(-1)
-        if BuiltinType.exists(name) or Typedef.exists(name):
+        if types.exists(BuiltinType, name) or \
+           types.exists(Typedef, name):
             if allow_unamed_variables:
                 parts.append(name)
                 name = None
             else:
                 raise ValueError("name is a known type: %s" % name)
 
-        t = BuiltinType(" ".join(parts))
+        t = types.new(BuiltinType, " ".join(parts))
         processed.append(Variable(t, name, pointer))
     return processed
 
 
-def process(node, data):
-    processed = process_single(node.children[0], data)
+def process(node, data, types):
+    processed = process_single(node.children[0], data, types)
     if len(node.children) == 1:
         return processed
 
@@ -721,12 +733,16 @@ def process(node, data):
     return processed
 
 
-def header_tree(header_file, cfg=None):
-    tokens = header_tokenize(header_file, cfg)
+def header_statements(tokens):
+    """Build the tree of top-level statements from header_tokenize() output.
+
+    Tokens are consumed with a cursor, so each token is visited once and
+    the whole list is never copied.
+    """
+    n_tokens = len(tokens)
     closing = {"(":")", "{":"}"}
 
-    def make_tree(tokens, delim=None):
-        tokens = list(tokens)
+    def make_tree(pos, delim=None):
         nodes = Node([])
         current = Node([], parent=nodes)
         nodes.children.append(current)
@@ -737,8 +753,9 @@ def header_tree(header_file, cfg=None):
             delims = (";",)
 
         t = None
-        while tokens:
-            t = tokens.pop(0)
+        while pos < n_tokens:
+            t = tokens[pos]
+            pos += 1
             if t == ",":
                 current = Node([], parent=nodes)
                 nodes.children.append(current)
@@ -749,43 +766,144 @@ def header_tree(header_file, cfg=None):
                 end = None
                 sub = Node([], enclosure=enclosure, parent=current)
                 current.children.append(sub)
-                while tokens and end != enclosure[1]:
-                    x, end, tokens = make_tree(tokens, enclosure[1])
+                while pos < n_tokens and end != enclosure[1]:
+                    x, end, pos = make_tree(pos, enclosure[1])
                     if x.children and x.children[0].children:
                         x.parent = sub
                         sub.children.append(x)
             else:
                 current.children.append(t)
 
-        return (nodes, t, tokens)
+        return (nodes, t, pos)
+
+    pos = 0
+    while pos < n_tokens:
+        n, ignored, pos = make_tree(pos)
+        yield n
 
 
+def header_tree(header_file, cfg=None, types=None):
+    if types is None:
+        types = TypeRegistry()
+    tokens = header_tokenize(header_file, cfg)
+
     data = {"enum": {}, "struct": {}, "union": {}, "typedef": {},
             "function": {}, "global": {}}
 
-    while tokens:
-        n, ignored, tokens = make_tree(tokens)
-        if n:
-            process(n, data)
+    for n in header_statements(tokens):
+        process(n, data, types)
 
     return data
 
 
+class ParseCache(object):
+    """On-disk cache of header_tree() results.
+
+    Entries are keyed by the header contents, the global/headers and
+    global/ignore-tokens-regexp configuration values and the tool
+    version, so a hit skips tokenizing and parsing entirely.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.load_time = 0.0
+        self.parse_time = 0.0
+
+    def key(self, header_file, cfg):
+        h = hashlib.sha1()
+        h.update(__version__)
+        h.update(__name__) # pickled classes refer to their module
+        f = open(header_file, "rb")
+        h.update(hashlib.sha1(f.read()).hexdigest())
+        f.close()
+        for k in ("headers", "ignore-tokens-regexp"):
+            v = ""
+            if cfg:
+                try:
+                    v = cfg.get("global", k, raw=True)
+                except Exception, e:
+                    pass
+            h.update(hashlib.sha1(v).hexdigest())
+        return h.hexdigest()
+
+    def header_tree(self, header_file, cfg=None):
+        """Same as header_tree(), but returns (header_contents, types)."""
+        filename = os.path.join(self.directory,
+                                self.key(header_file, cfg) + ".pickle")
+        t0 = time.time()
+        try:
+            f = open(filename, "rb")
+        except IOError, e:
+            f = None
+        if f:
+            # the model is a big graph of small objects, collecting
+            # while it's built just wastes time
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                try:
+                    data, types = pickle.load(f)
+                    self.hits += 1
+                    self.load_time += time.time() - t0
+                    return data, types
+                except Exception, e:
+                    print "Ignoring broken cache entry %s: %s" % (filename, e)
+                    self.errors += 1
+            finally:
+                f.close()
+                if gc_enabled:
+                    gc.enable()
+
+        self.misses += 1
+        t0 = time.time()
+        types = TypeRegistry()
+        data = header_tree(header_file, cfg, types)
+        self.parse_time += time.time() - t0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmpname = "%s.%d.tmp" % (filename, os.getpid())
+        f = open(tmpname, "wb")
+        pickle.dump((data, types), f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmpname, filename)
+        return data, types
+
+    def stats(self):
+        return ("parse cache %s: %d hits (%.3fs loading), "
+                "%d misses (%.3fs parsing), %d errors") % \
+                (self.directory, self.hits, self.load_time,
+                 self.misses, self.parse_time, self.errors)
+
+
 def generate_preamble(f, ctxt):
+    libraries = ctxt.get("libraries") or [ctxt]
     repl = {
-        "header": ctxt["header"],
+        "header": ", ".join(lib["header"] for lib in libraries),
         "header_name": os.path.splitext(os.path.basename(ctxt["header"]))[0],
         "prefix": ctxt["prefix"],
         "libname": ctxt["libname"],
         "progname": progname,
         "timestamp": timestamp,
+        "function_table": generate_function_table(ctxt),
+        "limits_runtime": generate_limits_runtime(ctxt),
+        "dl_runtime": generate_dl_runtime(ctxt),
         }
+    if ctxt.get("shards", 1) > 1:
+        # no timestamp, regenerating must not touch unchanged files
+        repl["timestamp"] = "runtime shared by %d shards" % (ctxt["shards"],)
 
     f.write("""\
 /* this file was auto-generated from %(header)s by %(progname)s.
  * %(timestamp)s
  */
 
+#if defined(%(prefix)s_LOG_BUFFERED) && !defined(_GNU_SOURCE)
+#define _GNU_SOURCE 1 /* fopencookie() */
+#endif
+
 """ % repl)
 
     cfg = ctxt["cfg"]
@@ -800,7 +918,8 @@ def generate_preamble(f, ctxt):
                 f.write("#include <%s>\n" % h.strip())
 
     if not headers:
-        f.write("#include <%(header)s>\n" % ctxt)
+        for lib in libraries:
+            f.write("#include <%(header)s>\n" % lib)
 
     f.write("""
 #include <stdio.h>
@@ -824,11 +943,48 @@ def generate_preamble(f, ctxt):
 #define %(prefix)s_COLOR_CLEAR \"\"
 #endif
 
+#ifdef %(prefix)s_SHARDED
+/* Wrappers are split in several files (see liblogger.py --shards),
+ * all of them include this runtime. Weak symbols keep a single copy of
+ * its state and only the file defining %(prefix)s_RUNTIME registers
+ * constructors and destructors.
+ */
+#define %(prefix)s_SHARED __attribute__((weak, visibility(\"hidden\")))
+#ifdef %(prefix)s_RUNTIME
+#define %(prefix)s_CONSTRUCTOR __attribute__((constructor))
+#define %(prefix)s_DESTRUCTOR __attribute__((destructor))
+#else
+#define %(prefix)s_CONSTRUCTOR __attribute__((unused))
+#define %(prefix)s_DESTRUCTOR __attribute__((unused))
+#endif
+#else
+#define %(prefix)s_SHARED static
+#define %(prefix)s_CONSTRUCTOR __attribute__((constructor))
+#define %(prefix)s_DESTRUCTOR __attribute__((destructor))
+#endif
+
+%(function_table)s
+#if defined(%(prefix)s_LOG_RECORD) && !defined(%(prefix)s_LOG_BINARY)
+#define %(prefix)s_LOG_BINARY 1 /* recordings are binary traces */
+#endif
+
+#if defined(%(prefix)s_LOG_BINARY) && !defined(%(prefix)s_HAVE_THREADS)
+#define %(prefix)s_HAVE_THREADS 1 /* binary traces are flushed by a thread */
+#endif
+
+#if defined(%(prefix)s_LOG_BUFFERED) && !defined(%(prefix)s_HAVE_THREADS)
+#define %(prefix)s_HAVE_THREADS 1 /* sinks are per thread */
+#endif
+
+#if defined(%(prefix)s_LOG_CONTROL) && !defined(%(prefix)s_HAVE_THREADS)
+#define %(prefix)s_HAVE_THREADS 1 /* control FIFO is read by a thread */
+#endif
+
 #ifdef %(prefix)s_HAVE_THREADS
 #include <pthread.h>
-static pthread_mutex_t %(prefix)s_th_mutex = PTHREAD_MUTEX_INITIALIZER;
-static pthread_t %(prefix)s_th_main = 0;
-static unsigned char %(prefix)s_th_initted = 0;
+%(prefix)s_SHARED pthread_mutex_t %(prefix)s_th_mutex = PTHREAD_MUTEX_INITIALIZER;
+%(prefix)s_SHARED pthread_t %(prefix)s_th_main = 0;
+%(prefix)s_SHARED unsigned char %(prefix)s_th_initted = 0;
 #define %(prefix)s_THREADS_INIT \\
     do { \\
         pthread_mutex_lock(&%(prefix)s_th_mutex); \\
@@ -852,10 +1008,195 @@ static unsigned char %(prefix)s_th_initted = 0;
 #define %(prefix)s_THREAD_LOCAL
 #endif
 
+#ifdef %(prefix)s_LOG_CALL_TREE
+/* wrapped calls in progress in this thread, see %(prefix)s_tree_push() */
+%(prefix)s_SHARED %(prefix)s_THREAD_LOCAL unsigned int %(prefix)s_tree_depth = 0;
+#endif
+
+#ifdef %(prefix)s_LOG_BUFFERED
+/* Each thread formats into its own FILE, backed by a buffer of
+ * %(prefix)s_LOG_BUFFER_SIZE bytes. Buffers are written with a single
+ * write(2), or copied to the mmap-ed log file, when full or at the end
+ * of each line, so lines from different threads don't mix and no lock
+ * is taken to log.
+ */
+#include <stdint.h>
+#include <unistd.h>
+#include <fcntl.h>
+
+#ifndef %(prefix)s_LOG_BUFFER_SIZE
+#define %(prefix)s_LOG_BUFFER_SIZE 65536
+#endif
+
+#if defined(%(prefix)s_LOG_MMAP) && defined(%(prefix)s_LOGFILE)
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+/* bytes mapped after the existing file contents */
+#ifndef %(prefix)s_LOG_MMAP_SIZE
+#define %(prefix)s_LOG_MMAP_SIZE (256 * 1024 * 1024)
+#endif
+
+%(prefix)s_SHARED char *%(prefix)s_log_mmap = NULL;
+%(prefix)s_SHARED uint64_t %(prefix)s_log_mmap_end = 0;
+%(prefix)s_SHARED uint64_t %(prefix)s_log_mmap_used = 0;
+#endif
+
+%(prefix)s_SHARED pthread_once_t %(prefix)s_log_sink_once = PTHREAD_ONCE_INIT;
+%(prefix)s_SHARED pthread_key_t %(prefix)s_log_sink_key;
+%(prefix)s_SHARED int %(prefix)s_log_sink_fd = 2;
+%(prefix)s_SHARED %(prefix)s_THREAD_LOCAL FILE *%(prefix)s_log_fp = NULL;
+#define %(prefix)s_LOG_PREPARE \\
+    do { if (!%(prefix)s_log_fp) %(prefix)s_log_sink_open(); } while (0)
+#define %(prefix)s_LOG_LOCK do{}while(0)
+#define %(prefix)s_LOG_UNLOCK do{}while(0)
+
+static ssize_t %(prefix)s_log_sink_write(void *cookie, const char *buf, size_t len)
+{
+    size_t done = 0;
+
+#if defined(%(prefix)s_LOG_MMAP) && defined(%(prefix)s_LOGFILE)
+    if (%(prefix)s_log_mmap) {
+        uint64_t off = __atomic_fetch_add(&%(prefix)s_log_mmap_used, len,
+                                          __ATOMIC_RELAXED);
+        if (off + len <= %(prefix)s_log_mmap_end) {
+            memcpy(%(prefix)s_log_mmap + off, buf, len);
+            return len;
+        }
+        /* mapping is full, the file grows with pwrite() */
+        while (done < len) {
+            ssize_t r = pwrite(%(prefix)s_log_sink_fd, buf + done, len - done,
+                               off + done);
+            if (r < 0) {
+                if (errno == EINTR)
+                    continue;
+                return -1;
+            }
+            done += r;
+        }
+        return len;
+    }
+#endif
+
+    while (done < len) {
+        ssize_t r = write(%(prefix)s_log_sink_fd, buf + done, len - done);
+        if (r < 0) {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        }
+        done += r;
+    }
+    (void)cookie;
+    return len;
+}
+
+static void %(prefix)s_log_sink_close(void *data)
+{
+    /* thread exit, nothing is pending as lines are flushed */
+    %(prefix)s_log_fp = NULL;
+    fclose(data);
+}
+
+#if defined(%(prefix)s_LOG_MMAP) && defined(%(prefix)s_LOGFILE)
+%(prefix)s_DESTRUCTOR
+static void %(prefix)s_log_mmap_shutdown(void)
+{
+    uint64_t used;
+
+    if (!%(prefix)s_log_mmap)
+        return;
+    used = __atomic_load_n(&%(prefix)s_log_mmap_used, __ATOMIC_RELAXED);
+    msync(%(prefix)s_log_mmap, %(prefix)s_log_mmap_end, MS_ASYNC);
+    /* drop the unused mapped tail */
+    if (used < %(prefix)s_log_mmap_end &&
+        ftruncate(%(prefix)s_log_sink_fd, used) != 0)
+        fprintf(stderr,
+                %(prefix)s_COLOR_ERROR
+                \"ERROR: could not truncate logfile %%s: %%s.\\n\"
+                %(prefix)s_COLOR_CLEAR,
+                %(prefix)s_LOGFILE, strerror(errno));
+}
+
+static void %(prefix)s_log_mmap_prepare(void)
+{
+    struct stat st;
+    uint64_t end;
+    void *p;
+
+    if (fstat(%(prefix)s_log_sink_fd, &st) != 0)
+        return;
+    end = st.st_size + %(prefix)s_LOG_MMAP_SIZE;
+    if (ftruncate(%(prefix)s_log_sink_fd, end) != 0)
+        return;
+    p = mmap(NULL, end, PROT_WRITE, MAP_SHARED, %(prefix)s_log_sink_fd, 0);
+    if (p == MAP_FAILED) {
+        fprintf(stderr,
+                %(prefix)s_COLOR_ERROR
+                \"ERROR: could not mmap logfile %%s: %%s.\"
+                \" Using write()!\\n\"
+                %(prefix)s_COLOR_CLEAR,
+                %(prefix)s_LOGFILE, strerror(errno));
+        /* give back the space reserved for the mapping */
+        if (ftruncate(%(prefix)s_log_sink_fd, st.st_size) != 0)
+            errno = 0;
+        return;
+    }
+    %(prefix)s_log_mmap_used = st.st_size;
+    %(prefix)s_log_mmap_end = end;
+    %(prefix)s_log_mmap = p;
+}
+#endif
+
+static void %(prefix)s_log_sink_init(void)
+{
+    pthread_key_create(&%(prefix)s_log_sink_key, %(prefix)s_log_sink_close);
+
 #ifdef %(prefix)s_LOGFILE
-static FILE *%(prefix)s_log_fp = NULL;
+#ifdef %(prefix)s_LOG_MMAP
+    %(prefix)s_log_sink_fd = open(%(prefix)s_LOGFILE, O_RDWR | O_CREAT, 0644);
+#else
+    %(prefix)s_log_sink_fd = open(%(prefix)s_LOGFILE,
+                                  O_WRONLY | O_CREAT | O_APPEND, 0644);
+#endif
+    if (%(prefix)s_log_sink_fd < 0) {
+        fprintf(stderr,
+                %(prefix)s_COLOR_ERROR
+                \"ERROR: could not open logfile %%s: %%s.\"
+                \" Using stderr!\\n\"
+                %(prefix)s_COLOR_CLEAR,
+                %(prefix)s_LOGFILE, strerror(errno));
+        %(prefix)s_log_sink_fd = 2;
+    }
+#ifdef %(prefix)s_LOG_MMAP
+    else
+        %(prefix)s_log_mmap_prepare();
+#endif
+#endif
+}
+
+static void %(prefix)s_log_sink_open(void)
+{
+    cookie_io_functions_t io = {NULL, %(prefix)s_log_sink_write, NULL, NULL};
+    FILE *fp;
+
+    pthread_once(&%(prefix)s_log_sink_once, %(prefix)s_log_sink_init);
+
+    fp = fopencookie(NULL, \"w\", io);
+    if (!fp) {
+        %(prefix)s_log_fp = stderr;
+        return;
+    }
+    setvbuf(fp, NULL, _IOFBF, %(prefix)s_LOG_BUFFER_SIZE);
+    pthread_setspecific(%(prefix)s_log_sink_key, fp);
+    %(prefix)s_log_fp = fp;
+}
+#elif defined(%(prefix)s_LOGFILE)
+%(prefix)s_SHARED FILE *%(prefix)s_log_fp = NULL;
 #define %(prefix)s_LOG_PREPARE \\
     do { if (!%(prefix)s_log_fp) %(prefix)s_log_prepare(); } while (0)
+#define %(prefix)s_LOG_LOCK %(prefix)s_LOCK
+#define %(prefix)s_LOG_UNLOCK %(prefix)s_UNLOCK
 
 static void %(prefix)s_log_prepare(void)
 {
@@ -875,9 +1216,11 @@ static void %(prefix)s_log_prepare(void)
     %(prefix)s_UNLOCK;
 }
 #else
-static FILE *%(prefix)s_log_fp = NULL;
+%(prefix)s_SHARED FILE *%(prefix)s_log_fp = NULL;
 #define %(prefix)s_LOG_PREPARE \\
     do{ if (!%(prefix)s_log_fp) %(prefix)s_log_fp = stderr; }while(0)
+#define %(prefix)s_LOG_LOCK %(prefix)s_LOCK
+#define %(prefix)s_LOG_UNLOCK %(prefix)s_UNLOCK
 #endif
 
 #ifdef %(prefix)s_LOG_TIMESTAMP
@@ -893,8 +1236,8 @@ static FILE *%(prefix)s_log_fp = NULL;
         struct timespec spec = {0, 0}; \\
         clock_gettime(%(prefix)s_LOG_TIMESTAMP_CLOCK_SOURCE, &spec); \\
         fprintf(%(prefix)s_log_fp, \"[%%5lu.%%06lu] \", \\
-                (unsigned long)tv.tv_sec, \\
-                (unsigned long)tv.tv_usec / 1000); \\
+                (unsigned long)spec.tv_sec, \\
+                (unsigned long)spec.tv_nsec / 1000); \\
     } while (0)
 
 #else /* fallback to gettimeofday() */
@@ -914,141 +1257,952 @@ static FILE *%(prefix)s_log_fp = NULL;
 #define %(prefix)s_LOG_TIMESTAMP_SHOW do{}while(0)
 #endif
 
-static void *%(prefix)s_dl_handle = NULL;
+#ifdef %(prefix)s_LOG_BINARY
+#include <stdint.h>
+#include <stdlib.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <time.h>
 
-static unsigned char %(prefix)s_dl_prepare(void)
-{
-    unsigned char ok;
+/* records per thread, must be a power of 2 */
+#ifndef %(prefix)s_LOG_BINARY_RING_SIZE
+#define %(prefix)s_LOG_BINARY_RING_SIZE 4096
+#endif
 
-    %(prefix)s_THREADS_INIT;
+#ifndef %(prefix)s_LOG_BINARY_FLUSH_INTERVAL_MS
+#define %(prefix)s_LOG_BINARY_FLUSH_INTERVAL_MS 100
+#endif
 
-    %(prefix)s_LOCK;
-    ok = !!%(prefix)s_dl_handle;
-    if (!ok) {
-        char *errmsg;
-        %(prefix)s_dl_handle = dlopen(\"%(libname)s\", RTLD_LAZY);
-        errmsg = dlerror();
-        if (errmsg) {
-            %(prefix)s_dl_handle = NULL;
-            fprintf(stderr,
-                    %(prefix)s_COLOR_ERROR
-                    \"ERROR: could not dlopen(%(libname)s): %%s\\n\"
-                    %(prefix)s_COLOR_CLEAR, errmsg);
+#ifndef %(prefix)s_LOG_BINARY_CLOCK_SOURCE
+#define %(prefix)s_LOG_BINARY_CLOCK_SOURCE CLOCK_MONOTONIC
+#endif
+
+#define %(prefix)s_BINARY_MAGIC \"LLBT\"
+#define %(prefix)s_BINARY_VERSION 1
+#define %(prefix)s_BINARY_ENTER 1
+#define %(prefix)s_BINARY_EXIT 2
+#define %(prefix)s_BINARY_DROPPED 3
+#define %(prefix)s_BINARY_SIZES 4 /* precedes ENTER with %(prefix)s_LOG_RECORD */
+
+/* layout is decoded by liblogger-decode, keep both in sync */
+struct %(prefix)s_binary_record {
+    uint32_t function;
+    uint16_t type;
+    uint16_t n_args;
+    int32_t error;
+    uint32_t depth; /* call depth + 1, 0 if not tracked */
+    uint64_t thread;
+    uint64_t timestamp;
+    uint64_t ret;
+    uint64_t args[%(prefix)s_LOG_BINARY_MAX_ARGS];
+};
+
+struct %(prefix)s_binary_ring {
+    uint64_t head; /* only written by the owner thread */
+    uint64_t tail; /* only written by the flusher */
+    uint64_t dropped; /* only written by the owner thread */
+    uint64_t dropped_reported; /* only used by the flusher */
+    uint64_t thread;
+    struct %(prefix)s_binary_ring *next;
+    struct %(prefix)s_binary_record records[%(prefix)s_LOG_BINARY_RING_SIZE];
+};
+
+%(prefix)s_SHARED struct %(prefix)s_binary_ring *%(prefix)s_binary_rings = NULL;
+%(prefix)s_SHARED %(prefix)s_THREAD_LOCAL struct %(prefix)s_binary_ring *%(prefix)s_binary_thread_ring = NULL;
+%(prefix)s_SHARED pthread_once_t %(prefix)s_binary_once = PTHREAD_ONCE_INIT;
+%(prefix)s_SHARED pthread_mutex_t %(prefix)s_binary_flush_mutex = PTHREAD_MUTEX_INITIALIZER;
+%(prefix)s_SHARED int %(prefix)s_binary_fd = -1;
+
+static void %(prefix)s_binary_write(const void *buf, size_t len)
+{
+    const char *p = buf;
+    while (len > 0) {
+        ssize_t r = write(%(prefix)s_binary_fd, p, len);
+        if (r < 0) {
+            if (errno == EINTR)
+                continue;
+            return;
         }
-        ok = !!%(prefix)s_dl_handle;
+        p += r;
+        len -= r;
     }
-    %(prefix)s_UNLOCK;
-
-    return ok;
 }
 
-#define %(prefix)s_GET_SYM(v, name, ...) \\
-    do { \\
-        if (!v) { \\
-            if (!%(prefix)s_dl_handle) { \\
-                if (!%(prefix)s_dl_prepare()) \\
-                    return __VA_ARGS__; \\
-            } \\
-            %(prefix)s_LOCK; \\
-            if (!v) { \\
-                char *%(prefix)s_dl_err; \\
-                v = dlsym(%(prefix)s_dl_handle, name); \\
-                %(prefix)s_dl_err = dlerror(); \\
-                if (%(prefix)s_dl_err) { \\
-                    fprintf(stderr, \\
-                            %(prefix)s_COLOR_ERROR \\
-                            \"ERROR: could not dlsym(%%s): %%s\\n\" \\
-                            %(prefix)s_COLOR_CLEAR, \\
-                            name, %(prefix)s_dl_err); \\
-                } \\
-            } \\
-            %(prefix)s_UNLOCK; \\
-            if (!v) \\
-                return __VA_ARGS__; \\
-        } \\
-    } while (0)
+static void %(prefix)s_binary_flush(void)
+{
+    struct %(prefix)s_binary_ring *ring;
+
+    pthread_mutex_lock(&%(prefix)s_binary_flush_mutex);
+    if (%(prefix)s_binary_fd < 0)
+        goto end;
+
+    ring = __atomic_load_n(&%(prefix)s_binary_rings, __ATOMIC_ACQUIRE);
+    for (; ring != NULL; ring = ring->next) {
+        uint64_t tail = ring->tail;
+        uint64_t head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE);
+        uint64_t dropped = __atomic_load_n(&ring->dropped, __ATOMIC_RELAXED);
+
+        while (tail < head) {
+            uint64_t idx = tail & (%(prefix)s_LOG_BINARY_RING_SIZE - 1);
+            uint64_t n = head - tail;
+            if (n > %(prefix)s_LOG_BINARY_RING_SIZE - idx)
+                n = %(prefix)s_LOG_BINARY_RING_SIZE - idx;
+            %(prefix)s_binary_write(ring->records + idx,
+                                    n * sizeof(struct %(prefix)s_binary_record));
+            tail += n;
+        }
+        __atomic_store_n(&ring->tail, tail, __ATOMIC_RELEASE);
+
+        if (dropped != ring->dropped_reported) {
+            struct %(prefix)s_binary_record r;
+            memset(&r, 0, sizeof(r));
+            r.type = %(prefix)s_BINARY_DROPPED;
+            r.thread = ring->thread;
+            r.ret = dropped - ring->dropped_reported;
+            ring->dropped_reported = dropped;
+            %(prefix)s_binary_write(&r, sizeof(r));
+        }
+    }
+ end:
+    pthread_mutex_unlock(&%(prefix)s_binary_flush_mutex);
+}
 
+static void *%(prefix)s_binary_flusher(void *data)
+{
+    struct timespec interval = {
+        %(prefix)s_LOG_BINARY_FLUSH_INTERVAL_MS / 1000,
+        (%(prefix)s_LOG_BINARY_FLUSH_INTERVAL_MS %% 1000) * 1000000
+    };
+    while (1) {
+        nanosleep(&interval, NULL);
+        %(prefix)s_binary_flush();
+    }
+    return data;
+}
 
-static inline void %(prefix)s_log_params_begin(void)
+%(prefix)s_DESTRUCTOR
+static void %(prefix)s_binary_shutdown(void)
 {
-    putc('(', %(prefix)s_log_fp);
+    %(prefix)s_binary_flush();
 }
 
-static inline void %(prefix)s_log_param_continue(void)
+static void %(prefix)s_binary_start(void)
 {
-    fputs(\", \", %(prefix)s_log_fp);
+    uint32_t hdr[4];
+    unsigned int i;
+    pthread_t th;
+    pthread_attr_t attr;
+#ifdef %(prefix)s_LOGFILE
+    const char *path = %(prefix)s_LOGFILE;
+#else
+    char path[256];
+    snprintf(path, sizeof(path), \"%(prefix)s.%%d.trace\", (int)getpid());
+#endif
+
+    %(prefix)s_binary_fd = open(path, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+    if (%(prefix)s_binary_fd < 0) {
+        fprintf(stderr,
+                %(prefix)s_COLOR_ERROR
+                \"ERROR: could not open binary trace %%s: %%s.\\n\"
+                %(prefix)s_COLOR_CLEAR, path, strerror(errno));
+        return;
+    }
+
+    hdr[0] = %(prefix)s_BINARY_VERSION;
+    hdr[1] = sizeof(struct %(prefix)s_binary_record);
+    hdr[2] = %(prefix)s_LOG_BINARY_MAX_ARGS;
+    hdr[3] = %(prefix)s_N_FUNCTIONS;
+    %(prefix)s_binary_write(%(prefix)s_BINARY_MAGIC, 4);
+    %(prefix)s_binary_write(hdr, sizeof(hdr));
+    for (i = 0; i < %(prefix)s_N_FUNCTIONS; i++)
+        %(prefix)s_binary_write(%(prefix)s_function_names[i],
+                                strlen(%(prefix)s_function_names[i]) + 1);
+
+    pthread_attr_init(&attr);
+    pthread_attr_setdetachstate(&attr, PTHREAD_CREATE_DETACHED);
+    if (pthread_create(&th, &attr, %(prefix)s_binary_flusher, NULL) != 0)
+        fprintf(stderr,
+                %(prefix)s_COLOR_ERROR
+                \"ERROR: could not start binary trace flusher, \"
+                \"records are written at exit.\\n\"
+                %(prefix)s_COLOR_CLEAR);
+    pthread_attr_destroy(&attr);
 }
 
-static inline void %(prefix)s_log_params_end(void)
+static struct %(prefix)s_binary_ring *%(prefix)s_binary_ring_new(void)
 {
-    putc(')', %(prefix)s_log_fp);
+    struct %(prefix)s_binary_ring *ring;
+
+    pthread_once(&%(prefix)s_binary_once, %(prefix)s_binary_start);
+
+    ring = calloc(1, sizeof(*ring));
+    if (!ring)
+        return NULL;
+    ring->thread = (uint64_t)pthread_self();
+    ring->next = __atomic_load_n(&%(prefix)s_binary_rings, __ATOMIC_RELAXED);
+    while (!__atomic_compare_exchange_n(&%(prefix)s_binary_rings, &ring->next,
+                                        ring, 0, __ATOMIC_RELEASE,
+                                        __ATOMIC_RELAXED))
+        ;
+    %(prefix)s_binary_thread_ring = ring;
+    return ring;
 }
 
-static inline void %(prefix)s_log_params_output_begin(void)
+/* returns the record to fill or NULL if the ring is full (dropped) */
+static inline struct %(prefix)s_binary_record *%(prefix)s_binary_reserve(uint32_t function, uint16_t type, int error)
 {
-    fputs(\"output-parameters=(\", %(prefix)s_log_fp);
+    struct %(prefix)s_binary_ring *ring = %(prefix)s_binary_thread_ring;
+    struct %(prefix)s_binary_record *r;
+    struct timespec spec;
+
+    if (!ring) {
+        ring = %(prefix)s_binary_ring_new();
+        if (!ring)
+            return NULL;
+    }
+
+    if (ring->head - __atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE) >=
+        %(prefix)s_LOG_BINARY_RING_SIZE) {
+        __atomic_store_n(&ring->dropped, ring->dropped + 1, __ATOMIC_RELAXED);
+        return NULL;
+    }
+
+    r = ring->records + (ring->head & (%(prefix)s_LOG_BINARY_RING_SIZE - 1));
+    clock_gettime(%(prefix)s_LOG_BINARY_CLOCK_SOURCE, &spec);
+    r->function = function;
+    r->type = type;
+    r->error = error;
+    r->thread = ring->thread;
+#ifdef %(prefix)s_LOG_CALL_TREE
+    r->depth = %(prefix)s_tree_depth + 1;
+#else
+    r->depth = 0;
+#endif
+    r->timestamp = (uint64_t)spec.tv_sec * 1000000000ULL + spec.tv_nsec;
+    return r;
 }
 
-static inline void %(prefix)s_log_param_output_continue(void)
+static inline void %(prefix)s_binary_commit(struct %(prefix)s_binary_record *r, uint16_t n_args)
 {
-    fputs(\", \", %(prefix)s_log_fp);
+    struct %(prefix)s_binary_ring *ring = %(prefix)s_binary_thread_ring;
+    r->n_args = n_args;
+    __atomic_store_n(&ring->head, ring->head + 1, __ATOMIC_RELEASE);
 }
 
-static inline void %(prefix)s_log_params_output_end(void)
+static inline uint64_t %(prefix)s_binary_double(double value)
 {
-    putc(')', %(prefix)s_log_fp);
+    uint64_t raw;
+    memcpy(&raw, &value, sizeof(raw));
+    return raw;
 }
+#endif /* %(prefix)s_LOG_BINARY */
+
+#if defined(%(prefix)s_LOG_PROFILE) && !defined(%(prefix)s_LOG_BINARY)
+/* Calls are not logged, instead their duration is accumulated in a
+ * histogram per function. Bucket 0 counts calls under 1ns, bucket i
+ * counts calls taking [2^(i-1), 2^i) nanoseconds. Histograms are
+ * appended to the profile file at exit and when
+ * %(prefix)s_LOG_PROFILE_SIGNAL is received, see liblogger-profile.py.
+ */
+#include <stdint.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <signal.h>
+#include <time.h>
 
-#ifdef %(prefix)s_LOG_INDENT
-static %(prefix)s_THREAD_LOCAL int %(prefix)s_log_indentation = 0;
+#ifndef %(prefix)s_LOG_PROFILE_CLOCK_SOURCE
+#define %(prefix)s_LOG_PROFILE_CLOCK_SOURCE CLOCK_MONOTONIC
 #endif
 
-static inline void %(prefix)s_log_enter_start(const char *name)
-{
-    %(prefix)s_LOG_PREPARE;
-    %(prefix)s_LOCK;
+/* 0 to disable */
+#ifndef %(prefix)s_LOG_PROFILE_SIGNAL
+#define %(prefix)s_LOG_PROFILE_SIGNAL SIGUSR2
+#endif
 
-    %(prefix)s_LOG_TIMESTAMP_SHOW;
+#define %(prefix)s_PROFILE_BUCKETS 64
 
-#ifdef %(prefix)s_LOG_INDENT
-    int i;
+struct %(prefix)s_profile_stats {
+    uint64_t calls;
+    uint64_t total;
+    uint64_t max;
+    uint64_t buckets[%(prefix)s_PROFILE_BUCKETS];
+};
 
-    for (i = 0; i < %(prefix)s_log_indentation; i++)
-        fputs(%(prefix)s_LOG_INDENT, %(prefix)s_log_fp);
-    %(prefix)s_log_indentation++;
-#endif
+%(prefix)s_SHARED struct %(prefix)s_profile_stats %(prefix)s_profile[%(prefix)s_N_FUNCTIONS + 1];
+%(prefix)s_SHARED char %(prefix)s_profile_path[256];
 
-    if (!%(prefix)s_IS_MAIN_THREAD)
-        fprintf(%(prefix)s_log_fp, \"[T:%%lu]\", %(prefix)s_THREAD_ID);
+static inline uint64_t %(prefix)s_profile_now(void)
+{
+    struct timespec spec;
+    clock_gettime(%(prefix)s_LOG_PROFILE_CLOCK_SOURCE, &spec);
+    return (uint64_t)spec.tv_sec * 1000000000ULL + spec.tv_nsec;
+}
 
-    fprintf(%(prefix)s_log_fp, %(prefix)s_COLOR_ENTER \"LOG> %%s\", name);
+static inline void %(prefix)s_profile_record(unsigned int function, uint64_t elapsed)
+{
+    struct %(prefix)s_profile_stats *st = %(prefix)s_profile + function;
+    uint64_t max = __atomic_load_n(&st->max, __ATOMIC_RELAXED);
+    unsigned int bucket = 0;
+
+    if (elapsed)
+        bucket = 64 - __builtin_clzll(elapsed);
+    if (bucket >= %(prefix)s_PROFILE_BUCKETS)
+        bucket = %(prefix)s_PROFILE_BUCKETS - 1;
+
+    __atomic_fetch_add(&st->calls, 1, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&st->total, elapsed, __ATOMIC_RELAXED);
+    __atomic_fetch_add(st->buckets + bucket, 1, __ATOMIC_RELAXED);
+    while (elapsed > max &&
+           !__atomic_compare_exchange_n(&st->max, &max, elapsed, 1,
+                                        __ATOMIC_RELAXED, __ATOMIC_RELAXED))
+        ;
 }
 
-static inline void %(prefix)s_log_enter_end(const char *name)
+/* dump helpers only use write(2), so they're safe in signal handlers */
+static void %(prefix)s_profile_puts(char *buf, size_t *len, size_t size, const char *s)
 {
-    fputs(%(prefix)s_COLOR_CLEAR \"\\n\", %(prefix)s_log_fp);
-    fflush(%(prefix)s_log_fp);
-    %(prefix)s_UNLOCK;
-    (void)name;
+    while (*s && *len < size)
+        buf[(*len)++] = *s++;
 }
 
-static inline void %(prefix)s_log_exit_start(const char *name)
+static void %(prefix)s_profile_putu(char *buf, size_t *len, size_t size, uint64_t value)
 {
-    %(prefix)s_LOG_PREPARE;
-    %(prefix)s_LOCK;
+    char tmp[24];
+    int i = sizeof(tmp) - 1;
+
+    tmp[i] = '\\0';
+    do {
+        tmp[--i] = '0' + value %% 10;
+        value /= 10;
+    } while (value);
+    %(prefix)s_profile_puts(buf, len, size, tmp + i);
+}
 
-    %(prefix)s_LOG_TIMESTAMP_SHOW;
+static void %(prefix)s_profile_dump(void)
+{
+    char buf[%(prefix)s_PROFILE_BUCKETS * 48 + 256];
+    size_t len;
+    unsigned int i, b;
+    int saved_errno = errno;
+    int fd = open(%(prefix)s_profile_path, O_WRONLY | O_CREAT | O_APPEND,
+                  0644);
+
+    if (fd < 0) {
+        errno = saved_errno;
+        return;
+    }
 
-#ifdef %(prefix)s_LOG_INDENT
-    int i;
+    len = 0;
+    %(prefix)s_profile_puts(buf, &len, sizeof(buf), \"# liblogger-profile 1 \");
+    %(prefix)s_profile_putu(buf, &len, sizeof(buf), %(prefix)s_N_FUNCTIONS);
+    %(prefix)s_profile_puts(buf, &len, sizeof(buf), \" \");
+    %(prefix)s_profile_putu(buf, &len, sizeof(buf), %(prefix)s_profile_now());
+    %(prefix)s_profile_puts(buf, &len, sizeof(buf), \"\\n\");
+    if (write(fd, buf, len) < 0)
+        goto end;
+
+    for (i = 0; i < %(prefix)s_N_FUNCTIONS; i++) {
+        const struct %(prefix)s_profile_stats *st = %(prefix)s_profile + i;
+        uint64_t calls = __atomic_load_n(&st->calls, __ATOMIC_RELAXED);
+        if (!calls)
+            continue;
+
+        len = 0;
+        %(prefix)s_profile_puts(buf, &len, sizeof(buf), %(prefix)s_function_names[i]);
+        %(prefix)s_profile_puts(buf, &len, sizeof(buf), \" \");
+        %(prefix)s_profile_putu(buf, &len, sizeof(buf), calls);
+        %(prefix)s_profile_puts(buf, &len, sizeof(buf), \" \");
+        %(prefix)s_profile_putu(buf, &len, sizeof(buf),
+                                __atomic_load_n(&st->total, __ATOMIC_RELAXED));
+        %(prefix)s_profile_puts(buf, &len, sizeof(buf), \" \");
+        %(prefix)s_profile_putu(buf, &len, sizeof(buf),
+                                __atomic_load_n(&st->max, __ATOMIC_RELAXED));
+        for (b = 0; b < %(prefix)s_PROFILE_BUCKETS; b++) {
+            uint64_t n = __atomic_load_n(st->buckets + b, __ATOMIC_RELAXED);
+            if (!n)
+                continue;
+            %(prefix)s_profile_puts(buf, &len, sizeof(buf), \" \");
+            %(prefix)s_profile_putu(buf, &len, sizeof(buf), b);
+            %(prefix)s_profile_puts(buf, &len, sizeof(buf), \":\");
+            %(prefix)s_profile_putu(buf, &len, sizeof(buf), n);
+        }
+        %(prefix)s_profile_puts(buf, &len, sizeof(buf), \"\\n\");
+        if (write(fd, buf, len) < 0)
+            goto end;
+    }
+    if (write(fd, \"# end\\n\", 6) < 0)
+        goto end;
 
-    %(prefix)s_log_indentation--;
-    for (i = 0; i < %(prefix)s_log_indentation; i++)
-        fputs(%(prefix)s_LOG_INDENT, %(prefix)s_log_fp);
-#endif
+ end:
+    close(fd);
+    errno = saved_errno;
+}
+
+#if %(prefix)s_LOG_PROFILE_SIGNAL
+static void %(prefix)s_profile_signal(int sig)
+{
+    %(prefix)s_profile_dump();
+    (void)sig;
+}
+#endif
+
+%(prefix)s_CONSTRUCTOR
+static void %(prefix)s_profile_start(void)
+{
+#ifdef %(prefix)s_LOG_PROFILE_FILE
+    snprintf(%(prefix)s_profile_path, sizeof(%(prefix)s_profile_path),
+             \"%%s\", %(prefix)s_LOG_PROFILE_FILE);
+#else
+    snprintf(%(prefix)s_profile_path, sizeof(%(prefix)s_profile_path),
+             \"%(prefix)s.%%d.profile\", (int)getpid());
+#endif
+#if %(prefix)s_LOG_PROFILE_SIGNAL
+    {
+        struct sigaction sa;
+        memset(&sa, 0, sizeof(sa));
+        sa.sa_handler = %(prefix)s_profile_signal;
+        sa.sa_flags = SA_RESTART;
+        sigemptyset(&sa.sa_mask);
+        sigaction(%(prefix)s_LOG_PROFILE_SIGNAL, &sa, NULL);
+    }
+#endif
+}
+
+%(prefix)s_DESTRUCTOR
+static void %(prefix)s_profile_shutdown(void)
+{
+    %(prefix)s_profile_dump();
+}
+#endif /* %(prefix)s_LOG_PROFILE */
+
+#ifdef %(prefix)s_LOG_COUNTERS
+/* Live counters per function in a POSIX shared memory segment, read by
+ * liblogger-top.py. The segment is a header followed by one entry per
+ * function, in function id order, updated with atomic operations only.
+ */
+#include <stdint.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <time.h>
+#include <stddef.h>
+#include <sys/mman.h>
+
+#define %(prefix)s_COUNTERS_MAGIC \"LLCNT\"
+#define %(prefix)s_COUNTERS_VERSION 1
+
+/* layout is read by liblogger-top, keep both in sync */
+struct %(prefix)s_counters_header {
+    char magic[8];
+    uint32_t version;
+    uint32_t n_functions;
+    uint32_t entry_size;
+    uint32_t name_size;
+    uint32_t entries_offset;
+    uint32_t reserved;
+    uint64_t pid;
+    uint64_t start; /* CLOCK_MONOTONIC, nanoseconds */
+};
+
+struct %(prefix)s_counters_entry {
+    char name[%(prefix)s_FUNCTION_NAME_SIZE];
+    uint64_t calls;
+    int64_t in_flight;
+    uint64_t failures; /* return checker failed */
+    uint64_t total; /* nanoseconds */
+} __attribute__((aligned(64)));
+
+struct %(prefix)s_counters {
+    struct %(prefix)s_counters_header header;
+    struct %(prefix)s_counters_entry entries[%(prefix)s_N_FUNCTIONS + 1];
+};
+
+%(prefix)s_SHARED struct %(prefix)s_counters *%(prefix)s_counters = NULL;
+%(prefix)s_SHARED char %(prefix)s_counters_name[256];
+
+static inline uint64_t %(prefix)s_counters_now(void)
+{
+    struct timespec spec;
+    clock_gettime(CLOCK_MONOTONIC, &spec);
+    return (uint64_t)spec.tv_sec * 1000000000ULL + spec.tv_nsec;
+}
+
+static inline uint64_t %(prefix)s_counters_enter(unsigned int function)
+{
+    struct %(prefix)s_counters *c = %(prefix)s_counters;
+    if (!c)
+        return 0;
+    __atomic_fetch_add(&c->entries[function].calls, 1, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&c->entries[function].in_flight, 1, __ATOMIC_RELAXED);
+    return %(prefix)s_counters_now();
+}
+
+static inline void %(prefix)s_counters_exit(unsigned int function, uint64_t t0, int failed)
+{
+    struct %(prefix)s_counters *c = %(prefix)s_counters;
+    if (!c || !t0)
+        return;
+    __atomic_fetch_add(&c->entries[function].total,
+                       %(prefix)s_counters_now() - t0, __ATOMIC_RELAXED);
+    __atomic_fetch_sub(&c->entries[function].in_flight, 1, __ATOMIC_RELAXED);
+    if (failed)
+        __atomic_fetch_add(&c->entries[function].failures, 1,
+                           __ATOMIC_RELAXED);
+}
+
+%(prefix)s_CONSTRUCTOR
+static void %(prefix)s_counters_start(void)
+{
+    struct %(prefix)s_counters *c;
+    unsigned int i;
+    int fd;
+
+#ifdef %(prefix)s_LOG_COUNTERS_NAME
+    snprintf(%(prefix)s_counters_name, sizeof(%(prefix)s_counters_name),
+             \"%%s\", %(prefix)s_LOG_COUNTERS_NAME);
+#else
+    snprintf(%(prefix)s_counters_name, sizeof(%(prefix)s_counters_name),
+             \"/%(prefix)s.%%d\", (int)getpid());
+#endif
+
+    fd = shm_open(%(prefix)s_counters_name, O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if (fd < 0) {
+        fprintf(stderr,
+                %(prefix)s_COLOR_ERROR
+                \"ERROR: could not create shared memory %%s: %%s.\\n\"
+                %(prefix)s_COLOR_CLEAR,
+                %(prefix)s_counters_name, strerror(errno));
+        return;
+    }
+    if (ftruncate(fd, sizeof(*c)) != 0) {
+        fprintf(stderr,
+                %(prefix)s_COLOR_ERROR
+                \"ERROR: could not resize shared memory %%s: %%s.\\n\"
+                %(prefix)s_COLOR_CLEAR,
+                %(prefix)s_counters_name, strerror(errno));
+        close(fd);
+        shm_unlink(%(prefix)s_counters_name);
+        return;
+    }
+    c = mmap(NULL, sizeof(*c), PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    close(fd);
+    if (c == MAP_FAILED) {
+        fprintf(stderr,
+                %(prefix)s_COLOR_ERROR
+                \"ERROR: could not map shared memory %%s: %%s.\\n\"
+                %(prefix)s_COLOR_CLEAR,
+                %(prefix)s_counters_name, strerror(errno));
+        shm_unlink(%(prefix)s_counters_name);
+        return;
+    }
+
+    for (i = 0; i < %(prefix)s_N_FUNCTIONS; i++)
+        strncpy(c->entries[i].name, %(prefix)s_function_names[i],
+                %(prefix)s_FUNCTION_NAME_SIZE - 1);
+    c->header.version = %(prefix)s_COUNTERS_VERSION;
+    c->header.n_functions = %(prefix)s_N_FUNCTIONS;
+    c->header.entry_size = sizeof(struct %(prefix)s_counters_entry);
+    c->header.name_size = %(prefix)s_FUNCTION_NAME_SIZE;
+    c->header.entries_offset = offsetof(struct %(prefix)s_counters, entries);
+    c->header.pid = getpid();
+    c->header.start = %(prefix)s_counters_now();
+    /* magic last, readers wait for it */
+    memcpy(c->header.magic, %(prefix)s_COUNTERS_MAGIC,
+           sizeof(%(prefix)s_COUNTERS_MAGIC));
+    __atomic_store_n(&%(prefix)s_counters, c, __ATOMIC_RELEASE);
+}
+
+#ifndef %(prefix)s_LOG_COUNTERS_KEEP
+%(prefix)s_DESTRUCTOR
+static void %(prefix)s_counters_shutdown(void)
+{
+    if (%(prefix)s_counters)
+        shm_unlink(%(prefix)s_counters_name);
+}
+#endif
+#endif /* %(prefix)s_LOG_COUNTERS */
+
+#ifdef %(prefix)s_LOG_CONTROL
+/* Functions may be disabled at runtime, then they only forward the
+ * call. The initial set comes from the %(prefix)s_ENABLE environment
+ * variable, a list of fnmatch(3) patterns separated by commas or
+ * spaces, where a leading '-' disables the matching functions. If
+ * it's not set every function is enabled. Later, lines with the same
+ * syntax written to the FIFO named by %(prefix)s_CONTROL change the set
+ * and %(prefix)s_LOG_CONTROL_SIGNAL turns all functions off and back on.
+ */
+#include <stdint.h>
+#include <stdlib.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <signal.h>
+#include <fnmatch.h>
+#include <sys/stat.h>
+
+/* 0 to disable */
+#ifndef %(prefix)s_LOG_CONTROL_SIGNAL
+#define %(prefix)s_LOG_CONTROL_SIGNAL SIGUSR1
+#endif
+
+#define %(prefix)s_ENABLED_WORDS ((%(prefix)s_N_FUNCTIONS + 31) / 32)
+%(prefix)s_SHARED uint32_t %(prefix)s_enabled[%(prefix)s_ENABLED_WORDS + 1];
+%(prefix)s_SHARED uint32_t %(prefix)s_enabled_saved[%(prefix)s_ENABLED_WORDS + 1];
+%(prefix)s_SHARED volatile sig_atomic_t %(prefix)s_enabled_off = 0;
+%(prefix)s_SHARED char %(prefix)s_control_path[256];
+%(prefix)s_SHARED unsigned char %(prefix)s_control_created = 0;
+
+#define %(prefix)s_ENABLED(id) \\
+    (__atomic_load_n(%(prefix)s_enabled + ((id) >> 5), __ATOMIC_RELAXED) & \\
+     (1U << ((id) & 31)))
+
+static void %(prefix)s_control_set(unsigned int id, int enabled)
+{
+    if (enabled)
+        __atomic_fetch_or(%(prefix)s_enabled + (id >> 5), 1U << (id & 31),
+                          __ATOMIC_RELAXED);
+    else
+        __atomic_fetch_and(%(prefix)s_enabled + (id >> 5), ~(1U << (id & 31)),
+                           __ATOMIC_RELAXED);
+}
+
+static void %(prefix)s_control_apply(const char *spec)
+{
+    const char *seps = \", \\t\\r\\n\";
+    char pattern[256];
+
+    while (*spec) {
+        const char *glob = pattern;
+        size_t len;
+        int enabled = 1;
+        unsigned int i;
+
+        spec += strspn(spec, seps);
+        len = strcspn(spec, seps);
+        if (!len)
+            break;
+        if (len >= sizeof(pattern))
+            len = sizeof(pattern) - 1;
+        memcpy(pattern, spec, len);
+        pattern[len] = '\\0';
+        spec += len;
+
+        if (glob[0] == '-' || glob[0] == '+') {
+            enabled = glob[0] == '+';
+            glob++;
+        }
+        for (i = 0; i < %(prefix)s_N_FUNCTIONS; i++) {
+            if (fnmatch(glob, %(prefix)s_function_names[i], 0) == 0)
+                %(prefix)s_control_set(i, enabled);
+        }
+    }
+}
+
+#if %(prefix)s_LOG_CONTROL_SIGNAL
+static void %(prefix)s_control_signal(int sig)
+{
+    unsigned int i;
+
+    if (!%(prefix)s_enabled_off) {
+        for (i = 0; i < %(prefix)s_ENABLED_WORDS; i++)
+            %(prefix)s_enabled_saved[i] =
+                __atomic_exchange_n(%(prefix)s_enabled + i, 0,
+                                    __ATOMIC_RELAXED);
+        %(prefix)s_enabled_off = 1;
+    } else {
+        for (i = 0; i < %(prefix)s_ENABLED_WORDS; i++)
+            __atomic_store_n(%(prefix)s_enabled + i,
+                             %(prefix)s_enabled_saved[i], __ATOMIC_RELAXED);
+        %(prefix)s_enabled_off = 0;
+    }
+    (void)sig;
+}
+#endif
+
+static void *%(prefix)s_control_reader(void *data)
+{
+    char buf[4096];
+    size_t used = 0;
+    /* read-write so it never sees end of file when writers go away */
+    int fd = open(%(prefix)s_control_path, O_RDWR);
+
+    if (fd < 0) {
+        fprintf(stderr,
+                %(prefix)s_COLOR_ERROR
+                \"ERROR: could not open control FIFO %%s: %%s.\\n\"
+                %(prefix)s_COLOR_CLEAR,
+                %(prefix)s_control_path, strerror(errno));
+        return data;
+    }
+
+    while (1) {
+        char *nl;
+        ssize_t r = read(fd, buf + used, sizeof(buf) - used - 1);
+        if (r < 0) {
+            if (errno == EINTR)
+                continue;
+            break;
+        }
+        used += r;
+        buf[used] = '\\0';
+        while ((nl = strchr(buf, '\\n')) != NULL) {
+            *nl = '\\0';
+            %(prefix)s_control_apply(buf);
+            used -= nl + 1 - buf;
+            memmove(buf, nl + 1, used + 1);
+        }
+        if (used == sizeof(buf) - 1) { /* line too long, apply as is */
+            %(prefix)s_control_apply(buf);
+            used = 0;
+        }
+    }
+    close(fd);
+    return data;
+}
+
+%(prefix)s_CONSTRUCTOR
+static void %(prefix)s_control_start(void)
+{
+    const char *spec = getenv(\"%(prefix)s_ENABLE\");
+    const char *path = getenv(\"%(prefix)s_CONTROL\");
+    unsigned int i;
+
+    if (spec)
+        %(prefix)s_control_apply(spec);
+    else {
+        for (i = 0; i < %(prefix)s_N_FUNCTIONS; i++)
+            %(prefix)s_control_set(i, 1);
+    }
+
+#if %(prefix)s_LOG_CONTROL_SIGNAL
+    {
+        struct sigaction sa;
+        memset(&sa, 0, sizeof(sa));
+        sa.sa_handler = %(prefix)s_control_signal;
+        sa.sa_flags = SA_RESTART;
+        sigemptyset(&sa.sa_mask);
+        sigaction(%(prefix)s_LOG_CONTROL_SIGNAL, &sa, NULL);
+    }
+#endif
+
+    if (path && path[0]) {
+        pthread_t th;
+        pthread_attr_t attr;
+
+        snprintf(%(prefix)s_control_path, sizeof(%(prefix)s_control_path),
+                 \"%%s\", path);
+        if (mkfifo(%(prefix)s_control_path, 0600) == 0)
+            %(prefix)s_control_created = 1;
+        else if (errno != EEXIST) {
+            fprintf(stderr,
+                    %(prefix)s_COLOR_ERROR
+                    \"ERROR: could not create control FIFO %%s: %%s.\\n\"
+                    %(prefix)s_COLOR_CLEAR,
+                    %(prefix)s_control_path, strerror(errno));
+            return;
+        }
+        pthread_attr_init(&attr);
+        pthread_attr_setdetachstate(&attr, PTHREAD_CREATE_DETACHED);
+        if (pthread_create(&th, &attr, %(prefix)s_control_reader, NULL) != 0)
+            fprintf(stderr,
+                    %(prefix)s_COLOR_ERROR
+                    \"ERROR: could not start control FIFO reader.\\n\"
+                    %(prefix)s_COLOR_CLEAR);
+        pthread_attr_destroy(&attr);
+    }
+}
+
+%(prefix)s_DESTRUCTOR
+static void %(prefix)s_control_shutdown(void)
+{
+    if (%(prefix)s_control_created)
+        unlink(%(prefix)s_control_path);
+}
+#endif /* %(prefix)s_LOG_CONTROL */
+%(limits_runtime)s
+#ifdef %(prefix)s_LOG_CALL_TREE
+/* Per thread stack of the wrapped calls in progress, used to tell the
+ * time spent in a function itself (exclusive) from the time spent in
+ * the wrapped functions it called, ie: through callbacks (inclusive).
+ */
+#include <stdint.h>
+#include <time.h>
+
+#ifndef %(prefix)s_LOG_CALL_TREE_MAX_DEPTH
+#define %(prefix)s_LOG_CALL_TREE_MAX_DEPTH 256
+#endif
+
+struct %(prefix)s_tree_frame {
+    unsigned int function;
+    uint64_t start;
+    uint64_t children; /* time spent in wrapped calls made by this one */
+};
+
+%(prefix)s_SHARED %(prefix)s_THREAD_LOCAL struct %(prefix)s_tree_frame %(prefix)s_tree_stack[%(prefix)s_LOG_CALL_TREE_MAX_DEPTH];
+
+%(prefix)s_SHARED struct {
+    uint64_t calls;
+    uint64_t inclusive; /* outermost calls only if recursive */
+    uint64_t exclusive;
+} %(prefix)s_tree_stats[%(prefix)s_N_FUNCTIONS];
+
+static inline uint64_t %(prefix)s_tree_now(void)
+{
+    struct timespec spec;
+    clock_gettime(CLOCK_MONOTONIC, &spec);
+    return (uint64_t)spec.tv_sec * 1000000000ULL + spec.tv_nsec;
+}
+
+/* called right before the wrapped function */
+static inline void %(prefix)s_tree_push(unsigned int id)
+{
+    unsigned int depth = %(prefix)s_tree_depth++;
+    if (depth < %(prefix)s_LOG_CALL_TREE_MAX_DEPTH) {
+        %(prefix)s_tree_stack[depth].function = id;
+        %(prefix)s_tree_stack[depth].children = 0;
+        %(prefix)s_tree_stack[depth].start = %(prefix)s_tree_now();
+    }
+}
+
+/* called right after the wrapped function returned */
+static inline void %(prefix)s_tree_pop(unsigned int id)
+{
+    unsigned int depth = --%(prefix)s_tree_depth;
+    const struct %(prefix)s_tree_frame *frame;
+    uint64_t elapsed;
+    unsigned int i;
+
+    if (depth >= %(prefix)s_LOG_CALL_TREE_MAX_DEPTH)
+        return;
+
+    frame = %(prefix)s_tree_stack + depth;
+    elapsed = %(prefix)s_tree_now() - frame->start;
+    if (depth > 0)
+        %(prefix)s_tree_stack[depth - 1].children += elapsed;
+
+    __atomic_fetch_add(&%(prefix)s_tree_stats[id].calls, 1, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&%(prefix)s_tree_stats[id].exclusive,
+                       elapsed - frame->children, __ATOMIC_RELAXED);
+    for (i = 0; i < depth; i++)
+        if (%(prefix)s_tree_stack[i].function == id)
+            return; /* recursive, counted by the outermost call */
+    __atomic_fetch_add(&%(prefix)s_tree_stats[id].inclusive, elapsed,
+                       __ATOMIC_RELAXED);
+}
+
+%(prefix)s_DESTRUCTOR
+static void %(prefix)s_tree_report(void)
+{
+    unsigned int i;
+    FILE *fp;
+
+#ifdef %(prefix)s_LOG_BINARY
+    fp = stderr;
+#else
+    %(prefix)s_LOG_PREPARE;
+    fp = %(prefix)s_log_fp;
+#endif
+
+    for (i = 0; i < %(prefix)s_N_FUNCTIONS; i++) {
+        if (!%(prefix)s_tree_stats[i].calls)
+            continue;
+        fprintf(fp, \"LOG! %%s: calls=%%llu inclusive=%%lluns \"
+                \"exclusive=%%lluns\\n\",
+                %(prefix)s_function_names[i],
+                (unsigned long long)%(prefix)s_tree_stats[i].calls,
+                (unsigned long long)%(prefix)s_tree_stats[i].inclusive,
+                (unsigned long long)%(prefix)s_tree_stats[i].exclusive);
+    }
+    fflush(fp);
+}
+
+#define %(prefix)s_LOG_DEPTH_SHOW \\
+    fprintf(%(prefix)s_log_fp, \"[D:%%u]\", %(prefix)s_tree_depth)
+#else
+#define %(prefix)s_LOG_DEPTH_SHOW do{}while(0)
+#endif /* %(prefix)s_LOG_CALL_TREE */
+%(dl_runtime)s
+
+static inline void %(prefix)s_log_params_begin(void)
+{
+    putc('(', %(prefix)s_log_fp);
+}
+
+static inline void %(prefix)s_log_param_continue(void)
+{
+    fputs(\", \", %(prefix)s_log_fp);
+}
+
+static inline void %(prefix)s_log_params_end(void)
+{
+    putc(')', %(prefix)s_log_fp);
+}
+
+static inline void %(prefix)s_log_params_output_begin(void)
+{
+    fputs(\"output-parameters=(\", %(prefix)s_log_fp);
+}
+
+static inline void %(prefix)s_log_param_output_continue(void)
+{
+    fputs(\", \", %(prefix)s_log_fp);
+}
+
+static inline void %(prefix)s_log_params_output_end(void)
+{
+    putc(')', %(prefix)s_log_fp);
+}
+
+#ifdef %(prefix)s_LOG_INDENT
+%(prefix)s_SHARED %(prefix)s_THREAD_LOCAL int %(prefix)s_log_indentation = 0;
+#endif
+
+static inline void %(prefix)s_log_enter_start(const char *name)
+{
+    %(prefix)s_LOG_PREPARE;
+    %(prefix)s_LOG_LOCK;
+
+    %(prefix)s_LOG_TIMESTAMP_SHOW;
+
+#ifdef %(prefix)s_LOG_INDENT
+    int i;
+
+    for (i = 0; i < %(prefix)s_log_indentation; i++)
+        fputs(%(prefix)s_LOG_INDENT, %(prefix)s_log_fp);
+    %(prefix)s_log_indentation++;
+#endif
+
+    if (!%(prefix)s_IS_MAIN_THREAD)
+        fprintf(%(prefix)s_log_fp, \"[T:%%lu]\", %(prefix)s_THREAD_ID);
+    %(prefix)s_LOG_DEPTH_SHOW;
+
+    fprintf(%(prefix)s_log_fp, %(prefix)s_COLOR_ENTER \"LOG> %%s\", name);
+}
+
+static inline void %(prefix)s_log_enter_end(const char *name)
+{
+    fputs(%(prefix)s_COLOR_CLEAR \"\\n\", %(prefix)s_log_fp);
+    fflush(%(prefix)s_log_fp);
+    %(prefix)s_LOG_UNLOCK;
+    (void)name;
+}
+
+static inline void %(prefix)s_log_exit_start(const char *name)
+{
+    %(prefix)s_LOG_PREPARE;
+    %(prefix)s_LOG_LOCK;
+
+    %(prefix)s_LOG_TIMESTAMP_SHOW;
+
+#ifdef %(prefix)s_LOG_INDENT
+    int i;
+
+    %(prefix)s_log_indentation--;
+    for (i = 0; i < %(prefix)s_log_indentation; i++)
+        fputs(%(prefix)s_LOG_INDENT, %(prefix)s_log_fp);
+#endif
 
     if (!%(prefix)s_IS_MAIN_THREAD)
         fprintf(%(prefix)s_log_fp, \"[T:%%lu]\", %(prefix)s_THREAD_ID);
+    %(prefix)s_LOG_DEPTH_SHOW;
     fprintf(%(prefix)s_log_fp, %(prefix)s_COLOR_EXIT \"LOG< %%s\", name);
 }
 
@@ -1061,7 +2215,7 @@ static inline void %(prefix)s_log_exit_end(const char *name)
 {
     fputs(%(prefix)s_COLOR_CLEAR \"\\n\", %(prefix)s_log_fp);
     fflush(%(prefix)s_log_fp);
-    %(prefix)s_UNLOCK;
+    %(prefix)s_LOG_UNLOCK;
     (void)name;
 }
 
@@ -1385,7 +2539,75 @@ static inline void %(prefix)s_log_checker_errno(FILE *p, const char *type, long
                 f.write("#include \"%s\"\n" % o.strip())
 
 
+class TypeResolver(object):
+    """Per run cache of how type strings resolve.
+
+    Formatters, checkers, pointer-ness and aliases only depend on the
+    type and the configuration, yet they are asked for every parameter
+    of every function. They are computed once per normalized type (see
+    key()) with the resolve_* functions. Per function settings, like
+    parameter formatters, are not cached.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def key(self, type):
+        return re_doublespaces.sub(" ", type.strip()).replace(" ", "-")
+
+    def lookup(self, type, what, resolve, *args):
+        key = self.key(type)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {}
+        try:
+            return entry[what]
+        except KeyError:
+            value = entry[what] = resolve(key, *args)
+            return value
+
+    def chain(self, key, ctxt):
+        """Types key is an alias of, in order."""
+        chain = []
+        alias = key
+        while True:
+            alias = get_type_alias(alias, ctxt)
+            if not alias or alias in chain or alias == key:
+                return chain
+            chain.append(alias)
+
+    def dump(self, out, ctxt):
+        out.write("Resolved %d types:\n" % (len(self.entries),))
+        for key in sorted(self.entries.keys()):
+            entry = self.entries[key]
+            out.write("%s\n" % (key,))
+            chain = self.chain(key, ctxt)
+            if chain:
+                out.write("    alias of: %s\n" % (" -> ".join(chain),))
+            if "pointer" in entry:
+                out.write("    pointer: %s\n" %
+                          (entry["pointer"] and "yes" or "no",))
+            for what in sorted(entry.keys()):
+                if what[0] != "formatter":
+                    continue
+                safe = {None: "default", True: "safe",
+                        False: "not safe"}[what[1]]
+                out.write("    formatter (%s): %s\n" % (safe, entry[what]))
+            if "checker" in entry:
+                out.write("    checker: %s\n" % (entry["checker"] or "none",))
+
+
+def get_resolver(ctxt):
+    resolver = ctxt.get("resolver")
+    if resolver is None:
+        resolver = ctxt["resolver"] = TypeResolver()
+    return resolver
+
+
 def get_type_alias(type, ctxt):
+    return get_resolver(ctxt).lookup(type, "alias", resolve_type_alias, ctxt)
+
+
+def resolve_type_alias(type, ctxt):
     cfg = ctxt["cfg"]
     if cfg:
         try:
@@ -1393,8 +2615,7 @@ def get_type_alias(type, ctxt):
         except Exception, e:
             pass
 
-    typedefs = ctxt["header_contents"]["typedef"]
-    alias = Typedef.find(type.replace("-", " "))
+    alias = ctxt["types"].find(Typedef, type.replace("-", " "))
     if not alias:
         typename = re.sub("[[][0-9]+[]]", "[]", type)
         if typename != type:
@@ -1409,6 +2630,11 @@ def get_type_alias(type, ctxt):
 
 
 def type_is_pointer(type, ctxt):
+    return get_resolver(ctxt).lookup(type, "pointer", resolve_type_is_pointer,
+                                     ctxt)
+
+
+def resolve_type_is_pointer(type, ctxt):
     if "*" in type:
         return True
     if "[" in type:
@@ -1416,8 +2642,7 @@ def type_is_pointer(type, ctxt):
     if type == "va_list":
         return True
 
-    typedefs = ctxt["header_contents"]["typedef"]
-    alias = Typedef.find(type.replace("-", " "))
+    alias = ctxt["types"].find(Typedef, type.replace("-", " "))
     if not alias:
         return False
     if alias.pointer > 0:
@@ -1483,8 +2708,36 @@ provided_formatters = {
     }
 
 def get_type_formatter(func, name, type, ctxt):
-    type = type.replace(" ", "-")
+    cfg = ctxt["cfg"]
+    safe = None
+    if cfg:
+        section = "func-%s" % (func,)
+        if name == "return":
+            key = "return"
+        else:
+            key = "parameter-%s" % name
+
+        # most functions have no settings, avoid the costly failures
+        if cfg.has_option(section, key + "-formatter"):
+            try:
+                param_formatter = cfg.get(section, key + "-formatter",
+                                          vars=ctxt)
+            except Exception, e:
+                param_formatter = None
+            if param_formatter:
+                return param_formatter
+        if cfg.has_option(section, key + "-safe"):
+            try:
+                safe = cfg.getboolean(section, key + "-safe")
+            except Exception, e:
+                pass
+
+    return get_resolver(ctxt).lookup(type, ("formatter", safe),
+                                     resolve_type_formatter, safe, ctxt)
 
+
+def resolve_type_formatter(type, param_safe, ctxt):
+    """Formatter of type, param_safe is the -safe setting of a parameter."""
     formatter = "%(prefix)s_log_fmt_long_long"
     if type_is_pointer(type, ctxt):
         formatter = "%(prefix)s_log_fmt_pointer"
@@ -1496,37 +2749,19 @@ def get_type_formatter(func, name, type, ctxt):
     if not cfg:
         return formatter
 
-    safe = False
-    try:
-        safe = cfg.getboolean("global", "assume-safe-formatters")
-    except Exception, e:
-        pass
+    safe = param_safe
+    if safe is None:
+        safe = False
+        try:
+            safe = cfg.getboolean("global", "assume-safe-formatters")
+        except Exception, e:
+            pass
 
     try:
         custom_formatter = cfg.get("type-formatters", type, vars=ctxt)
     except Exception, e:
         custom_formatter = None
 
-    section = "func-%s" % (func,)
-
-    if name == "return":
-        key = "return"
-    else:
-        key = "parameter-%s" % name
-
-    try:
-        safe = cfg.getboolean(section, key + "-safe")
-    except Exception, e:
-        pass
-
-    try:
-        param_formatter = cfg.get(section, key + "-formatter", vars=ctxt)
-    except Exception, e:
-        param_formatter = None
-
-    if param_formatter:
-        return param_formatter
-
     if not safe:
         try:
             safe = cfg.getboolean("safe-formatters", type)
@@ -1544,14 +2779,11 @@ def get_type_formatter(func, name, type, ctxt):
         print "Ignoring formatter '%s': %s not safe" % (custom_formatter, type)
         custom_formatter = None
 
-    alias = type
-    while True:
-        alias = get_type_alias(alias, ctxt)
-        if not alias:
-            break
-        custom_formatter = get_type_formatter(func, name, alias, ctxt)
-        if custom_formatter:
-            return custom_formatter
+    alias = get_type_alias(type, ctxt)
+    if alias:
+        return get_resolver(ctxt).lookup(alias, ("formatter", param_safe),
+                                         resolve_type_formatter, param_safe,
+                                         ctxt)
 
     return formatter
 
@@ -1600,41 +2832,243 @@ def get_return_checker(func, type, ctxt):
     if not cfg:
         return
 
-    type = type.replace(" ", "-")
-    try:
-        checker = cfg.get("return-checkers", type, vars=ctxt)
-    except Exception, e:
-        checker = None
-        alias = type
-        while not checker:
-            alias = get_type_alias(alias, ctxt)
-            if not alias:
-                break
-            checker = get_return_checker(func, alias, ctxt)
-
     section = "func-%s" % (func,)
+    if cfg.has_option(section, "return-checker"):
+        try:
+            custom_checker = cfg.get(section, "return-checker", vars=ctxt)
+        except Exception, e:
+            custom_checker = None
+        if custom_checker:
+            return custom_checker
+
+    return get_resolver(ctxt).lookup(type, "checker", resolve_return_checker,
+                                     ctxt)
+
+
+def resolve_return_checker(type, ctxt):
     try:
-        custom_checker = cfg.get(section, "return-checker", vars=ctxt)
+        return ctxt["cfg"].get("return-checkers", type, vars=ctxt)
     except Exception, e:
-        custom_checker = None
+        pass
+    alias = get_type_alias(type, ctxt)
+    if alias:
+        return get_resolver(ctxt).lookup(alias, "checker",
+                                         resolve_return_checker, ctxt)
+    return None
 
-    return custom_checker or checker
 
+# C condition telling the builtin checker would complain
+checker_failures = {
+    "log_checker_null": "%(ret)s != 0",
+    "log_checker_non_null": "%(ret)s == 0",
+    "log_checker_zero": "%(ret)s != 0",
+    "log_checker_non_zero": "%(ret)s == 0",
+    "log_checker_false": "%(ret)s != 0",
+    "log_checker_true": "%(ret)s == 0",
+    "log_checker_errno": "%(errno)s != 0",
+    }
 
-def generate_log_params(f, func, ctxt):
-    if not func.parameters or \
-       (func.parameters[0].pointer == 0 and
+def get_return_failure(func, ret_type, ctxt):
+    """C expression true when the return checker fails, or None.
+
+    Only builtin checkers are known, custom ones are C functions that
+    just print.
+    """
+    checker = get_return_checker(func.name, ret_type, ctxt)
+    if not checker:
+        return None
+    start = ctxt["prefix"] + "_"
+    if not checker.startswith(start):
+        return None
+    cond = checker_failures.get(checker[len(start):])
+    if not cond:
+        return None
+    return cond % {"ret": "%s_ret" % (ctxt["prefix"],),
+                   "errno": "%s_bkp_errno" % (ctxt["prefix"],)}
+
+
+def parameter_name_type(p):
+    """Returns (name, type) of a parameter, moving arrays to the type."""
+    type = p.type_formatter()
+    name = p.name
+    if "[" in name:
+        idx = name.find("[")
+        type += " " + re.sub("[0-9]", "", name[idx:])
+        name = name[:idx]
+    return name, type
+
+
+def get_type_raw_kind(type, pointer, ctxt):
+    """How a value is stored as a raw 64 bits word.
+
+    Returns "pointer", "double", "integer" or None for aggregates passed
+    by value, that can't be stored.
+    """
+    seen = set()
+    while True:
+        if pointer > 0:
+            return "pointer"
+        if isinstance(type, Typedef):
+            pointer = type.pointer
+            type = type.reference
+            continue
+        if isinstance(type, FunctionPointer):
+            return "pointer"
+        if isinstance(type, Group):
+            return None
+        if isinstance(type, Enum):
+            return "integer"
+
+        name = str(type)
+        if name in seen:
+            return "integer"
+        seen.add(name)
+        parts = [x for x in name.split(" ") if x not in ("const", "volatile")]
+        name = " ".join(parts)
+        if "*" in name or "[" in name or name == "va_list":
+            return "pointer"
+        if name in ("float", "double", "long double"):
+            return "double"
+        if parts and parts[0] in ("struct", "union"):
+            return None
+
+        typedef = ctxt["types"].find(Typedef, name)
+        if typedef:
+            type = typedef
+            continue
+        alias = get_type_alias(name.replace(" ", "-"), ctxt)
+        if alias:
+            type = ctxt["types"].get_by_name(alias.replace("-", " "))
+            continue
+        return "integer"
+
+
+def raw_value(name, kind, prefix, to_double="binary_double"):
+    if kind == "pointer":
+        return "(uint64_t)(uintptr_t)%s" % (name,)
+    elif kind == "double":
+        return "%s_%s(%s)" % (prefix, to_double, name)
+    elif kind == "integer":
+        return "(uint64_t)%s" % (name,)
+    return "0"
+
+
+def generate_binary_record(f, func, ctxt, record_type, ret_name=None):
+    prefix = ctxt["prefix"]
+    repl = {"prefix": prefix,
+            "id": ctxt["function_ids"][func.name],
+            "type": record_type,
+            }
+    f.write("#ifdef %(prefix)s_LOG_BINARY\n" % repl)
+    if record_type == "ENTER":
+        generate_binary_sizes_record(f, func, ctxt)
+    f.write("""\
+    {
+        struct %(prefix)s_binary_record *%(prefix)s_rec = \
+%(prefix)s_binary_reserve(%(id)d, %(prefix)s_BINARY_%(type)s, \
+%(prefix)s_bkp_errno);
+        if (%(prefix)s_rec) {
+""" % repl)
+    n_args = 0
+    if func.has_parameters():
+        for i, p in enumerate(func.parameters):
+            name, type = parameter_name_type(p)
+            if "[" in type:
+                kind = "pointer"
+            else:
+                kind = get_type_raw_kind(p.type, p.pointer, ctxt)
+            f.write("            %s_rec->args[%d] = %s;\n" %
+                    (prefix, i, raw_value(name, kind, prefix)))
+        n_args = len(func.parameters)
+    if ret_name:
+        kind = get_type_raw_kind(func.ret_type, func.ret_pointer, ctxt)
+        f.write("            %s_rec->ret = %s;\n" %
+                (prefix, raw_value(ret_name, kind, prefix)))
+    else:
+        f.write("            %s_rec->ret = 0;\n" % (prefix,))
+    f.write("""\
+            %(prefix)s_binary_commit(%(prefix)s_rec, %(n_args)d);
+        }
+    }
+""" % {"prefix": prefix, "n_args": n_args})
+
+
+def generate_binary_sizes_record(f, func, ctxt):
+    """Sizes of the buffers given to func, recorded before its ENTER."""
+    if not func.has_parameters():
+        return
+    sizes = []
+    for p in func.parameters:
+        name, type = parameter_name_type(p)
+        sizes.append(get_parameter_size(func, name, type, ctxt))
+    if not [x for x in sizes if x]:
+        return
+
+    repl = {"prefix": ctxt["prefix"],
+            "id": ctxt["function_ids"][func.name],
+            "n_args": len(sizes),
+            }
+    f.write("""\
+#ifdef %(prefix)s_LOG_RECORD
+    {
+        struct %(prefix)s_binary_record *%(prefix)s_rec = \
+%(prefix)s_binary_reserve(%(id)d, %(prefix)s_BINARY_SIZES, 0);
+        if (%(prefix)s_rec) {
+""" % repl)
+    for i, size in enumerate(sizes):
+        f.write("            %s_rec->args[%d] = %s;\n" %
+                (ctxt["prefix"], i, size or "0"))
+    f.write("""\
+            %(prefix)s_rec->ret = 0;
+            %(prefix)s_binary_commit(%(prefix)s_rec, %(n_args)d);
+        }
+    }
+#endif
+""" % repl)
+
+
+def get_parameter_size(func, name, type, ctxt):
+    """C expression with the size of the buffer given to a parameter.
+
+    Used to record calls for replay. Strings are measured if they are
+    safe to dereference (see get_type_formatter()), other pointers need
+    parameter-<name>-size in the function section. Returns None if not
+    known.
+    """
+    cfg = ctxt["cfg"]
+    if cfg:
+        try:
+            return "(%s ? (uint64_t)(%s) : 0)" % \
+                   (name, cfg.get("func-%s" % (func.name,),
+                                  "parameter-%s-size" % (name,)))
+        except Exception, e:
+            pass
+    formatter = get_type_formatter(func.name, name, type, ctxt)
+    if formatter == "%s_log_fmt_string" % (ctxt["prefix"],):
+        return "(%s ? strlen(%s) + 1 : 0)" % (name, name)
+    return None
+
+
+def generate_profile_record(f, func, ctxt, record_type):
+    repl = {"prefix": ctxt["prefix"], "id": ctxt["function_ids"][func.name]}
+    f.write("#elif defined(%(prefix)s_LOG_PROFILE)\n" % repl)
+    if record_type == "ENTER":
+        f.write("    uint64_t %(prefix)s_t0 = %(prefix)s_profile_now();\n" %
+                repl)
+    else:
+        f.write("    %(prefix)s_profile_record(%(id)d, "
+                "%(prefix)s_profile_now() - %(prefix)s_t0);\n" % repl)
+
+
+def generate_log_params(f, func, ctxt):
+    if not func.parameters or \
+       (func.parameters[0].pointer == 0 and
         func.parameters[0].type.name == "void"):
         return
     prefix = ctxt["prefix"]
     f.write("    %s_log_params_begin();\n" % (prefix,))
     for i, p in enumerate(func.parameters):
-        type = p.type_formatter()
-        name = p.name
-        if "[" in name:
-            idx = name.find("[")
-            type += " " + re.sub("[0-9]", "", name[idx:])
-            name = name[:idx]
+        name, type = parameter_name_type(p)
         formatter = get_type_formatter(func.name, name, type, ctxt)
         f.write("    errno = %s_bkp_errno;\n" % prefix)
         f.write("    %s(%s_log_fp, \"%s\", \"%s\", %s);\n" %
@@ -1655,12 +3089,7 @@ def generate_log_output_params(f, func, ctxt):
     prefix = ctxt["prefix"]
     f.write("    %s_log_params_output_begin();\n" % (prefix,))
     for i, p in enumerate(func.parameters):
-        type = p.type_formatter()
-        name = p.name
-        if "[" in name:
-            idx = name.find("[")
-            type += " " + re.sub("[0-9]", "", name[idx:])
-            name = name[:idx]
+        name, type = parameter_name_type(p)
 
         section = "func-%s" % (func.name,)
         key = "parameter-%s" % (name,)
@@ -1697,11 +3126,12 @@ def generate_log_output_params(f, func, ctxt):
     f.write("    %s_log_params_output_end();\n" % (prefix,))
 
 
-def generate_func(f, func, ctxt):
-    if func.parameters and func.parameters[-1].name == "...":
-        print "Ignored: %s() cannot handle variable arguments" % (func.name,)
-        return
+def generate_func_start(f, func, ctxt):
+    """Writes the wrapper up to the logging of the call.
 
+    That is the symbol lookup and the forwarding of calls that must not
+    be logged. Returns the replacements used by the rest of the wrapper.
+    """
     if func.ret_pointer > 0 or type_is_pointer(str(func.ret_type), ctxt):
         ret_default = "NULL"
     else:
@@ -1721,38 +3151,31 @@ def generate_func(f, func, ctxt):
     repl = {
         "prefix": prefix,
         "name": func.name,
+        "log_name": function_log_name(func, ctxt),
         "internal_name": "%s_f_%s" % (prefix, func.name),
         "ret_type": ret_type,
         "ret_name": ret_name,
         "ret_default": ret_default,
         "params_decl": func.parameters_str(),
         "params_names": func.parameters_names_str(),
+        "id": ctxt["function_ids"][func.name],
         }
     returns_value = ret_type != "void"
 
     f.write("""
 %(ret_type)s %(name)s(%(params_decl)s)
 {
-    static %(ret_type)s (*%(internal_name)s)(%(params_decl)s) = NULL;
+    %(prefix)s_SYM_DECL(%(ret_type)s (*)(%(params_decl)s), %(internal_name)s, %(id)d);
     int %(prefix)s_bkp_errno = errno;
 """ % repl)
     if returns_value:
         f.write("""\
     %(ret_type)s %(ret_name)s = %(ret_default)s;
-    %(prefix)s_GET_SYM(%(internal_name)s, \"%(name)s\", %(ret_name)s);
+    %(prefix)s_GET_SYM(%(internal_name)s, %(id)d, \"%(name)s\", %(ret_name)s);
 """ % repl)
     else:
-        f.write("    %(prefix)s_GET_SYM(%(internal_name)s, \"%(name)s\");\n" %
-                repl)
-
-    f.write("\n    %(prefix)s_log_enter_start(\"%(name)s\");\n" % repl)
-    generate_log_params(f, func, ctxt)
-    f.write("    %(prefix)s_log_enter_end(\"%(name)s\");\n" % repl)
-
-    f.write("\n    errno = %(prefix)s_bkp_errno;\n    " % repl)
-
-    if returns_value:
-        f.write("%s = " % (ret_name,))
+        f.write("    %(prefix)s_GET_SYM(%(internal_name)s, %(id)d, "
+                "\"%(name)s\");\n" % repl)
 
     override = None
     if ctxt["cfg"]:
@@ -1762,12 +3185,86 @@ def generate_func(f, func, ctxt):
             pass
     if override:
         repl["override"] = override
-        f.write("%(override)s(%(internal_name)s, %(params_names)s);\n" % repl)
+        call = "%(override)s(%(internal_name)s, %(params_names)s)" % repl
     else:
-        f.write("%(internal_name)s(%(params_names)s);\n" % repl)
+        call = "%(internal_name)s(%(params_names)s)" % repl
+    repl["call"] = call
+
+    if returns_value:
+        forward = "        return %(call)s;\n" % repl
+    else:
+        forward = "        %(call)s;\n        return;\n" % repl
+
+    f.write("\n")
+    f.write("#ifdef %(prefix)s_LOG_CONTROL\n" % repl)
+    f.write("    if (!%(prefix)s_ENABLED(%(id)d)) {\n" % repl)
+    f.write(forward)
+    f.write("    }\n#endif\n")
+    limit = ctxt["limited_functions"].get(func.name)
+    if limit:
+        repl["limit_index"] = limit[0]
+        f.write("    if (%(prefix)s_limits_suppress(%(limit_index)d)) {\n" %
+                repl)
+        f.write(forward)
+        f.write("    }\n")
+    return repl
+
+
+def generate_func(f, func, ctxt):
+    if ctxt.get("compact") and ctxt["compact_functions"].get(func.name):
+        generate_compact_func(f, func, ctxt)
+        return
+
+    repl = generate_func_start(f, func, ctxt)
+    prefix = repl["prefix"]
+    ret_type = repl["ret_type"]
+    ret_name = repl["ret_name"]
+    returns_value = ret_type != "void"
+    f.write("""\
+#ifdef %(prefix)s_LOG_COUNTERS
+    uint64_t %(prefix)s_counters_t0 = %(prefix)s_counters_enter(%(id)d);
+#endif
+""" % repl)
+    generate_binary_record(f, func, ctxt, "ENTER")
+    generate_profile_record(f, func, ctxt, "ENTER")
+    f.write("#else\n")
+    f.write("    %(prefix)s_log_enter_start(\"%(log_name)s\");\n" % repl)
+    generate_log_params(f, func, ctxt)
+    f.write("    %(prefix)s_log_enter_end(\"%(log_name)s\");\n" % repl)
+    f.write("#endif\n")
+
+    f.write("\n#ifdef %(prefix)s_LOG_CALL_TREE\n"
+            "    %(prefix)s_tree_push(%(id)d);\n"
+            "#endif\n" % repl)
+    f.write("    errno = %(prefix)s_bkp_errno;\n    " % repl)
+
+    if returns_value:
+        f.write("%s = " % (ret_name,))
+
+    f.write("%(call)s;\n" % repl)
 
     f.write("    %(prefix)s_bkp_errno = errno;\n" % repl)
-    f.write("\n    %(prefix)s_log_exit_start(\"%(name)s\");\n" % repl)
+    f.write("#ifdef %(prefix)s_LOG_CALL_TREE\n"
+            "    %(prefix)s_tree_pop(%(id)d);\n"
+            "#endif\n" % repl)
+    f.write("\n")
+
+    failure = None
+    if returns_value:
+        failure = get_return_failure(func, ret_type, ctxt)
+    repl["failure"] = failure or "0"
+    f.write("""\
+#ifdef %(prefix)s_LOG_COUNTERS
+    %(prefix)s_counters_exit(%(id)d, %(prefix)s_counters_t0, %(failure)s);
+#endif
+""" % repl)
+    if returns_value:
+        generate_binary_record(f, func, ctxt, "EXIT", ret_name)
+    else:
+        generate_binary_record(f, func, ctxt, "EXIT")
+    generate_profile_record(f, func, ctxt, "EXIT")
+    f.write("#else\n")
+    f.write("    %(prefix)s_log_exit_start(\"%(log_name)s\");\n" % repl)
     generate_log_params(f, func, ctxt)
 
     if returns_value:
@@ -1783,7 +3280,8 @@ def generate_func(f, func, ctxt):
                     (checker, prefix, ret_type, ret_name))
 
     generate_log_output_params(f, func, ctxt)
-    f.write("    %(prefix)s_log_exit_end(\"%(name)s\");\n" % repl)
+    f.write("    %(prefix)s_log_exit_end(\"%(log_name)s\");\n" % repl)
+    f.write("#endif\n")
 
     if returns_value:
         f.write("\n    errno = %(prefix)s_bkp_errno;\n" % repl)
@@ -1792,26 +3290,1130 @@ def generate_func(f, func, ctxt):
     f.write("}\n")
 
 
-def generate(outfile, ctxt):
-    f = open(outfile, "w")
+# builtin formatters compact wrappers know: name, C type of the value
+compact_formatters = [
+    ("int", "int"),
+    ("uint", "unsigned int"),
+    ("hex_int", "int"),
+    ("errno", "int"),
+    ("octal_int", "int"),
+    ("char", "char"),
+    ("uchar", "unsigned char"),
+    ("hex_char", "char"),
+    ("octal_char", "char"),
+    ("short", "short"),
+    ("ushort", "unsigned short"),
+    ("hex_short", "short"),
+    ("long", "long"),
+    ("ulong", "unsigned long"),
+    ("hex_long", "long"),
+    ("long_long", "long long"),
+    ("ulong_long", "unsigned long long"),
+    ("hex_long_long", "long long"),
+    ("bool", "int"),
+    ("string", "const char *"),
+    ("double", "double"),
+    ("pointer", "const void *"),
+    ]
+compact_formatter_names = set(name for name, ctype in compact_formatters)
+
+# builtin checkers compact wrappers know: name, C type of the value
+compact_checkers = [
+    ("null", "const void *"),
+    ("non_null", "const void *"),
+    ("zero", "long long"),
+    ("non_zero", "long long"),
+    ("false", "long long"),
+    ("true", "long long"),
+    ("errno", "long long"),
+    ]
+compact_checker_names = set(name for name, ctype in compact_checkers)
+
+
+def compact_formatter(formatter, kind, ctxt):
+    """Name of a builtin formatter usable with a raw value of kind, or None."""
+    start = "%s_log_fmt_" % (ctxt["prefix"],)
+    if kind is None or not formatter.startswith(start):
+        return None
+    name = formatter[len(start):]
+    if name not in compact_formatter_names:
+        return None
+    if (kind == "double") != (name == "double"):
+        return None
+    return name
+
 
+def compact_describe(func, ctxt):
+    """Table entry of func for compact wrappers.
+
+    Returns (params, ret_type, ret_formatter, ret_checker, output) or
+    None if func needs an open-coded wrapper: values that can't be
+    stored in 64 bits, custom formatters or checkers and output
+    parameters.
+    """
+    prefix = ctxt["prefix"]
+    cfg = ctxt["cfg"]
+    section = "func-%s" % (func.name,)
+    func.parameters_unnamed_fix(prefix + "_p_")
+
+    params = []
+    if func.has_parameters():
+        for p in func.parameters:
+            name, type = parameter_name_type(p)
+            if "[" in type:
+                kind = "pointer"
+            else:
+                kind = get_type_raw_kind(p.type, p.pointer, ctxt)
+            formatter = get_type_formatter(func.name, name, type, ctxt)
+            formatter = compact_formatter(formatter, kind, ctxt)
+            if not formatter:
+                return None
+            if cfg:
+                try:
+                    if cfg.get(section, "parameter-%s-return" % (name,)):
+                        return None
+                except Exception, e:
+                    pass
+            params.append((type, name, formatter))
+
+    ret_type = str(func.ret_type) + " *" * func.ret_pointer
+    ret_formatter = ret_checker = None
+    if ret_type != "void":
+        kind = get_type_raw_kind(func.ret_type, func.ret_pointer, ctxt)
+        formatter = get_type_formatter(func.name, "return", ret_type, ctxt)
+        ret_formatter = compact_formatter(formatter, kind, ctxt)
+        if not ret_formatter:
+            return None
+        checker = get_return_checker(func.name, ret_type, ctxt)
+        if checker:
+            start = "%s_log_checker_" % (prefix,)
+            if not checker.startswith(start):
+                return None
+            ret_checker = checker[len(start):]
+            if ret_checker not in compact_checker_names:
+                return None
+
+    output = bool(cfg) and func.has_parameters()
+    return params, ret_type, ret_formatter, ret_checker, output
+
+
+def compact_value(ctype, prefix):
+    """C expression converting the raw 64 bits word v to ctype."""
+    if ctype == "double":
+        return "%s_compact_to_double(v)" % (prefix,)
+    elif "*" in ctype:
+        return "(%s)(uintptr_t)v" % (ctype,)
+    return "(%s)v" % (ctype,)
+
+
+def generate_compact_runtime(f, ctxt):
+    """Table of functions and the code logging them for compact wrappers."""
+    prefix = ctxt["prefix"]
+    repl = {"prefix": prefix}
+
+    fmt_enum = []
+    fmt_cases = []
+    for name, ctype in compact_formatters:
+        fmt_enum.append("    %s_FMT_%s," % (prefix, name.upper()))
+        fmt_cases.append("""\
+    case %s_FMT_%s:
+        %s_log_fmt_%s(p, type, name, %s);
+        break;""" % (prefix, name.upper(), prefix, name,
+                     compact_value(ctype, prefix)))
+    check_enum = ["    %s_CHECK_NONE," % (prefix,)]
+    check_cases = []
+    for name, ctype in compact_checkers:
+        check_enum.append("    %s_CHECK_%s," % (prefix, name.upper()))
+        check_cases.append("""\
+    case %s_CHECK_%s:
+        %s_log_checker_%s(p, type, %s);
+        break;""" % (prefix, name.upper(), prefix, name,
+                     compact_value(ctype, prefix)))
+    repl["fmt_enum"] = "\n".join(fmt_enum)
+    repl["fmt_cases"] = "\n".join(fmt_cases)
+    repl["check_enum"] = "\n".join(check_enum)
+    repl["check_cases"] = "\n".join(check_cases)
+
+    # functions with the same parameters share their descriptions
+    param_tables = {}
+    tables = []
+    entries = []
+    for func in ctxt["functions"]:
+        desc = ctxt["compact_functions"].get(func.name)
+        if not desc:
+            entries.append("    {NULL, NULL, 0, 0, 0, 0, NULL}, "
+                           "/* %s, open-coded */" % (func.name,))
+            continue
+        params, ret_type, ret_formatter, ret_checker, output = desc
+        key = tuple(params)
+        table = "NULL"
+        if params:
+            table = param_tables.get(key)
+            if not table:
+                table = "%s_compact_params_%d" % (prefix, len(param_tables))
+                param_tables[key] = table
+                tables.append("%s_SHARED const struct %s_compact_param "
+                              "%s[] = {" % (prefix, prefix, table))
+                for type, name, formatter in params:
+                    tables.append("    {\"%s\", \"%s\", %s_FMT_%s}," %
+                                  (type, name, prefix, formatter.upper()))
+                tables.append("};")
+        flags = []
+        if ret_formatter:
+            flags.append("%s_COMPACT_RETURNS" % (prefix,))
+        if output:
+            flags.append("%s_COMPACT_OUTPUT" % (prefix,))
+        entries.append("    {\"%s\", %s, %d, %s_FMT_%s, %s_CHECK_%s, %s, "
+                       "\"%s\"}," %
+                       (function_log_name(func, ctxt), table, len(params),
+                        prefix,
+                        (ret_formatter or "int").upper(), prefix,
+                        (ret_checker or "none").upper(),
+                        " | ".join(flags) or "0", ret_type))
+    tables.append("%(prefix)s_SHARED const struct "
+                  "%(prefix)s_compact_function "
+                  "%(prefix)s_compact_functions[%(prefix)s_N_FUNCTIONS + 1] "
+                  "= {" % repl)
+    tables.extend(entries)
+    tables.append("    {NULL, NULL, 0, 0, 0, 0, NULL}")
+    tables.append("};")
+    repl["tables"] = "\n".join(tables)
+
+    f.write("""
+/* Compact wrappers, see liblogger.py --compact. Wrappers store their
+ * arguments as raw 64 bits words and the functions below log them as
+ * described by %(prefix)s_compact_functions, instead of open-coding the
+ * logging in every wrapper.
+ */
+#include <stdint.h>
+#include <string.h>
+
+enum %(prefix)s_compact_formatter {
+%(fmt_enum)s
+};
+
+enum %(prefix)s_compact_checker {
+%(check_enum)s
+};
+
+#define %(prefix)s_COMPACT_RETURNS 1
+#define %(prefix)s_COMPACT_OUTPUT 2 /* empty output-parameters=() */
+
+struct %(prefix)s_compact_param {
+    const char *type;
+    const char *name;
+    unsigned char formatter;
+};
+
+struct %(prefix)s_compact_function {
+    const char *name;
+    const struct %(prefix)s_compact_param *params;
+    unsigned char n_params;
+    unsigned char ret_formatter;
+    unsigned char ret_checker;
+    unsigned char flags;
+    const char *ret_type;
+};
+
+%(tables)s
+
+static inline uint64_t %(prefix)s_compact_double(double value)
+{
+    uint64_t raw;
+    memcpy(&raw, &value, sizeof(raw));
+    return raw;
+}
+
+static inline double %(prefix)s_compact_to_double(uint64_t raw)
+{
+    double value;
+    memcpy(&value, &raw, sizeof(value));
+    return value;
+}
+
+static void %(prefix)s_compact_fmt(FILE *p, unsigned int formatter, const char *type, const char *name, uint64_t v)
+{
+    switch (formatter) {
+%(fmt_cases)s
+    }
+}
+
+static void %(prefix)s_compact_check(FILE *p, unsigned int checker, const char *type, uint64_t v)
+{
+    switch (checker) {
+%(check_cases)s
+    }
+}
+
+static void %(prefix)s_compact_log_params(const struct %(prefix)s_compact_function *d, const uint64_t *args, int error)
+{
+    unsigned int i;
+
+    if (!d->n_params)
+        return;
+    %(prefix)s_log_params_begin();
+    for (i = 0; i < d->n_params; i++) {
+        if (i)
+            %(prefix)s_log_param_continue();
+        errno = error;
+        %(prefix)s_compact_fmt(%(prefix)s_log_fp, d->params[i].formatter,
+                               d->params[i].type, d->params[i].name, args[i]);
+    }
+    %(prefix)s_log_params_end();
+}
+
+static void %(prefix)s_compact_enter(unsigned int id, const uint64_t *args, int error, uint64_t *t0)
+{
+    const struct %(prefix)s_compact_function *d = %(prefix)s_compact_functions + id;
+
+#ifdef %(prefix)s_LOG_COUNTERS
+    t0[0] = %(prefix)s_counters_enter(id);
+#endif
+#ifdef %(prefix)s_LOG_BINARY
+    {
+        struct %(prefix)s_binary_record *rec =
+            %(prefix)s_binary_reserve(id, %(prefix)s_BINARY_ENTER, error);
+        if (rec) {
+            if (d->n_params)
+                memcpy(rec->args, args, d->n_params * sizeof(uint64_t));
+            rec->ret = 0;
+            %(prefix)s_binary_commit(rec, d->n_params);
+        }
+    }
+#elif defined(%(prefix)s_LOG_PROFILE)
+    t0[1] = %(prefix)s_profile_now();
+#else
+    %(prefix)s_log_enter_start(d->name);
+    %(prefix)s_compact_log_params(d, args, error);
+    %(prefix)s_log_enter_end(d->name);
+#endif
+#ifdef %(prefix)s_LOG_CALL_TREE
+    %(prefix)s_tree_push(id);
+#endif
+    (void)d;
+    (void)args;
+    (void)error;
+    (void)t0;
+}
+
+static void %(prefix)s_compact_exit(unsigned int id, const uint64_t *args, uint64_t ret, int error, const uint64_t *t0, int failed)
+{
+    const struct %(prefix)s_compact_function *d = %(prefix)s_compact_functions + id;
+
+#ifdef %(prefix)s_LOG_CALL_TREE
+    %(prefix)s_tree_pop(id);
+#endif
+#ifdef %(prefix)s_LOG_COUNTERS
+    %(prefix)s_counters_exit(id, t0[0], failed);
+#endif
+#ifdef %(prefix)s_LOG_BINARY
+    {
+        struct %(prefix)s_binary_record *rec =
+            %(prefix)s_binary_reserve(id, %(prefix)s_BINARY_EXIT, error);
+        if (rec) {
+            if (d->n_params)
+                memcpy(rec->args, args, d->n_params * sizeof(uint64_t));
+            rec->ret = ret;
+            %(prefix)s_binary_commit(rec, d->n_params);
+        }
+    }
+#elif defined(%(prefix)s_LOG_PROFILE)
+    %(prefix)s_profile_record(id, %(prefix)s_profile_now() - t0[1]);
+#else
+    %(prefix)s_log_exit_start(d->name);
+    %(prefix)s_compact_log_params(d, args, error);
+    if (d->flags & %(prefix)s_COMPACT_RETURNS) {
+        %(prefix)s_log_exit_return();
+        errno = error;
+        %(prefix)s_compact_fmt(%(prefix)s_log_fp, d->ret_formatter,
+                               d->ret_type, NULL, ret);
+        if (d->ret_checker) {
+            errno = error;
+            %(prefix)s_compact_check(%(prefix)s_log_fp, d->ret_checker,
+                                     d->ret_type, ret);
+        }
+    }
+    if (d->flags & %(prefix)s_COMPACT_OUTPUT) {
+        %(prefix)s_log_params_output_begin();
+        %(prefix)s_log_params_output_end();
+    }
+    %(prefix)s_log_exit_end(d->name);
+#endif
+    (void)d;
+    (void)args;
+    (void)ret;
+    (void)error;
+    (void)t0;
+    (void)failed;
+}
+""" % repl)
+
+
+def generate_compact_func(f, func, ctxt):
+    repl = generate_func_start(f, func, ctxt)
+    prefix = repl["prefix"]
+    ret_type = repl["ret_type"]
+    ret_name = repl["ret_name"]
+    returns_value = ret_type != "void"
+
+    args = []
+    if func.has_parameters():
+        for p in func.parameters:
+            name, type = parameter_name_type(p)
+            if "[" in type:
+                kind = "pointer"
+            else:
+                kind = get_type_raw_kind(p.type, p.pointer, ctxt)
+            args.append(raw_value(name, kind, prefix, "compact_double"))
+    if args:
+        repl["args"] = ", ".join(args)
+        f.write("    uint64_t %(prefix)s_args[] = {%(args)s};\n" % repl)
+    else:
+        f.write("    const uint64_t *%(prefix)s_args = NULL;\n" % repl)
+    f.write("    uint64_t %(prefix)s_t0[2] = {0, 0};\n" % repl)
+    generate_binary_sizes_record(f, func, ctxt)
+    f.write("    %(prefix)s_compact_enter(%(id)d, %(prefix)s_args, "
+            "%(prefix)s_bkp_errno, %(prefix)s_t0);\n" % repl)
+
+    f.write("    errno = %(prefix)s_bkp_errno;\n    " % repl)
+    if returns_value:
+        f.write("%s = " % (ret_name,))
+    f.write("%(call)s;\n" % repl)
+    f.write("    %(prefix)s_bkp_errno = errno;\n" % repl)
+
+    if returns_value:
+        kind = get_type_raw_kind(func.ret_type, func.ret_pointer, ctxt)
+        repl["ret"] = raw_value(ret_name, kind, prefix, "compact_double")
+        repl["failure"] = get_return_failure(func, ret_type, ctxt) or "0"
+    else:
+        repl["ret"] = "0"
+        repl["failure"] = "0"
+    f.write("    %(prefix)s_compact_exit(%(id)d, %(prefix)s_args, %(ret)s, "
+            "%(prefix)s_bkp_errno, %(prefix)s_t0, %(failure)s);\n" % repl)
+
+    if returns_value:
+        f.write("\n    errno = %(prefix)s_bkp_errno;\n" % repl)
+        f.write("    return %s;\n" % (ret_name,))
+    f.write("}\n")
+
+
+def select_functions(ctxt, report=False):
+    """Functions to wrap, sorted by name. Their index is the function id."""
     cfg = ctxt["cfg"]
     fignore_regexp = config_get_regexp(cfg, "global", "ignore-functions-regexp")
     fselect_regexp = config_get_regexp(cfg, "global", "select-functions-regexp")
 
-    generate_preamble(f, ctxt)
     funcs = ctxt["header_contents"]["function"].items()
     funcs.sort(cmp=lambda a, b: cmp(a[0], b[0]))
+    selected = []
     for name, func in funcs:
         if fignore_regexp and fignore_regexp.match(name):
-            print "Ignoring %s as requested" % (name,)
+            if report:
+                print "Ignoring %s as requested" % (name,)
             continue
         elif fselect_regexp and not fselect_regexp.match(name):
             continue
-        generate_func(f, func, ctxt)
+        elif func.parameters and func.parameters[-1].name == "...":
+            if report:
+                print "Ignored: %s() cannot handle variable arguments" % \
+                      (name,)
+            continue
+        selected.append(func)
+    return selected
+
+
+def get_function_limits(func, ctxt):
+    """(sample-rate, max-calls-per-second) of func, 0 if not limited."""
+    cfg = ctxt["cfg"]
+    section = "func-%s" % (func.name,)
+    limits = []
+    for key in ("sample-rate", "max-calls-per-second"):
+        value = 0
+        if cfg and cfg.has_option(section, key):
+            try:
+                value = cfg.getint(section, key)
+            except ValueError, e:
+                print "Ignoring %s/%s: %s" % (section, key, e)
+            if value < 0:
+                print "Ignoring %s/%s: must be positive" % (section, key)
+                value = 0
+        limits.append(value)
+    if limits[0] == 1:
+        limits[0] = 0 # every call is sampled
+    return tuple(limits)
+
+
+def select_limited_functions(ctxt):
+    """Maps names of functions with limits to (index, rate, max)."""
+    limited = {}
+    for func in ctxt["functions"]:
+        rate, max_calls = get_function_limits(func, ctxt)
+        if rate or max_calls:
+            limited[func.name] = (len(limited), rate, max_calls)
+    return limited
+
+
+def generate_limits_runtime(ctxt):
+    limited = ctxt["limited_functions"]
+    if not limited:
+        return ""
+
+    entries = limited.items()
+    entries.sort(key=lambda x: x[1][0])
+    limits = []
+    for name, (index, rate, max_calls) in entries:
+        limits.append("    {%d, %d, %d}, /* %s */" %
+                      (ctxt["function_ids"][name], rate, max_calls, name))
+    repl = {"prefix": ctxt["prefix"],
+            "n_limited": len(limited),
+            "limits": "\n".join(limits),
+            }
+    return """
+/* Functions with sample-rate or max-calls-per-second configured skip
+ * logging for some calls, counted per thread and reported at exit.
+ */
+#include <stdint.h>
+#include <stdlib.h>
+#include <time.h>
+
+#define %(prefix)s_N_LIMITED %(n_limited)d
+
+static const struct {
+    unsigned int function;
+    unsigned int sample_rate;
+    unsigned int max_per_second;
+} %(prefix)s_limits[%(prefix)s_N_LIMITED] = {
+%(limits)s
+};
+
+struct %(prefix)s_limits_thread {
+    uint64_t calls[%(prefix)s_N_LIMITED];
+    uint64_t suppressed[%(prefix)s_N_LIMITED];
+    unsigned int sample[%(prefix)s_N_LIMITED];
+    unsigned int second_calls[%(prefix)s_N_LIMITED];
+    time_t second[%(prefix)s_N_LIMITED];
+    struct %(prefix)s_limits_thread *next;
+};
+
+%(prefix)s_SHARED struct %(prefix)s_limits_thread *%(prefix)s_limits_threads = NULL;
+%(prefix)s_SHARED %(prefix)s_THREAD_LOCAL struct %(prefix)s_limits_thread *%(prefix)s_limits_self = NULL;
+
+static struct %(prefix)s_limits_thread *%(prefix)s_limits_thread_new(void)
+{
+    struct %(prefix)s_limits_thread *t = calloc(1, sizeof(*t));
+    if (!t)
+        return NULL;
+    t->next = __atomic_load_n(&%(prefix)s_limits_threads, __ATOMIC_RELAXED);
+    while (!__atomic_compare_exchange_n(&%(prefix)s_limits_threads, &t->next,
+                                        t, 0, __ATOMIC_RELEASE,
+                                        __ATOMIC_RELAXED))
+        ;
+    %(prefix)s_limits_self = t;
+    return t;
+}
+
+/* returns 1 if this call should not be logged */
+static inline int %(prefix)s_limits_suppress(unsigned int idx)
+{
+    struct %(prefix)s_limits_thread *t = %(prefix)s_limits_self;
+    unsigned int rate = %(prefix)s_limits[idx].sample_rate;
+    unsigned int max = %(prefix)s_limits[idx].max_per_second;
+
+    if (!t) {
+        t = %(prefix)s_limits_thread_new();
+        if (!t)
+            return 0;
+    }
+    t->calls[idx]++;
+
+    if (rate) {
+        if (t->sample[idx]++ %% rate != 0)
+            goto suppress;
+    }
+    if (max) {
+        struct timespec spec;
+        clock_gettime(CLOCK_MONOTONIC_COARSE, &spec);
+        if (spec.tv_sec != t->second[idx]) {
+            t->second[idx] = spec.tv_sec;
+            t->second_calls[idx] = 0;
+        }
+        if (++t->second_calls[idx] > max)
+            goto suppress;
+    }
+    return 0;
+
+ suppress:
+    t->suppressed[idx]++;
+    return 1;
+}
+
+%(prefix)s_DESTRUCTOR
+static void %(prefix)s_limits_report(void)
+{
+    const struct %(prefix)s_limits_thread *t;
+    unsigned int i;
+    FILE *fp;
+
+#ifdef %(prefix)s_LOG_BINARY
+    fp = stderr;
+#else
+    %(prefix)s_LOG_PREPARE;
+    fp = %(prefix)s_log_fp;
+#endif
+
+    for (i = 0; i < %(prefix)s_N_LIMITED; i++) {
+        uint64_t calls = 0, suppressed = 0;
+        t = __atomic_load_n(&%(prefix)s_limits_threads, __ATOMIC_ACQUIRE);
+        for (; t != NULL; t = t->next) {
+            calls += t->calls[i];
+            suppressed += t->suppressed[i];
+        }
+        if (!suppressed)
+            continue;
+        fprintf(fp, \"LOG! %%s: %%llu of %%llu calls not logged \"
+                \"(sample-rate=%%u, max-calls-per-second=%%u)\\n\",
+                %(prefix)s_function_names[%(prefix)s_limits[i].function],
+                (unsigned long long)suppressed, (unsigned long long)calls,
+                %(prefix)s_limits[i].sample_rate,
+                %(prefix)s_limits[i].max_per_second);
+    }
+    fflush(fp);
+}
+""" % repl
+
+
+def generate_dl_runtime(ctxt):
+    """Opening of the wrapped library and lookup of its symbols.
+
+    Modules wrapping several libraries (see generate()) have a handle
+    per library and find the library of each function in the table of
+    functions.
+    """
+    repl = {"prefix": ctxt["prefix"],
+            "libname": ctxt["libname"],
+            }
+    if ctxt.get("libraries"):
+        return """\
+/* Libraries are dlopen()ed on demand, symbols are looked up in the
+ * library of their function, see %(prefix)s_function_libraries.
+ */
+%(prefix)s_SHARED void *%(prefix)s_dl_handles[%(prefix)s_N_LIBRARIES];
+
+static unsigned char %(prefix)s_dl_prepare(unsigned int lib)
+{
+    unsigned char ok;
+
+    %(prefix)s_THREADS_INIT;
+
+    %(prefix)s_LOCK;
+    ok = !!%(prefix)s_dl_handles[lib];
+    if (!ok) {
+        char *errmsg;
+        %(prefix)s_dl_handles[lib] = dlopen(%(prefix)s_library_names[lib],
+                                            RTLD_LAZY);
+        errmsg = dlerror();
+        if (errmsg) {
+            %(prefix)s_dl_handles[lib] = NULL;
+            fprintf(stderr,
+                    %(prefix)s_COLOR_ERROR
+                    \"ERROR: could not dlopen(%%s): %%s\\n\"
+                    %(prefix)s_COLOR_CLEAR,
+                    %(prefix)s_library_names[lib], errmsg);
+        }
+        ok = !!%(prefix)s_dl_handles[lib];
+    }
+    %(prefix)s_UNLOCK;
+
+    return ok;
+}
+
+#ifdef %(prefix)s_LAZY_SYMBOLS
+/* symbols are looked up on first call, for libraries that are
+ * dlopen()ed after the program started.
+ */
+#define %(prefix)s_SYM_DECL(type, v, id) static __typeof__(type) v = NULL
+#define %(prefix)s_GET_SYM(v, id, name, ...) \\
+    do { \\
+        if (!v) { \\
+            unsigned int %(prefix)s_dl_lib = %(prefix)s_function_libraries[id]; \\
+            if (!%(prefix)s_dl_handles[%(prefix)s_dl_lib]) { \\
+                if (!%(prefix)s_dl_prepare(%(prefix)s_dl_lib)) \\
+                    return __VA_ARGS__; \\
+            } \\
+            %(prefix)s_LOCK; \\
+            if (!v) { \\
+                char *%(prefix)s_dl_err; \\
+                v = dlsym(%(prefix)s_dl_handles[%(prefix)s_dl_lib], name); \\
+                %(prefix)s_dl_err = dlerror(); \\
+                if (%(prefix)s_dl_err) { \\
+                    fprintf(stderr, \\
+                            %(prefix)s_COLOR_ERROR \\
+                            \"ERROR: could not dlsym(%%s): %%s\\n\" \\
+                            %(prefix)s_COLOR_CLEAR, \\
+                            name, %(prefix)s_dl_err); \\
+                } \\
+            } \\
+            %(prefix)s_UNLOCK; \\
+            if (!v) \\
+                return __VA_ARGS__; \\
+        } \\
+    } while (0)
+#else
+/* all symbols are looked up once, when this library is loaded, and
+ * calls just read them from the table. Missing symbols are reported
+ * at load time and calls to them return the default value. Libraries
+ * that could not be opened are tried again on the next call of one of
+ * their functions.
+ */
+%(prefix)s_SHARED void *%(prefix)s_symbols[%(prefix)s_N_FUNCTIONS + 1];
+%(prefix)s_SHARED unsigned char %(prefix)s_symbols_loaded = 0;
+%(prefix)s_SHARED unsigned char %(prefix)s_library_loaded[%(prefix)s_N_LIBRARIES];
+
+static void %(prefix)s_symbols_load(void)
+{
+    unsigned int i, lib, opened = 0;
+    unsigned int missing[%(prefix)s_N_LIBRARIES];
+    unsigned int total[%(prefix)s_N_LIBRARIES];
+
+    for (lib = 0; lib < %(prefix)s_N_LIBRARIES; lib++) {
+        missing[lib] = total[lib] = 0;
+        if (%(prefix)s_dl_handles[lib] || %(prefix)s_dl_prepare(lib))
+            opened++;
+    }
+    if (!opened)
+        return;
+
+    %(prefix)s_LOCK;
+    if (!%(prefix)s_symbols_loaded) {
+        for (i = 0; i < %(prefix)s_N_FUNCTIONS; i++) {
+            char *err;
+            lib = %(prefix)s_function_libraries[i];
+            if (%(prefix)s_library_loaded[lib] || !%(prefix)s_dl_handles[lib])
+                continue;
+            total[lib]++;
+            dlerror();
+            %(prefix)s_symbols[i] = dlsym(%(prefix)s_dl_handles[lib],
+                                          %(prefix)s_function_symbols[i]);
+            err = dlerror();
+            if (err) {
+                %(prefix)s_symbols[i] = NULL;
+                fprintf(stderr,
+                        %(prefix)s_COLOR_ERROR
+                        \"ERROR: could not dlsym(%%s): %%s\\n\"
+                        %(prefix)s_COLOR_CLEAR,
+                        %(prefix)s_function_names[i], err);
+                missing[lib]++;
+            }
+        }
+        for (lib = 0; lib < %(prefix)s_N_LIBRARIES; lib++) {
+            if (%(prefix)s_library_loaded[lib] || !%(prefix)s_dl_handles[lib])
+                continue;
+            if (missing[lib])
+                fprintf(stderr,
+                        %(prefix)s_COLOR_ERROR
+                        \"ERROR: %%u of %%u symbols missing from %%s\\n\"
+                        %(prefix)s_COLOR_CLEAR,
+                        missing[lib], total[lib],
+                        %(prefix)s_library_names[lib]);
+            %(prefix)s_library_loaded[lib] = 1;
+        }
+        if (opened == %(prefix)s_N_LIBRARIES)
+            __atomic_store_n(&%(prefix)s_symbols_loaded, 1, __ATOMIC_RELEASE);
+    }
+    %(prefix)s_UNLOCK;
+}
+
+%(prefix)s_CONSTRUCTOR
+static void %(prefix)s_symbols_init(void)
+{
+    %(prefix)s_symbols_load();
+}
+
+#define %(prefix)s_SYM_DECL(type, v, id) __typeof__(type) v = %(prefix)s_symbols[id]
+/* only called before the constructor ran, ie: from other constructors,
+ * or if the library of the function could not be opened.
+ */
+#define %(prefix)s_GET_SYM(v, id, name, ...) \\
+    do { \\
+        if (!v) { \\
+            if (!__atomic_load_n(&%(prefix)s_symbols_loaded, \\
+                                 __ATOMIC_ACQUIRE)) { \\
+                %(prefix)s_symbols_load(); \\
+                v = %(prefix)s_symbols[id]; \\
+            } \\
+            if (!v) \\
+                return __VA_ARGS__; \\
+        } \\
+    } while (0)
+#endif
+""" % repl
+    return """\
+%(prefix)s_SHARED void *%(prefix)s_dl_handle = NULL;
+
+static unsigned char %(prefix)s_dl_prepare(void)
+{
+    unsigned char ok;
+
+    %(prefix)s_THREADS_INIT;
+
+    %(prefix)s_LOCK;
+    ok = !!%(prefix)s_dl_handle;
+    if (!ok) {
+        char *errmsg;
+        %(prefix)s_dl_handle = dlopen(\"%(libname)s\", RTLD_LAZY);
+        errmsg = dlerror();
+        if (errmsg) {
+            %(prefix)s_dl_handle = NULL;
+            fprintf(stderr,
+                    %(prefix)s_COLOR_ERROR
+                    \"ERROR: could not dlopen(%(libname)s): %%s\\n\"
+                    %(prefix)s_COLOR_CLEAR, errmsg);
+        }
+        ok = !!%(prefix)s_dl_handle;
+    }
+    %(prefix)s_UNLOCK;
+
+    return ok;
+}
+
+#ifdef %(prefix)s_LAZY_SYMBOLS
+/* symbols are looked up on first call, for libraries that are
+ * dlopen()ed after the program started.
+ */
+#define %(prefix)s_SYM_DECL(type, v, id) static __typeof__(type) v = NULL
+#define %(prefix)s_GET_SYM(v, id, name, ...) \\
+    do { \\
+        if (!v) { \\
+            if (!%(prefix)s_dl_handle) { \\
+                if (!%(prefix)s_dl_prepare()) \\
+                    return __VA_ARGS__; \\
+            } \\
+            %(prefix)s_LOCK; \\
+            if (!v) { \\
+                char *%(prefix)s_dl_err; \\
+                v = dlsym(%(prefix)s_dl_handle, name); \\
+                %(prefix)s_dl_err = dlerror(); \\
+                if (%(prefix)s_dl_err) { \\
+                    fprintf(stderr, \\
+                            %(prefix)s_COLOR_ERROR \\
+                            \"ERROR: could not dlsym(%%s): %%s\\n\" \\
+                            %(prefix)s_COLOR_CLEAR, \\
+                            name, %(prefix)s_dl_err); \\
+                } \\
+            } \\
+            %(prefix)s_UNLOCK; \\
+            if (!v) \\
+                return __VA_ARGS__; \\
+        } \\
+    } while (0)
+#else
+/* all symbols are looked up once, when this library is loaded, and
+ * calls just read them from the table. Missing symbols are reported
+ * at load time and calls to them return the default value.
+ */
+%(prefix)s_SHARED void *%(prefix)s_symbols[%(prefix)s_N_FUNCTIONS + 1];
+%(prefix)s_SHARED unsigned char %(prefix)s_symbols_loaded = 0;
+
+static void %(prefix)s_symbols_load(void)
+{
+    unsigned int i, missing = 0;
+
+    if (!%(prefix)s_dl_handle) {
+        if (!%(prefix)s_dl_prepare())
+            return;
+    }
+
+    %(prefix)s_LOCK;
+    if (!%(prefix)s_symbols_loaded) {
+        for (i = 0; i < %(prefix)s_N_FUNCTIONS; i++) {
+            char *err;
+            dlerror();
+            %(prefix)s_symbols[i] = dlsym(%(prefix)s_dl_handle,
+                                          %(prefix)s_function_names[i]);
+            err = dlerror();
+            if (err) {
+                %(prefix)s_symbols[i] = NULL;
+                fprintf(stderr,
+                        %(prefix)s_COLOR_ERROR
+                        \"ERROR: could not dlsym(%%s): %%s\\n\"
+                        %(prefix)s_COLOR_CLEAR,
+                        %(prefix)s_function_names[i], err);
+                missing++;
+            }
+        }
+        if (missing)
+            fprintf(stderr,
+                    %(prefix)s_COLOR_ERROR
+                    \"ERROR: %%u of %%u symbols missing from %(libname)s\\n\"
+                    %(prefix)s_COLOR_CLEAR,
+                    missing, %(prefix)s_N_FUNCTIONS);
+        __atomic_store_n(&%(prefix)s_symbols_loaded, 1, __ATOMIC_RELEASE);
+    }
+    %(prefix)s_UNLOCK;
+}
+
+%(prefix)s_CONSTRUCTOR
+static void %(prefix)s_symbols_init(void)
+{
+    %(prefix)s_symbols_load();
+}
+
+#define %(prefix)s_SYM_DECL(type, v, id) __typeof__(type) v = %(prefix)s_symbols[id]
+/* only called before the constructor ran, ie: from other constructors */
+#define %(prefix)s_GET_SYM(v, id, name, ...) \\
+    do { \\
+        if (!v) { \\
+            if (!__atomic_load_n(&%(prefix)s_symbols_loaded, \\
+                                 __ATOMIC_ACQUIRE)) { \\
+                %(prefix)s_symbols_load(); \\
+                v = %(prefix)s_symbols[id]; \\
+            } \\
+            if (!v) \\
+                return __VA_ARGS__; \\
+        } \\
+    } while (0)
+#endif
+""" % repl
+
+
+def generate_function_table(ctxt):
+    funcs = ctxt["functions"]
+    max_args = 1
+    name_size = 8 # with the trailing NUL, multiple of 8
+    for func in funcs:
+        if func.has_parameters():
+            max_args = max(max_args, len(func.parameters))
+        name = function_log_name(func, ctxt)
+        name_size = max(name_size, (len(name) + 8) & ~7)
+
+    lines = ["#define %s_N_FUNCTIONS %d" % (ctxt["prefix"], len(funcs)),
+             "#define %s_FUNCTION_NAME_SIZE %d" % (ctxt["prefix"], name_size),
+             "#define %s_LOG_BINARY_MAX_ARGS %d" % (ctxt["prefix"], max_args),
+             "static const char *const %s_function_names[%s_N_FUNCTIONS + 1] "
+             "__attribute__((unused)) = {" % (ctxt["prefix"], ctxt["prefix"])]
+    for func in funcs:
+        lines.append("    \"%s\"," % (function_log_name(func, ctxt),))
+    lines.append("    NULL")
+    lines.append("};")
+
+    libraries = ctxt.get("libraries")
+    if libraries:
+        prefix = ctxt["prefix"]
+        lines.append("#define %s_N_LIBRARIES %d" % (prefix, len(libraries)))
+        lines.append("static const char *const "
+                     "%s_library_names[%s_N_LIBRARIES] "
+                     "__attribute__((unused)) = {" % (prefix, prefix))
+        for lib in libraries:
+            lines.append("    \"%s\"," % (lib["libname"],))
+        lines.append("};")
+        # dlsym() needs the names without namespace
+        lines.append("static const char *const "
+                     "%s_function_symbols[%s_N_FUNCTIONS + 1] "
+                     "__attribute__((unused)) = {" % (prefix, prefix))
+        for func in funcs:
+            lines.append("    \"%s\"," % (func.name,))
+        lines.append("    NULL")
+        lines.append("};")
+        index = dict((id(lib), i) for i, lib in enumerate(libraries))
+        lines.append("static const unsigned short "
+                     "%s_function_libraries[%s_N_FUNCTIONS + 1] "
+                     "__attribute__((unused)) = {" % (prefix, prefix))
+        for func in funcs:
+            lib = function_context(func, ctxt)
+            lines.append("    %d, /* %s */" % (index[id(lib)], func.name))
+        lines.append("    0")
+        lines.append("};")
+    return "\n".join(lines) + "\n"
+
+
+def function_context(func, ctxt):
+    """Context of the library func comes from, see generate()."""
+    return ctxt.get("function_contexts", {}).get(func.name, ctxt)
+
+
+def function_log_name(func, ctxt):
+    """Name of func in logs and traces, namespaced by its library in
+    modules wrapping several libraries.
+    """
+    return ctxt.get("log_names", {}).get(func.name, func.name)
+
+
+def library_namespace(libname):
+    """Namespace of libname functions in modules, libfoo-1.so.2 is foo_1."""
+    name = prefix_from_libname(libname)[len("_log_"):]
+    return re.sub("[^A-Za-z0-9_]", "_", name)
+
+
+def shard_of(name, n_shards):
+    """Shard of a function, stable across runs, platforms and versions."""
+    return (zlib.crc32(name) & 0xffffffff) % n_shards
+
+
+def shard_paths(outfile, n_shards):
+    """(internal header, shard sources) of a sharded outfile."""
+    base = os.path.splitext(outfile)[0]
+    return ("%s-internal.h" % (base,),
+            ["%s-%d.c" % (base, i) for i in xrange(n_shards)])
+
+
+def write_if_changed(filename, contents):
+    """Write filename unless it already has contents, keeping its mtime."""
+    try:
+        f = open(filename)
+        old = f.read()
+        f.close()
+        if old == contents:
+            return False
+    except IOError, e:
+        pass
+    f = open(filename, "w")
+    f.write(contents)
+    f.close()
+    return True
+
+
+def generate_shards(outfile, ctxt):
+    """Split the wrappers of ctxt["functions"] in ctxt["shards"] files.
+
+    The runtime goes to an internal header included by all of them and
+    outfile only instantiates its constructors and destructors, so
+    shards can be compiled in parallel and linked in a single library.
+    Functions go to shards by a hash of their name, files whose contents
+    didn't change are not rewritten and so not rebuilt.
+    """
+    prefix = ctxt["prefix"]
+    header, sources = shard_paths(outfile, ctxt["shards"])
+    include = os.path.basename(header)
+
+    f = StringIO.StringIO()
+    f.write("#ifndef %s_INTERNAL_H\n#define %s_INTERNAL_H\n\n"
+            "#define %s_SHARDED 1\n" % (prefix, prefix, prefix))
+    generate_preamble(f, ctxt)
+    if ctxt.get("compact"):
+        generate_compact_runtime(f, ctxt)
+    f.write("\n#endif /* %s_INTERNAL_H */\n" % (prefix,))
+    write_if_changed(header, f.getvalue())
+
+    banner = "/* this file was auto-generated from %s by %s. */\n" % \
+             (ctxt["header"], progname)
+    write_if_changed(outfile,
+                     "%s\n#define %s_RUNTIME 1\n#include \"%s\"\n" %
+                     (banner, prefix, include))
+
+    shards = [[] for source in sources]
+    for func in ctxt["functions"]:
+        shards[shard_of(func.name, len(sources))].append(func)
+    for source, funcs in zip(sources, shards):
+        f = StringIO.StringIO()
+        f.write("%s\n#include \"%s\"\n" % (banner, include))
+        for func in funcs:
+            generate_func(f, func, function_context(func, ctxt))
+        write_if_changed(source, f.getvalue())
+
+
+def select_module_functions(ctxt, report=False):
+    """Functions of every library in ctxt["libraries"], by library.
+
+    Each function is tied to the context of its library, their names
+    are namespaced by library in logs and traces. A function can be
+    wrapped only once per module, the first library declaring it wins.
+    """
+    funcs = []
+    contexts = {}
+    log_names = {}
+    namespaces = {}
+    for lib in ctxt["libraries"]:
+        namespace = library_namespace(lib["libname"])
+        if namespace in namespaces:
+            raise ValueError("%s and %s have the same namespace: %s" %
+                             (namespaces[namespace], lib["libname"],
+                              namespace))
+        namespaces[namespace] = lib["libname"]
+        for func in select_functions(lib, report):
+            other = contexts.get(func.name)
+            if other:
+                if report:
+                    print "Ignored: %s() of %s is wrapped for %s" % \
+                          (func.name, lib["libname"], other["libname"])
+                continue
+            contexts[func.name] = lib
+            log_names[func.name] = "%s:%s" % (namespace, func.name)
+            funcs.append(func)
+    for lib in ctxt["libraries"]:
+        lib["function_contexts"] = contexts
+        lib["log_names"] = log_names
+    return funcs
+
+
+def generate(outfile, ctxt):
+    """Write the wrappers of the functions selected in ctxt.
+
+    If ctxt["libraries"] lists the contexts of several libraries (ctxt
+    being the first one), a single module wraps all of them: one runtime
+    with a handle per library.
+    """
+    if ctxt.get("libraries"):
+        funcs = select_module_functions(ctxt, report=True)
+    else:
+        funcs = select_functions(ctxt, report=True)
+    ctxt["functions"] = funcs
+    ctxt["function_ids"] = dict((func.name, i) for i, func in enumerate(funcs))
+    ctxt["limited_functions"] = select_limited_functions(ctxt)
+    ctxt["compact_functions"] = {}
+    if ctxt.get("compact"):
+        for func in funcs:
+            ctxt["compact_functions"][func.name] = \
+                compact_describe(func, function_context(func, ctxt))
+    for lib in ctxt.get("libraries", ()):
+        for key in ("functions", "function_ids", "limited_functions",
+                    "compact_functions"):
+            lib[key] = ctxt[key]
+
+    if ctxt.get("shards", 1) > 1:
+        generate_shards(outfile, ctxt)
+        return
+
+    f = open(outfile, "w")
+    generate_preamble(f, ctxt)
+    if ctxt.get("compact"):
+        generate_compact_runtime(f, ctxt)
+    for func in funcs:
+        generate_func(f, func, function_context(func, ctxt))
     f.close()
 
 
+# wrapper libraries built by the generated makefile:
+# suffix, defines and libraries
+makefile_variants = [
+    ("", "", ""),
+    ("-color", "-D%(prefix)s_USE_COLORS=1", ""),
+    ("-color-timestamp",
+     "-D%(prefix)s_USE_COLORS=1 -D%(prefix)s_LOG_TIMESTAMP=1", ""),
+    ("-color-threads",
+     "-D%(prefix)s_USE_COLORS=1 -D%(prefix)s_HAVE_THREADS=1", "-lpthread"),
+    ("-color-threads-timestamp",
+     "-D%(prefix)s_USE_COLORS=1 -D%(prefix)s_HAVE_THREADS=1 "
+     "-D%(prefix)s_LOG_TIMESTAMP=1", "-lpthread"),
+    ("-color-indent",
+     "-D%(prefix)s_USE_COLORS=1 -D%(prefix)s_LOG_INDENT='\"  \"'", ""),
+    ("-color-indent-timestamp",
+     "-D%(prefix)s_USE_COLORS=1 -D%(prefix)s_LOG_INDENT='\"  \"' "
+     "-D%(prefix)s_LOG_TIMESTAMP=1", ""),
+    ("-color-indent-threads",
+     "-D%(prefix)s_USE_COLORS=1 -D%(prefix)s_LOG_INDENT='\"  \"' "
+     "-D%(prefix)s_HAVE_THREADS=1", "-lpthread"),
+    ("-color-indent-threads-timestamp",
+     "-D%(prefix)s_USE_COLORS=1 -D%(prefix)s_LOG_INDENT='\"  \"' "
+     "-D%(prefix)s_HAVE_THREADS=1 -D%(prefix)s_LOG_TIMESTAMP=1",
+     "-lpthread"),
+    ("-buffered", "-D%(prefix)s_LOG_BUFFERED=1", "-lpthread"),
+    ("-binary", "-D%(prefix)s_LOG_BINARY=1", "-lpthread"),
+    ("-record", "-D%(prefix)s_LOG_RECORD=1", "-lpthread"),
+    ("-profile", "-D%(prefix)s_LOG_PROFILE=1", ""),
+    ("-counters", "-D%(prefix)s_LOG_COUNTERS=1 -D%(prefix)s_LOG_PROFILE=1",
+     "-lrt"),
+    ]
+
 def generate_makefile(makefile, sourcefile, ctxt):
     source_dir = os.path.dirname(sourcefile)
     makefile_dir = os.path.dirname(makefile)
@@ -1835,55 +4437,71 @@ def generate_makefile(makefile, sourcefile, ctxt):
         "cflags": ctxt["cflags"],
         "ldflags": ctxt["ldflags"],
         }
+    n_shards = ctxt.get("shards", 1)
+    if n_shards > 1:
+        header, shards = shard_paths(sourcefile, n_shards)
+        if source_dir == makefile_dir:
+            header = os.path.basename(header)
+            shards = [os.path.basename(x) for x in shards]
+        repl["header"] = header
+        repl["sources"] = " \\\n    ".join([sourcefile] + shards)
+
     f = open(makefile, "w")
     f.write("""\
 CFLAGS = -Wall -Wextra %(cflags)s $(EXTRA_CFLAGS)
 LDFLAGS = -ldl -fPIC %(ldflags)s $(EXTRA_LDFLAGS)
 
 BINS = \\
-    %(sourcename)s.so \\
-    %(sourcename)s-color.so \\
-    %(sourcename)s-color-timestamp.so \\
-    %(sourcename)s-color-threads.so \\
-    %(sourcename)s-color-threads-timestamp.so \\
-    %(sourcename)s-color-indent.so \\
-    %(sourcename)s-color-indent-timestamp.so \\
-    %(sourcename)s-color-indent-threads.so \\
-    %(sourcename)s-color-indent-threads-timestamp.so
-
+""" % repl)
+    f.write(" \\\n".join(["    %s%s.so" % (sourcename, suffix)
+                          for suffix, defines, libs in makefile_variants]))
+    f.write("\n\n")
+
+    if n_shards > 1:
+        # every variant has its objects, built from all shards
+        f.write("SOURCES = \\\n    %(sources)s\n\n" % repl)
+        objects = []
+        for suffix, defines, libs in makefile_variants:
+            objects.append("$(SOURCES:.c=.%s.o)" %
+                           (suffix.lstrip("-") or "default",))
+        f.write("OBJECTS = \\\n    %s\n\n" % (" \\\n    ".join(objects),))
+        f.write("""\
+.PHONY: all clean
+all: $(BINS)
+clean:
+\trm -f $(BINS) $(OBJECTS) *~
+""")
+    else:
+        f.write("""\
 .PHONY: all clean
 all: $(BINS)
 clean:
 \trm -f $(BINS) *~
-
-%(sourcename)s.so: %(sourcefile)s %(makefile)s
-\t$(CC) -shared $(CFLAGS) $(LDFLAGS) $< -o $@
-
-%(sourcename)s-color.so: %(sourcefile)s %(makefile)s
-\t$(CC) -shared -D%(prefix)s_USE_COLORS=1 $(CFLAGS) $(LDFLAGS) $< -o $@
-
-%(sourcename)s-color-timestamp.so: %(sourcefile)s %(makefile)s
-\t$(CC) -shared -D%(prefix)s_USE_COLORS=1 -D%(prefix)s_LOG_TIMESTAMP=1 $(CFLAGS) $(LDFLAGS) $< -o $@
-
-%(sourcename)s-color-threads.so: %(sourcefile)s %(makefile)s
-\t$(CC) -shared -D%(prefix)s_USE_COLORS=1 -D%(prefix)s_HAVE_THREADS=1 $(CFLAGS) $(LDFLAGS) -lpthread $< -o $@
-
-%(sourcename)s-color-threads-timestamp.so: %(sourcefile)s %(makefile)s
-\t$(CC) -shared -D%(prefix)s_USE_COLORS=1 -D%(prefix)s_HAVE_THREADS=1 -D%(prefix)s_LOG_TIMESTAMP=1 $(CFLAGS) $(LDFLAGS) -lpthread $< -o $@
-
-%(sourcename)s-color-indent.so: %(sourcefile)s %(makefile)s
-\t$(CC) -shared -D%(prefix)s_USE_COLORS=1 -D%(prefix)s_LOG_INDENT='\"  \"' $(CFLAGS) $(LDFLAGS) $< -o $@
-
-%(sourcename)s-color-indent-timestamp.so: %(sourcefile)s %(makefile)s
-\t$(CC) -shared -D%(prefix)s_USE_COLORS=1 -D%(prefix)s_LOG_INDENT='\"  \"' -D%(prefix)s_LOG_TIMESTAMP=1 $(CFLAGS) $(LDFLAGS) $< -o $@
-
-%(sourcename)s-color-indent-threads.so: %(sourcefile)s %(makefile)s
-\t$(CC) -shared -D%(prefix)s_USE_COLORS=1 -D%(prefix)s_LOG_INDENT='\"  \"' -D%(prefix)s_HAVE_THREADS=1 $(CFLAGS) $(LDFLAGS) -lpthread $< -o $@
-
-%(sourcename)s-color-indent-threads-timestamp.so: %(sourcefile)s %(makefile)s
-\t$(CC) -shared -D%(prefix)s_USE_COLORS=1 -D%(prefix)s_LOG_INDENT='\"  \"' -D%(prefix)s_HAVE_THREADS=1 -D%(prefix)s_LOG_TIMESTAMP=1 $(CFLAGS) $(LDFLAGS) -lpthread $< -o $@
-
+""")
+
+    for suffix, defines, libs in makefile_variants:
+        repl["suffix"] = suffix
+        repl["defines"] = defines % repl
+        if defines:
+            repl["defines"] += " "
+        repl["libs"] = libs
+        if libs:
+            repl["libs"] += " "
+        if n_shards > 1:
+            repl["variant"] = suffix.lstrip("-") or "default"
+            f.write("""
+%%.%(variant)s.o: %%.c %(header)s %(makefile)s
+\t$(CC) -c -fPIC %(defines)s$(CFLAGS) $< -o $@
+
+%(sourcename)s%(suffix)s.so: $(SOURCES:.c=.%(variant)s.o)
+\t$(CC) -shared $(CFLAGS) $(LDFLAGS) %(libs)s$^ -o $@
 """ % repl)
+        else:
+            f.write("""
+%(sourcename)s%(suffix)s.so: %(sourcefile)s %(makefile)s
+\t$(CC) -shared %(defines)s$(CFLAGS) $(LDFLAGS) %(libs)s$< -o $@
+""" % repl)
+    f.write("\n")
     f.close()
 
 
@@ -1924,8 +4542,157 @@ def generate_type(f, type, ctxt, indent_level=1):
             f.write("}")
 
 
+type_qualifiers = ("const", "volatile", "restrict")
+
+
+class TypesFileOrder(object):
+    """Order in which named types must be written to a types file.
+
+    Every enum, struct, union and typedef becomes a vertex of a
+    dependency graph, walked depth first in declaration order so each
+    type comes right after what it needs, in time linear with the
+    number of types and members. A member used by value needs the
+    complete type while a pointer only needs the name declared, for
+    structs and unions not yet defined a forward declaration is written
+    instead, so cycles through pointers are fine. Cycles through values
+    can't be written in C and raise ValueError naming the types in it.
+
+    Iterating gives (type, forward) pairs, forward being True when only
+    "struct name;" or "union name;" must be written.
+    """
+    def __init__(self, types):
+        self.types = types
+        self.typedefs = {}
+        self.roots = []
+        for t in types.order:
+            if not t.name:
+                continue
+            if isinstance(t, Typedef):
+                # array typedefs are registered as "name[N]"
+                self.typedefs[t.name.split("[", 1)[0].strip()] = t
+                self.roots.append(("typedef", t))
+            elif isinstance(t, (Enum, Group)):
+                self.roots.append(("define", t))
+
+    def resolve(self, t):
+        """Types used by name are builtin, find what they refer to."""
+        if not isinstance(t, BuiltinType):
+            return t
+        words = [w for w in t.name.split() if w not in type_qualifiers]
+        if len(words) == 2:
+            cls = {"enum": Enum, "struct": Struct, "union": Union}.get(words[0])
+            if cls:
+                return self.types.find(cls, words[1]) or t
+        return self.typedefs.get(" ".join(words), t)
+
+    def requires(self, t, pointer, complete, inside=None):
+        t = self.resolve(t)
+        if isinstance(t, Typedef):
+            if complete and not pointer:
+                return [("complete", t)]
+            return [("typedef", t)]
+        elif isinstance(t, Enum):
+            if t.name:
+                return [("define", t)] # no forward declaration of enums
+        elif isinstance(t, Group):
+            if not t.name:
+                # defined in place, needs whatever its members need
+                deps = []
+                for m in t.members:
+                    deps.extend(self.requires(m.type, m.pointer,
+                                              not m.pointer, inside))
+                return deps
+            elif complete and not pointer:
+                return [("define", t)]
+            elif t is not inside:
+                return [("declare", t)]
+        elif isinstance(t, FunctionPointer):
+            # prototypes may use incomplete types, even by value
+            deps = []
+            if isinstance(t.ret_type, Type):
+                deps.extend(self.requires(t.ret_type, t.ret_pointer, False,
+                                          inside))
+            for p in t.parameters:
+                deps.extend(self.requires(p.type, p.pointer, False, inside))
+            return deps
+        return []
+
+    def dependencies(self, vertex):
+        kind, t = vertex
+        if kind == "typedef":
+            complete = "[" in t.name and not t.pointer
+            ref = self.resolve(t.reference)
+            # "typedef struct x y;" declares struct x itself
+            return [d for d in self.requires(ref, t.pointer, complete)
+                    if d != ("declare", ref)]
+        elif kind == "complete":
+            deps = [("typedef", t)]
+            if not t.pointer:
+                deps.extend(self.requires(t.reference, 0, True))
+            return deps
+        elif kind == "define" and isinstance(t, Group):
+            deps = []
+            for m in t.members:
+                deps.extend(self.requires(m.type, m.pointer, not m.pointer,
+                                          inside=t))
+            return deps
+        return []
+
+    def cycle_error(self, stack, vertex):
+        path = [v for v, deps in stack]
+        path = path[path.index(vertex):] + [vertex]
+        names = []
+        for kind, t in path:
+            if kind in ("typedef", "complete"):
+                name = "typedef %s" % (t.name.split("[", 1)[0].strip(),)
+            else:
+                name = "%s %s" % (t.cls, t.name)
+            if not names or names[-1] != name:
+                names.append(name)
+        return ValueError("circular dependency: %s" % (" -> ".join(names),))
+
+    def __iter__(self):
+        declared = set()
+        state = {} # vertex -> False while visiting, True once written
+        for root in self.roots:
+            if root in state:
+                continue
+            state[root] = False
+            stack = [(root, iter(self.dependencies(root)))]
+            while stack:
+                vertex, deps = stack[-1]
+                for d in deps:
+                    s = state.get(d)
+                    if s is None:
+                        state[d] = False
+                        stack.append((d, iter(self.dependencies(d))))
+                        break
+                    elif s is False:
+                        raise self.cycle_error(stack, d)
+                else:
+                    stack.pop()
+                    state[vertex] = True
+                    kind, t = vertex
+                    if kind == "typedef":
+                        ref = self.resolve(t.reference)
+                        if isinstance(ref, Group):
+                            declared.add(ref)
+                        yield t, False
+                    elif kind == "define":
+                        if isinstance(t, Group) and not t.members:
+                            if t not in declared:
+                                declared.add(t)
+                                yield t, True
+                        else:
+                            declared.add(t)
+                            yield t, False
+                    elif kind == "declare" and t not in declared:
+                        declared.add(t)
+                        yield t, True
+
+
 def generate_types_file(types_file, header, ctxt):
-    data = ctxt["header_contents"]
+    order = list(TypesFileOrder(ctxt["types"]))
 
     f = open(types_file, "w")
     f.write("""\
@@ -1940,53 +4707,12 @@ def generate_types_file(types_file, header, ctxt):
        "prefix": ctxt["prefix"],
        })
 
-    def needs_emission(t):
-        return not isinstance(t, (BuiltinType, FunctionPointer))
-
-    order = []
-    done = set()
-    todo = list(x for x in _types_order if x.name and not
-                isinstance(x, (BuiltinType, FunctionPointer, FunctionName)))
-    reorder_count = 0
-    while todo:
-        x = todo.pop(0)
-        if isinstance(x, Enum):
-            order.append(x)
-            done.add(x)
-            reorder_count = 0
-        elif isinstance(x, Group):
-            for y in x.members:
-                if needs_emission(y.type) and y.type.name and \
-                       y.type not in done:
-                    print "Note: %s %s depends on %s, reorder..." % \
-                          (x.cls, x.name, y)
-                    todo.append(x)
-                    reorder_count += 1
-                    break
-            else:
-                order.append(x)
-                done.add(x)
-                reorder_count = 0
-        elif isinstance(x, Typedef):
-            if needs_emission(x.reference) and x.reference.name and \
-                   x.reference not in done:
-                print "Note: typedef %s depends on %s, reorder..." % \
-                      (x.name, x.reference)
-                todo.append(x)
-                reorder_count += 1
-            else:
-                order.append(x)
-                done.add(x)
-                reorder_count = 0
+    for t, forward in order:
+        if forward:
+            f.write("\t%s %s;\n" % (t.cls, t.name))
         else:
-            raise TypeError("unexpected type %r" % x)
-
-        if reorder_count > len(todo):
-            raise ValueError("circular dependency: %r" % (todo,))
-
-    for t in order:
-        f.write("%s;\n" %
-                t.pretty_format(prefix="\t", indent="\t", newline="\n"))
+            f.write("%s;\n" %
+                    t.pretty_format(prefix="\t", indent="\t", newline="\n"))
 
     f.write("#endif /* %s_TYPES_FILE */\n" % (ctxt["prefix"],))
     f.close()
@@ -2176,8 +4902,260 @@ def config_get_regexp(cfg, section, key, default=None):
     return None
 
 
+def load_config(filename):
+    if not filename:
+        return None
+    cfg = ConfigParser()
+    cfg.read([filename])
+    return cfg
+
+
+def dump_header_contents(header_contents):
+    hc = header_contents.items()
+    hc.sort(cmp=lambda a, b: cmp(a[0], b[0]))
+    for k, v in hc:
+        c = v.values()
+        if not c:
+            continue
+        print "%s:" % (k,)
+        c.sort(cmp=lambda a, b: cmp(a.name, b.name))
+        for p in c:
+            print "\t%s" % (p,)
+        print
+
+
+def make_context(job, header_contents, types, cfg):
+    """Generation context for job, as used by generate() and friends."""
+    prefix = job.get("prefix")
+    if not prefix:
+        prefix = prefix_from_libname(job["libname"])
+
+    prefix = re.sub("[^a-zA-z0-9_]", "_", prefix)
+
+    return {
+        "header": job["header"],
+        "header_contents": header_contents,
+        "types": types,
+        "prefix": prefix,
+        "libname": job["libname"],
+        "cfg": cfg,
+        "compact": job.get("compact", False),
+        "shards": job.get("shards") or 1,
+        }
+
+
+def parse_header(header, cfg, cache=None):
+    """(header contents, type registry) of header."""
+    if cache:
+        return cache.header_tree(header, cfg)
+    types = TypeRegistry()
+    return header_tree(header, cfg, types), types
+
+
+def make_module_context(job, cfg, cache=None):
+    """Parse the headers of job and return the context of job["header"].
+
+    If job["libraries"] lists more (header, libname) pairs, they are
+    parsed too and ctxt["libraries"] has the contexts of all of them,
+    sharing the prefix of the first one.
+    """
+    header_contents, types = parse_header(job["header"], cfg, cache)
+    ctxt = make_context(job, header_contents, types, cfg)
+    if not job.get("libraries"):
+        return ctxt
+    ctxt["libraries"] = [ctxt]
+    for header, libname in job["libraries"]:
+        lib_job = dict(job, header=header, libname=libname,
+                       prefix=ctxt["prefix"])
+        header_contents, types = parse_header(header, cfg, cache)
+        ctxt["libraries"].append(make_context(lib_job, header_contents,
+                                              types, cfg))
+    return ctxt
+
+
+def generate_library(job, cache=None):
+    """Parse job["header"] and write every file requested by job.
+
+    job is a dictionary with the same keys as command line options, plus
+    "header", "libname" and "outfile". Libraries in job["libraries"],
+    (header, libname) pairs, are wrapped by the same module. Returns a
+    dictionary with the time spent parsing and generating.
+    """
+    outfile = job["outfile"]
+    cfg = load_config(job.get("config"))
+
+    t0 = time.time()
+    ctxt = make_module_context(job, cfg, cache)
+    t1 = time.time()
+
+    libraries = ctxt.get("libraries") or [ctxt]
+    if job.get("dump"):
+        for lib in libraries:
+            dump_header_contents(lib["header_contents"])
+
+    generate(outfile, ctxt)
+    if job.get("dump_types"):
+        for lib in libraries:
+            get_resolver(lib).dump(sys.stdout, lib)
+
+    if job.get("makefile"):
+        ctxt["cflags"] = job.get("makefile_cflags") or ""
+        ctxt["ldflags"] = job.get("makefile_ldflags") or ""
+        generate_makefile(job["makefile"], outfile, ctxt)
+
+    if job.get("types_file"):
+        generate_types_file(job["types_file"], job["header"], ctxt)
+
+    if job.get("custom_formatters"):
+        generate_custom_formatters(job["custom_formatters"], job["header"],
+                                   ctxt)
+
+    return {"parse": t1 - t0, "generate": time.time() - t1}
+
+
+batch_keys = {
+    # manifest key: (job key, is path)
+    "header": ("header", True),
+    "library": ("libname", False),
+    "output": ("outfile", True),
+    "config": ("config", True),
+    "prefix": ("prefix", False),
+    "makefile": ("makefile", True),
+    "makefile-cflags": ("makefile_cflags", False),
+    "makefile-ldflags": ("makefile_ldflags", False),
+    "types-file": ("types_file", True),
+    "custom-formatters": ("custom_formatters", True),
+    }
+
+
+def parse_libraries(value, basedir=""):
+    """(header, libname) pairs of a list of header.h:libname.so values."""
+    libraries = []
+    for v in value:
+        v = v.strip()
+        if not v:
+            continue
+        try:
+            header, libname = v.rsplit(":", 1)
+        except ValueError:
+            raise ValueError("%r is not header.h:libname.so" % (v,))
+        if basedir:
+            header = os.path.normpath(os.path.join(basedir, header))
+        libraries.append((header, libname))
+    return libraries
+
+def load_batch_manifest(manifest):
+    """Read jobs for generate_library() from a batch manifest.
+
+    Each section is a library, relative paths are relative to the
+    manifest directory. Keys in [DEFAULT] apply to all libraries and
+    %(__name__)s expands to the section name.
+    """
+    cfg = ConfigParser()
+    if not cfg.read([manifest]):
+        raise SystemExit("Could not read batch manifest: %s" % (manifest,))
+    basedir = os.path.dirname(manifest)
+
+    jobs = []
+    for section in cfg.sections():
+        job = {"name": section}
+        for key, (job_key, is_path) in batch_keys.iteritems():
+            if not cfg.has_option(section, key):
+                continue
+            v = cfg.get(section, key)
+            if is_path and v:
+                v = os.path.normpath(os.path.join(basedir, v))
+            job[job_key] = v
+        for key in ("header", "libname", "outfile"):
+            if not job.get(key):
+                raise SystemExit("Batch manifest %s: [%s] misses '%s'" %
+                                 (manifest, section, key))
+        try:
+            if cfg.has_option(section, "compact"):
+                job["compact"] = cfg.getboolean(section, "compact")
+            if cfg.has_option(section, "shards"):
+                job["shards"] = cfg.getint(section, "shards")
+            if cfg.has_option(section, "libraries"):
+                job["libraries"] = parse_libraries(
+                    cfg.get(section, "libraries").split(","), basedir)
+        except ValueError, e:
+            raise SystemExit("Batch manifest %s: [%s]: %s" %
+                             (manifest, section, e))
+        jobs.append(job)
+    return jobs
+
+
+def batch_worker(args):
+    job, cache_dir = args
+    # generators print notes to stdout, keep them per library
+    old_stdout = sys.stdout
+    sys.stdout = output = StringIO.StringIO()
+    cache = None
+    if cache_dir:
+        cache = ParseCache(cache_dir)
+    t0 = time.time()
+    try:
+        try:
+            timings = generate_library(job, cache)
+            error = None
+        except Exception, e:
+            timings = {}
+            error = traceback.format_exc()
+    finally:
+        sys.stdout = old_stdout
+    timings["total"] = time.time() - t0
+    if cache:
+        timings["cache_hits"] = cache.hits
+        timings["cache_misses"] = cache.misses
+    return job["name"], output.getvalue(), timings, error
+
+
+def batch_run(jobs, n_processes, cache_dir=None, cache_stats=False):
+    """Run generate_library() for all jobs, using a pool of processes.
+
+    Each job uses its own TypeRegistry, so they don't interfere. Returns
+    the number of failed jobs.
+    """
+    work = [(job, cache_dir) for job in jobs]
+    t0 = time.time()
+    if n_processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(n_processes, len(jobs)))
+        results = pool.imap_unordered(batch_worker, work)
+    else:
+        pool = None
+        results = itertools.imap(batch_worker, work)
+
+    failures = 0
+    hits = misses = 0
+    cpu = 0.0
+    for name, output, timings, error in results:
+        if output:
+            sys.stdout.write(output)
+        if error:
+            failures += 1
+            print "FAILED %s:\n%s" % (name, error)
+            continue
+        print "%-30s parse %7.3fs, generate %7.3fs, total %7.3fs" % \
+              (name, timings["parse"], timings["generate"], timings["total"])
+        cpu += timings["total"]
+        hits += timings.get("cache_hits", 0)
+        misses += timings.get("cache_misses", 0)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    print "%d libraries (%d failed) in %.3fs using %d processes, " \
+          "%.3fs summed" % (len(jobs), failures, time.time() - t0,
+                            n_processes, cpu)
+    if cache_dir and cache_stats:
+        print "parse cache %s: %d hits, %d misses" % (cache_dir, hits, misses)
+    return failures
+
+
 if __name__ == "__main__":
-    usage = "usage: %prog [options] <header.h> <libname.so> <outfile.c>"
+    usage = ("usage: %prog [options] <header.h> <libname.so> <outfile.c>\n"
+             "       %prog [options] --batch <manifest>")
     parser = optparse.OptionParser(usage=usage)
 
     parser.add_option("-c", "--config", action="store", default=None,
@@ -2195,10 +5173,50 @@ if __name__ == "__main__":
     parser.add_option("-F", "--custom-formatters", action="store", default=None,
                       help=("Generate C file with custom formatters based on "
                             "typedefs, enums, structs and unions"))
+    parser.add_option("--compact", action="store_true", default=False,
+                      help=("Generate small wrappers that log through a "
+                            "table of functions instead of open-coding "
+                            "the logging of each one"))
+    parser.add_option("-S", "--shards", action="store", type="int",
+                      default=1,
+                      help=("Split wrappers in this many source files, "
+                            "to compile them in parallel"))
+    parser.add_option("-L", "--library", action="append", default=[],
+                      metavar="HEADER:LIBNAME",
+                      help=("Also wrap this library in the same module, "
+                            "sharing its runtime. May be repeated"))
     parser.add_option("-D", "--dump", action="store_true", default=False,
                       help="Dump parsed elements")
+    parser.add_option("--dump-types", action="store_true", default=False,
+                      help=("Show how the types of parameters and return "
+                            "values were resolved: aliases, formatters "
+                            "and checkers"))
+    parser.add_option("-C", "--cache-dir", action="store", default=None,
+                      help=("Directory to cache parsed headers, unchanged "
+                            "headers are not parsed again"))
+    parser.add_option("--cache-stats", action="store_true", default=False,
+                      help="Show parse cache hit and miss statistics")
+    parser.add_option("-b", "--batch", action="store", default=None,
+                      help=("Generate all libraries listed in this manifest "
+                            "instead of a single one"))
+    parser.add_option("-j", "--jobs", action="store", type="int",
+                      default=None,
+                      help=("Number of processes to use in batch mode "
+                            "(defaults to the number of CPUs)"))
 
     options, args = parser.parse_args()
+    if options.batch:
+        jobs = load_batch_manifest(options.batch)
+        for job in jobs:
+            job["dump"] = options.dump
+            job["dump_types"] = options.dump_types
+        n_processes = options.jobs or multiprocessing.cpu_count()
+        failures = batch_run(jobs, n_processes, options.cache_dir,
+                             options.cache_stats)
+        if failures:
+            raise SystemExit("%d libraries failed" % (failures,))
+        raise SystemExit(0)
+
     try:
         header = args[0]
     except IndexError:
@@ -2214,48 +5232,32 @@ if __name__ == "__main__":
     except IndexError:
         parser.print_help()
         raise SystemExit("Missing parameter: outfile.c")
+    try:
+        libraries = parse_libraries(options.library)
+    except ValueError, e:
+        raise SystemExit("Invalid --library: %s" % (e,))
 
-    cfg = None
-    if options.config:
-        cfg = ConfigParser()
-        cfg.read([options.config])
-
-    header_contents = header_tree(header, cfg)
-    if options.dump:
-        hc = header_contents.items()
-        hc.sort(cmp=lambda a, b: cmp(a[0], b[0]))
-        for k, v in hc:
-            c = v.values()
-            if not c:
-                continue
-            print "%s:" % (k,)
-            c.sort(cmp=lambda a, b: cmp(a.name, b.name))
-            for p in c:
-                print "\t%s" % (p,)
-            print
-
-    prefix = options.prefix
-    if not prefix:
-        prefix = prefix_from_libname(libname)
-
-    prefix = re.sub("[^a-zA-z0-9_]", "_", prefix)
-
-    ctxt = {
+    job = {
         "header": header,
-        "header_contents": header_contents,
-        "prefix": prefix,
         "libname": libname,
-        "cfg": cfg,
+        "outfile": outfile,
+        "config": options.config,
+        "prefix": options.prefix,
+        "makefile": options.makefile,
+        "makefile_cflags": options.makefile_cflags,
+        "makefile_ldflags": options.makefile_ldflags,
+        "types_file": options.types_file,
+        "custom_formatters": options.custom_formatters,
+        "compact": options.compact,
+        "shards": options.shards,
+        "libraries": libraries,
+        "dump": options.dump,
+        "dump_types": options.dump_types,
         }
-    generate(outfile, ctxt)
-
-    if options.makefile:
-        ctxt["cflags"] = options.makefile_cflags or ""
-        ctxt["ldflags"] = options.makefile_ldflags or ""
-        generate_makefile(options.makefile, outfile, ctxt)
-
-    if options.types_file:
-        generate_types_file(options.types_file, header, ctxt)
 
-    if options.custom_formatters:
-        generate_custom_formatters(options.custom_formatters, header, ctxt)
+    cache = None
+    if options.cache_dir:
+        cache = ParseCache(options.cache_dir)
+    generate_library(job, cache)
+    if cache and options.cache_stats:
+        print cache.stats()
@@ -0,0 +1,84 @@
+/* -*- mode: C; c-file-style: "gnu"; indent-tabs-mode: nil; -*- */
+/* dbus-like.h  exercises the macros used by libdbus-1 public headers
+ *
+ * Licensed under the Academic Free License version 2.1
+ */
+#if !defined (DBUS_INSIDE_DBUS_H) && !defined (DBUS_COMPILATION)
+#error "Only <dbus/dbus.h> can be included directly, this file may disappear or change contents."
+#endif
+
+#ifndef DBUS_LIKE_H
+#define DBUS_LIKE_H
+
+#include <dbus/dbus-macros.h>
+#include <dbus/dbus-types.h>
+
+DBUS_BEGIN_DECLS
+
+typedef struct DBusMessage DBusMessage;
+typedef struct DBusMessageIter DBusMessageIter;
+typedef struct DBusConnection DBusConnection;
+typedef dbus_uint32_t dbus_bool_t;
+
+typedef enum
+{
+  DBUS_HANDLER_RESULT_HANDLED,         /**< Message has had its effect */
+  DBUS_HANDLER_RESULT_NOT_YET_HANDLED, /**< Message has not had any effect */
+  DBUS_HANDLER_RESULT_NEED_MEMORY      /**< Need more memory */
+} DBusHandlerResult;
+
+typedef DBusHandlerResult (* DBusHandleMessageFunction) (DBusConnection     *connection,
+                                                         DBusMessage        *message,
+                                                         void               *user_data);
+typedef void (* DBusFreeFunction) (void *memory);
+
+struct DBusMessageIter
+{
+  void *dummy1;         /**< Don't use this */
+  void *dummy2;         /**< Don't use this */
+  dbus_uint32_t dummy3; /**< Don't use this */
+  int dummy4;           /**< Don't use this */
+  int pad1;             /**< Don't use this */
+  void *pad3;           /**< Don't use this */
+};
+
+DBUS_EXPORT
+DBusMessage* dbus_message_new               (int          message_type);
+DBUS_EXPORT
+DBusMessage* dbus_message_new_method_call   (const char  *bus_name,
+                                             const char  *path,
+                                             const char  *iface,
+                                             const char  *method);
+DBUS_EXPORT
+DBusMessage* dbus_message_ref               (DBusMessage   *message);
+DBUS_EXPORT
+void         dbus_message_unref             (DBusMessage   *message);
+DBUS_EXPORT
+dbus_bool_t  dbus_message_set_path          (DBusMessage   *message,
+                                             const char    *object_path);
+DBUS_EXPORT
+const char*  dbus_message_get_path          (DBusMessage   *message);
+DBUS_EXPORT
+dbus_bool_t  dbus_message_get_path_decomposed (DBusMessage   *message,
+                                               char        ***path);
+DBUS_EXPORT
+dbus_bool_t  dbus_message_append_args       (DBusMessage     *message,
+                                             int              first_arg_type,
+                                             ...);
+DBUS_EXPORT
+dbus_bool_t dbus_message_iter_init (DBusMessage *message,
+                                    DBusMessageIter *iter);
+DBUS_EXPORT
+void        dbus_message_iter_get_basic (DBusMessageIter *iter,
+                                         void            *value);
+DBUS_EXPORT
+dbus_bool_t dbus_connection_add_filter (DBusConnection            *connection,
+                                        DBusHandleMessageFunction  function,
+                                        void                      *user_data,
+                                        DBusFreeFunction           free_data_function);
+DBUS_EXPORT
+DBUS_DEPRECATED int dbus_message_iter_get_array_len (DBusMessageIter *iter);
+
+DBUS_END_DECLS
+
+#endif /* DBUS_LIKE_H */
@@ -0,0 +1,39 @@
+/* nested aggregates, arrays, function pointers returning pointers
+ * and declarations spread across lines.
+ */
+#define NESTED_API extern
+#define NESTED_MULTI_LINE(a, b) \
+    do { \
+        a = b; \
+    } while (0)
+
+typedef struct nested_node nested_node_t;
+typedef nested_node_t *nested_node_ptr;
+typedef char nested_name_t[32];
+
+struct nested_node {
+    nested_node_t *next, *prev;
+    union {
+        struct {
+            int kind;
+            unsigned short flags;
+        } header;
+        long raw[4];
+    } data;
+    enum nested_state { NESTED_IDLE, NESTED_BUSY = 3 } state;
+    void *(*alloc)(unsigned long size, void *ctx);
+    char name[16];
+};
+
+typedef int (*nested_cmp_t)(const nested_node_t *a, const nested_node_t *b);
+
+extern nested_node_t *nested_find(nested_node_t *root, const char *name,
+                                  nested_cmp_t cmp);
+extern int nested_walk(nested_node_t *root,
+                       int (*cb)(nested_node_t *n, void *data),
+                       void *data) __attribute__((nonnull(1), deprecated));
+void **nested_children(const nested_node_t *n, unsigned int *count);
+unsigned long long nested_total(const nested_node_t *n, int depth); // depth<0 is infinite
+enum nested_state nested_get_state(const nested_node_t *n);
+void nested_set_name(nested_node_t *n, nested_name_t name);
+int nested_sum(const int values[], int n_values);
@@ -0,0 +1,55 @@
+/* sample header
+ * multi-line comment */
+#ifndef SAMPLE_H
+#define SAMPLE_H \
+    1
+
+#include <stdio.h>
+
+// a line comment
+typedef struct _Sample Sample;
+typedef int (*SampleCallback)(Sample *s, void *data);
+typedef unsigned long SampleId;
+
+enum sample_mode {
+    SAMPLE_MODE_A = 0,
+    SAMPLE_MODE_B = (1 << 2),
+    SAMPLE_MODE_C
+};
+
+typedef enum {
+    SAMPLE_FLAG_NONE,
+    SAMPLE_FLAG_X = 0x10 /* inline comment */
+} SampleFlags;
+
+struct sample_point {
+    int x, y;
+    const char *label;
+    struct {
+        double a;
+        double b;
+    } inner;
+    union {
+        int i;
+        float f;
+    } u;
+    void (*notify)(struct sample_point *p, int why);
+};
+
+union sample_value { long l; double d; char *s; };
+
+Sample *sample_new(const char *name, SampleId id) __attribute__((warn_unused_result));
+void sample_free(Sample *s);
+int sample_set_mode(Sample *s, enum sample_mode mode);
+extern const char *sample_get_name(const Sample *s);
+int sample_foreach(Sample *s, SampleCallback cb, void *data);
+int sample_get_point(Sample *s, struct sample_point *out_point);
+unsigned int sample_count(void);
+int sample_printf(Sample *s, const char *fmt, ...);
+double sample_scale(double factor, float other);
+char sample_buffer_get(char buf[16], int idx);
+SampleFlags sample_flags(Sample *s);
+static int sample_private(int x);
+void sample_register(void (*handler)(int sig, void *ctx), void *ctx);
+long long sample_big(unsigned long long v, short s, unsigned char c);
+#endif
@@ -0,0 +1,195 @@
+#!/usr/bin/python2
+
+"""
+Parser regression checks for liblogger.
+
+Every corpus/<name>.h is tokenized and parsed, then both the statement
+trees and the parsed header contents are compared against the
+corpus/<name>.tree and corpus/<name>.dump files. If corpus/<name>.cfg
+exists it's used as configuration, just like liblogger.py --config.
+
+With --scaling synthetic headers from 1k to 200k declarations are
+parsed and the time per declaration is reported, it must stay about
+the same for the parser to be linear.
+"""
+
+import sys
+import os
+import optparse
+import time
+from ConfigParser import SafeConfigParser as ConfigParser
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+corpus_dir = os.path.join(tests_dir, "corpus")
+sys.path.insert(0, os.path.dirname(tests_dir))
+
+import liblogger
+
+
+def dump_node(node, indent=""):
+    if node.enclosure is None:
+        lines = [indent + "<>"]
+    else:
+        lines = [indent + "".join(node.enclosure)]
+    for c in node.children:
+        if isinstance(c, liblogger.Node):
+            lines.extend(dump_node(c, indent + "  "))
+        else:
+            lines.append("%s  %r" % (indent, c))
+    return lines
+
+
+def dump_contents(data):
+    lines = []
+    hc = data.items()
+    hc.sort(cmp=lambda a, b: cmp(a[0], b[0]))
+    for k, v in hc:
+        c = v.values()
+        if not c:
+            continue
+        lines.append("%s:" % (k,))
+        c.sort(cmp=lambda a, b: cmp(a.name, b.name))
+        for p in c:
+            lines.append("\t%s" % (p,))
+        lines.append("")
+    return lines
+
+
+def load_config(name):
+    cfgfile = os.path.join(corpus_dir, name + ".cfg")
+    if not os.path.exists(cfgfile):
+        return None
+    cfg = ConfigParser()
+    cfg.read([cfgfile])
+    return cfg
+
+
+def check_corpus(update=False):
+    failures = 0
+    headers = [x for x in os.listdir(corpus_dir) if x.endswith(".h")]
+    headers.sort()
+    for h in headers:
+        name = os.path.splitext(h)[0]
+        header = os.path.join(corpus_dir, h)
+        cfg = load_config(name)
+
+        tokens = liblogger.header_tokenize(header, cfg)
+        trees = []
+        for n in liblogger.header_statements(tokens):
+            trees.extend(dump_node(n))
+        contents = dump_contents(liblogger.header_tree(header, cfg))
+
+        for ext, lines in ((".tree", trees), (".dump", contents)):
+            expected_file = os.path.join(corpus_dir, name + ext)
+            got = "\n".join(lines) + "\n"
+            if update:
+                f = open(expected_file, "w")
+                f.write(got)
+                f.close()
+                print "updated %s" % (expected_file,)
+                continue
+
+            f = open(expected_file)
+            expected = f.read()
+            f.close()
+            if got == expected:
+                print "ok: %s%s" % (name, ext)
+            else:
+                print "FAIL: %s%s differs from expected" % (name, ext)
+                failures += 1
+    return failures
+
+
+def check_isolation():
+    header = os.path.join(corpus_dir, "sample.h")
+    types_a = liblogger.TypeRegistry()
+    types_b = liblogger.TypeRegistry()
+    a = liblogger.header_tree(header, None, types_a)
+    if types_b.find(liblogger.Typedef, "Sample"):
+        print "FAIL: registry sees types from another parse"
+        return 1
+    b = liblogger.header_tree(header, None, types_b)
+    if a["typedef"]["Sample"] is b["typedef"]["Sample"]:
+        print "FAIL: parses share type instances"
+        return 1
+    print "ok: parses are isolated"
+    return 0
+
+
+def synthetic_header(filename, count):
+    f = open(filename, "w")
+    f.write("/* %d synthetic declarations */\n#define SYNTH 1\n" % count)
+    for i in xrange(count):
+        kind = i % 4
+        if kind == 0:
+            f.write("typedef struct _synth_%d synth_%d_t;\n" % (i, i))
+        elif kind == 1:
+            f.write("struct synth_s%d {\n    int a; /* a */\n"
+                    "    const char *b;\n    void (*c)(int x, void *y);\n"
+                    "};\n" % (i,))
+        elif kind == 2:
+            f.write("enum synth_e%d { SYNTH_%d_A, SYNTH_%d_B = 2 };\n" %
+                    (i, i, i))
+        else:
+            f.write("extern int synth_f%d(void *ctx, const char *name,\n"
+                    "                     unsigned long n); // f\n" % (i,))
+    f.close()
+
+
+def check_scaling(counts, max_ratio):
+    import tempfile
+    fd, filename = tempfile.mkstemp(suffix=".h", prefix="liblogger-synth-")
+    os.close(fd)
+    results = []
+    try:
+        for count in counts:
+            synthetic_header(filename, count)
+            t0 = time.time()
+            tokens = liblogger.header_tokenize(filename, None)
+            t1 = time.time()
+            n_statements = 0
+            for n in liblogger.header_statements(tokens):
+                n_statements += 1
+            t2 = time.time()
+            per_decl = (t2 - t0) / count * 1e6
+            results.append(per_decl)
+            print ("%7d declarations: %7d tokens, tokenize %.3fs, "
+                   "tree %.3fs, %.2fus/declaration") % \
+                   (count, len(tokens), t1 - t0, t2 - t1, per_decl)
+    finally:
+        os.unlink(filename)
+
+    ratio = results[-1] / results[0]
+    if ratio > max_ratio:
+        print "FAIL: time per declaration grew %.1fx (max %.1fx)" % \
+              (ratio, max_ratio)
+        return 1
+    print "ok: time per declaration grew %.1fx (max %.1fx)" % \
+          (ratio, max_ratio)
+    return 0
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-u", "--update", action="store_true", default=False,
+                      help="Rewrite expected results from current parser")
+    parser.add_option("-s", "--scaling", action="store_true", default=False,
+                      help="Check parser scales linearly (slow)")
+    parser.add_option("--scaling-counts", action="store",
+                      default="1000,10000,50000,200000",
+                      help="Comma separated declaration counts to try")
+    parser.add_option("--scaling-max-ratio", action="store", type="float",
+                      default=3.0,
+                      help="Maximum growth of time per declaration")
+
+    options, args = parser.parse_args()
+
+    failures = check_corpus(options.update)
+    failures += check_isolation()
+    if options.scaling:
+        counts = [int(x) for x in options.scaling_counts.split(",")]
+        failures += check_scaling(counts, options.scaling_max_ratio)
+
+    if failures:
+        raise SystemExit("%d failures" % (failures,))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+CPU cost of moving transcoder output to a client socket.
+
+A producer process (dd from /dev/zero, standing in for mencoder) writes
+--megabytes to an anonymous pipe, the server side copies it to one end
+of a socket pair and a child process reads and discards the other end.
+Only the CPU time (user + system) of the copying process is measured,
+for each way of copying:
+
+  loop-1024: the old TranscoderMencoder loop, 1024 bytes reads, poll()
+             of the process and writes through the buffered socket file;
+  read:      StreamPump reading into a reused buffer;
+  splice:    StreamPump moving data in the kernel with splice(2).
+
+    ./benchmarks/stream.py -m 512
+"""
+
+import sys
+import os
+import optparse
+import resource
+import socket
+import subprocess
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarks_dir))
+
+import catota.stream
+
+
+def copy_loop_1024(proc, sock):
+    wfile = sock.makefile("wb", 0)
+    rfile = proc.stdout
+    while proc.poll() == None:
+        d = rfile.read(1024)
+        wfile.write(d)
+    # the old loop loses whatever is left once the process exits
+    d = rfile.read(1024)
+    while d:
+        wfile.write(d)
+        d = rfile.read(1024)
+    wfile.close()
+
+
+def copy_pump(proc, sock, use_splice):
+    pump = catota.stream.StreamPump(proc.stdout.fileno(), sock.fileno(),
+                                    use_splice)
+    pump.run()
+    return pump
+
+
+def discard(sock, other):
+    """Fork a child reading sock until EOF, returns its pid."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            other.close()
+            while os.read(sock.fileno(), 1024 * 1024):
+                pass
+        finally:
+            os._exit(0)
+    return pid
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(mode, megabytes):
+    server, client = socket.socketpair()
+    reader = discard(client, server)
+    client.close()
+
+    proc = subprocess.Popen(["dd", "if=/dev/zero", "bs=1048576",
+                             "count=%d" % (megabytes,)],
+                            stdout=subprocess.PIPE, stderr=open(os.devnull, "w"),
+                            close_fds=True)
+    catota.stream.set_pipe_size(proc.stdout.fileno(), 1024 * 1024)
+
+    cpu0 = cpu_time()
+    t0 = time.time()
+    if mode == "loop-1024":
+        copy_loop_1024(proc, server)
+    else:
+        copy_pump(proc, server, mode == "splice")
+    elapsed = time.time() - t0
+    cpu = cpu_time() - cpu0
+
+    server.close()
+    proc.stdout.close()
+    proc.wait()
+    os.waitpid(reader, 0)
+
+    size = megabytes * 1024 * 1024
+    return {"cpu": cpu, "elapsed": elapsed, "rate": size / elapsed,
+            "cpu_per_gib": cpu * 1024 / megabytes}
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-m", "--megabytes", action="store", type="int",
+                      default=256, help="Data streamed in every run")
+    parser.add_option("-r", "--repeat", action="store", type="int",
+                      default=3, help="Runs of every mode, best is kept")
+
+    options, args = parser.parse_args()
+
+    modes = ["loop-1024", "read"]
+    if catota.stream.have_splice:
+        modes.append("splice")
+
+    print "%d MiB, best of %d runs" % (options.megabytes, options.repeat)
+    print "%-12s%12s%12s%12s%12s%12s" % ("", "cpu (s)", "wall (s)",
+                                         "MiB/s", "cpu s/GiB", "cpu gain")
+    base = None
+    for mode in modes:
+        runs = [measure(mode, options.megabytes)
+                for i in xrange(options.repeat)]
+        best = min(runs, key=lambda r: r["cpu"])
+        if base is None:
+            base = best["cpu"]
+        print "%-12s%12.3f%12.3f%12.1f%12.3f%11.1fx" % \
+              (mode, best["cpu"], best["elapsed"],
+               best["rate"] / (1024 * 1024), best["cpu_per_gib"],
+               base / max(best["cpu"], 1e-6))
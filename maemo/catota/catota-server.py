@@ -3,12 +3,24 @@
 import sys
 import os
 import logging as log
-from catota.server import serve_forever, load_plugins_transcoders
+from catota.server import load_plugins_transcoders, Transcoder
 
 log_level = log.WARNING
+threads = False
+cache_dir = None
+cache_size = 1024 # MiB
+media_root = None
 for p in sys.argv[1:]:
     if p == "-v" or p == "--verbose":
         log_level -= 10
+    elif p == "-t" or p == "--threads":
+        threads = True
+    elif p.startswith("--cache="):
+        cache_dir = p[len("--cache="):]
+    elif p.startswith("--cache-size="):
+        cache_size = int(p[len("--cache-size="):])
+    elif p.startswith("--media-root="):
+        media_root = p[len("--media-root="):]
 
 log.basicConfig(level=log_level,
                 format=("### %(asctime)s %(name)-18s %(levelname)-8s "
@@ -17,4 +29,15 @@ log.basicConfig(level=log_level,
 
 pd = os.path.join("catota", "plugins", "server", "transcoders")
 load_plugins_transcoders(pd)
-serve_forever()
+Transcoder.media_root = media_root
+
+if threads:
+    from catota.server import serve_forever
+    serve_forever()
+else:
+    from catota.asyncserver import serve_forever
+    cache = None
+    if cache_dir:
+        from catota.cache import TranscodeCache
+        cache = TranscodeCache(cache_dir, cache_size * 1024 * 1024)
+    serve_forever(cache=cache)
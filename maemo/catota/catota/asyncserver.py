@@ -0,0 +1,854 @@
+#!/usr/bin/env python
+
+"""Single threaded catota server.
+
+Same pages and transcoder plugins as catota.server.Server, but every
+client and transcoder output is a non-blocking descriptor handled by one
+asyncore (poll(2)) loop: there are no threads per client, no wakeups
+while idle and shutdown is immediate. Transcoder output comes from
+Transcoder.spawn() and is moved to the client with
+catota.stream.StreamPump.move(), or, when sessions are shared (the
+default), fanned out to every client asking for the same output by a
+Session.
+"""
+
+__author__ = "Gustavo Sverzut Barbieri"
+__author_email__ = "barbieri@gmail.com"
+__license__ = "GPL"
+__version__ = "0.2"
+
+import os
+import time
+import asyncore
+import cStringIO
+import errno
+import resource
+import socket
+import catota.server
+import catota.stream
+import logging as log
+
+__all__ = ("AsyncRequestHandler", "HTTPChannel", "StreamOutput",
+           "Session", "SessionReader", "StaticFile", "FileReader",
+           "AsyncServer", "serve_forever")
+
+
+class AsyncRequestHandler(catota.server.RequestHandler):
+    """RequestHandler working on a request already read by HTTPChannel.
+
+    Responses are written to a memory buffer, the channel sends it
+    later. Streams are started with HTTPChannel.start_stream().
+    """
+    def __init__(self, channel, data):
+        self.channel = channel
+        self.server = channel.server
+        self.client_address = channel.client_address
+        self.request = self.connection = channel.socket
+        self.rfile = cStringIO.StringIO(data)
+        self.wfile = cStringIO.StringIO()
+    # __init__()
+
+
+    def address_string(self):
+        # no reverse DNS lookups, they would block the loop
+        return self.client_address[0]
+    # address_string()
+
+
+    def serve_stream(self, body):
+        transcoder = self._get_transcoder()
+        try:
+            obj = transcoder(self.query)
+        except Exception, e:
+            self.send_error(500, str(e))
+            return
+
+        path = obj.get_file()
+        if path is not None:
+            try:
+                source = StaticFile(path)
+            except OSError, e:
+                self.send_error(404, str(e))
+                return
+            self.serve_source(body, obj, source)
+            return
+
+        pipe = None
+        session = None
+        entry = None
+        cache = self.server.cache
+        if body and cache is not None:
+            cache_key = cache.key(obj)
+            entry = cache.lookup(cache_key)
+            if entry is not None and entry.complete:
+                self.serve_source(body, obj, entry)
+                return
+
+        key = obj.get_session_key()
+        if body and entry is None and self.server.share_sessions:
+            session = self.server.find_session(key)
+            if session is not None:
+                obj = session.transcoder
+
+        if body and entry is None and session is None:
+            pipe = obj.spawn()
+            if pipe is None:
+                self.send_error(500, "Could not start transcoder")
+                return
+            new_entry = None
+            if cache is not None:
+                new_entry = cache.create(cache_key)
+            if self.server.share_sessions or new_entry is not None:
+                session = self.server.add_session(key, obj, pipe, new_entry)
+
+        self.send_response(200)
+        self.send_header("Content-Type", obj.get_mimetype())
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        if entry is not None:
+            self.channel.read_file(entry, obj)
+        elif session is not None:
+            self.channel.join_session(session)
+        elif body:
+            self.server.add_transcoders(self.channel, obj)
+            self.channel.start_stream(obj, pipe)
+    # serve_stream()
+
+
+    def serve_source(self, body, obj, source):
+        """Send a complete file (StaticFile or CacheEntry), with ranges."""
+        r = self.send_file_headers(obj.get_mimetype(), source.size)
+        if body and r is not None:
+            self.channel.read_file(source, obj, r[0], r[1])
+    # serve_source()
+# AsyncRequestHandler
+
+
+
+class StreamOutput(asyncore.file_dispatcher):
+    """Transcoder output pipe of a HTTPChannel."""
+    def __init__(self, channel, transcoder, pipe):
+        asyncore.file_dispatcher.__init__(self, pipe)
+        self.pipe = pipe
+        self.channel = channel
+        self.transcoder = transcoder
+        self.pump = catota.stream.StreamPump(self._fileno,
+                                             channel.socket.fileno())
+        transcoder.pump = self.pump
+    # __init__()
+
+
+    def readable(self):
+        return not self.channel.outbuf and self.pump.waiting == "in"
+    # readable()
+
+
+    def writable(self):
+        return False
+    # writable()
+
+
+    def handle_read(self):
+        self.channel.move_stream()
+    # handle_read()
+
+
+    def handle_close(self):
+        # writer is gone, but the pipe may still have data
+        self.channel.move_stream()
+    # handle_close()
+
+
+    def handle_expt(self):
+        self.channel.move_stream()
+    # handle_expt()
+
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        self.pipe.close()
+    # close()
+# StreamOutput
+
+
+
+class Session(asyncore.file_dispatcher):
+    """One transcoder output shared by every client asking for it.
+
+    Output is read into a RingBuffer of buffer_size bytes and each
+    client (SessionReader) sends it from its own position. Data is read
+    while there is room in the buffer or some client is waiting for
+    more, so the transcoder goes as fast as the fastest client.
+
+    Late clients start at the last sync marker of the transcoder or the
+    oldest buffered byte. Clients whose data was overwritten skip ahead
+    the same way (or to half a buffer before the newest byte) or are
+    dropped, see slow_readers.
+
+    With a cache_entry the output is also written to it, clients
+    reading the entry (FileReader) keep the session alive too. The
+    transcoder is stopped when the last client leaves.
+    """
+    log = log.getLogger("catota.session")
+    buffer_size = 4 * 1024 * 1024
+    chunk_size = 256 * 1024
+    slow_readers = "skip" # or "drop"
+
+    def __init__(self, server, key, transcoder, pipe, cache_entry=None):
+        asyncore.file_dispatcher.__init__(self, pipe)
+        self.pipe = pipe
+        self.server = server
+        self.key = key
+        self.transcoder = transcoder
+        self.cache_entry = cache_entry
+        if cache_entry is not None:
+            cache_entry.writer = self
+        self.sync_marker = transcoder.get_sync_marker()
+        self.ring = catota.stream.RingBuffer(self.buffer_size)
+        self.readers = []
+        self.eof = False
+        self.stopped = False
+        self.start_time = time.time()
+    # __init__()
+
+
+    def join(self, channel):
+        ring = self.ring
+        if ring.start == 0:
+            pos = 0 # nothing lost yet, from the beginning
+        else:
+            pos = self.sync_position()
+        reader = SessionReader(self, channel, pos)
+        self.readers.append(reader)
+        self.log.info("%s joined %s at %d, %d readers" %
+                      (channel.client_address, self.transcoder, pos,
+                       len(self.readers)))
+        return reader
+    # join()
+
+
+    def leave(self, reader):
+        try:
+            self.readers.remove(reader)
+        except ValueError, e:
+            return
+        self.check_idle()
+    # leave()
+
+
+    def check_idle(self):
+        """Stop once nobody reads the output or its cache entry."""
+        if self.readers:
+            return
+        entry = self.cache_entry
+        if entry is not None and entry.readers and not entry.done():
+            return
+        self.stop()
+    # check_idle()
+
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.server.del_session(self)
+        self.close()
+        self.transcoder.stop()
+        if self.cache_entry is not None and not self.cache_entry.done():
+            self.cache_entry.abort()
+        self.log.info("Session finished: %s, %d bytes" %
+                      (self.transcoder, self.ring.end))
+        for reader in self.readers[:]:
+            reader.stop()
+    # stop()
+
+
+    def sync_position(self, default=None):
+        """Last sync marker in the buffer, default or the oldest byte."""
+        pos = None
+        if self.sync_marker:
+            pos = self.ring.rfind(self.sync_marker)
+        if pos is None:
+            pos = default
+        if pos is None or pos < self.ring.start:
+            pos = self.ring.start
+        return pos
+    # sync_position()
+
+
+    def starving(self):
+        end = self.ring.end
+        for reader in self.readers:
+            if reader.pos >= end:
+                return True
+        return False
+    # starving()
+
+
+    def readable(self):
+        if self.eof or self.stopped:
+            return False
+        elif not self.readers:
+            return True # only the cache entry is read
+        return self.ring.free() > 0 or self.starving()
+    # readable()
+
+
+    def writable(self):
+        return False
+    # writable()
+
+
+    def handle_read(self):
+        if self.eof or self.stopped:
+            return
+        size = self.chunk_size
+        if not self.starving():
+            size = min(size, self.ring.free())
+        if size == 0:
+            # buffer full, wait for readers. Reading 0 bytes would
+            # look like the end of the output
+            return
+        try:
+            data = os.read(self._fileno, size)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            self.log.error("Problems reading %s: %s" % (self.transcoder, e))
+            data = ""
+
+        if not data:
+            self.finish()
+            return
+
+        if self.cache_entry is not None:
+            try:
+                self.cache_entry.write(data)
+            except OSError, e:
+                self.log.error("Problems writing cache: %s" % e)
+                self.cache_entry.abort()
+                self.cache_entry = None
+
+        ring = self.ring
+        ring.append(data)
+        for reader in self.readers[:]:
+            if reader.pos < ring.start:
+                self.lagging(reader)
+    # handle_read()
+
+
+    def handle_close(self):
+        # writer is gone, but the pipe may still have data: read it
+        # as usual, end of file is only a read of 1+ bytes returning ""
+        self.handle_read()
+    # handle_close()
+
+
+    def finish(self):
+        """Transcoder output ended, readers get what is left."""
+        self.eof = True
+        self.server.del_session(self)
+        if self.cache_entry is not None:
+            self.cache_entry.finish()
+        for reader in self.readers[:]:
+            if reader.finished():
+                reader.stop()
+        self.check_idle()
+    # finish()
+
+
+    def lagging(self, reader):
+        if self.slow_readers == "drop":
+            self.log.info("%s too slow, dropped" %
+                          (reader.channel.client_address,))
+            reader.stop()
+        else:
+            # without markers go half a buffer back from the newest
+            # byte, otherwise it would lag again on the next read
+            ring = self.ring
+            pos = self.sync_position(ring.end - ring.size / 2)
+            self.log.debug("%s too slow, skipped %d bytes" %
+                           (reader.channel.client_address, pos - reader.pos))
+            reader.skipped += pos - reader.pos
+            reader.pos = pos
+    # lagging()
+
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        self.pipe.close()
+    # close()
+
+
+    def get_n_readers(self):
+        return len(self.readers)
+    # get_n_readers()
+
+
+    def get_buffered(self):
+        return len(self.ring)
+    # get_buffered()
+
+
+    def get_rate(self):
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.ring.end / elapsed
+    # get_rate()
+
+
+    def __str__(self):
+        return "%s(%s, readers=%d)" % (self.__class__.__name__,
+                                       self.transcoder, len(self.readers))
+    # __str__()
+# Session
+
+
+
+class SessionReader(object):
+    """Client of a Session, listed as its transcoder by the server."""
+    def __init__(self, session, channel, pos):
+        self.session = session
+        self.channel = channel
+        self.pos = pos
+        self.bytes = 0
+        self.skipped = 0
+        self.start_time = time.time()
+    # __init__()
+
+
+    def pending(self):
+        return self.pos < self.session.ring.end
+    # pending()
+
+
+    def finished(self):
+        return self.session.eof and not self.pending()
+    # finished()
+
+
+    def send(self):
+        sent = self.channel.send(self.session.ring.get(self.pos))
+        self.pos += sent
+        self.bytes += sent
+    # send()
+
+
+    def leave(self):
+        self.session.leave(self)
+    # leave()
+
+
+    def stop(self):
+        self.channel.close()
+    # stop()
+
+
+    def get_rate(self):
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes / elapsed
+    # get_rate()
+
+
+    def __str__(self):
+        return "%s [shared by %d]" % (self.session.transcoder,
+                                      len(self.session.readers))
+    # __str__()
+# SessionReader
+
+
+
+class StaticFile(object):
+    """Complete file sent as is, readable like a CacheEntry."""
+    def __init__(self, path):
+        self.path = path
+        self.size = os.stat(path).st_size
+    # __init__()
+
+
+    def done(self):
+        return True
+    # done()
+
+
+    def open(self):
+        return os.open(self.path, os.O_RDONLY)
+    # open()
+
+
+    def leave(self, fd):
+        os.close(fd)
+    # leave()
+
+
+    def __str__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.path)
+    # __str__()
+# StaticFile
+
+
+
+class FileReader(object):
+    """Client sent from a file with sendfile(2).
+
+    The file is a StaticFile or a CacheEntry, complete or still being
+    written, from pos to end (exclusive, None for everything).
+    """
+    log = log.getLogger("catota.file")
+    chunk_size = 1024 * 1024
+
+    def __init__(self, entry, channel, transcoder, pos=0, end=None):
+        self.entry = entry
+        self.channel = channel
+        self.transcoder = transcoder
+        self.pos = pos
+        self.end = end
+        self.bytes = 0
+        self.fd = entry.open()
+        self.start_time = time.time()
+    # __init__()
+
+
+    def limit(self):
+        if self.end is None:
+            return self.entry.size
+        return min(self.end, self.entry.size)
+    # limit()
+
+
+    def pending(self):
+        return self.pos < self.limit()
+    # pending()
+
+
+    def finished(self):
+        if self.end is not None and self.pos >= self.end:
+            return True
+        return self.entry.done() and not self.pending()
+    # finished()
+
+
+    def send(self):
+        count = min(self.chunk_size, self.limit() - self.pos)
+        try:
+            sent = catota.stream.sendfile(self.channel.socket.fileno(),
+                                          self.fd, self.pos, count)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                self.log.error("%s: problems sending %s: %s" %
+                               (self.channel.client_address, self.entry, e))
+            self.channel.close()
+            return
+
+        if sent == 0:
+            # file is shorter than expected, it was truncated
+            self.channel.close()
+            return
+        self.pos += sent
+        self.bytes += sent
+    # send()
+
+
+    def leave(self):
+        self.entry.leave(self.fd)
+    # leave()
+
+
+    def stop(self):
+        self.channel.close()
+    # stop()
+
+
+    def get_rate(self):
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes / elapsed
+    # get_rate()
+
+
+    def __str__(self):
+        return "%s [%s]" % (self.transcoder, self.entry)
+    # __str__()
+# FileReader
+
+
+
+class HTTPChannel(asyncore.dispatcher):
+    log = log.getLogger("catota.channel")
+    handler = AsyncRequestHandler
+    max_request_size = 65536
+
+    def __init__(self, sock, addr, server):
+        asyncore.dispatcher.__init__(self, sock)
+        self.client_address = addr
+        self.server = server
+        self.inbuf = ""
+        self.outbuf = ""
+        self.stream = None
+        self.reader = None
+        self.request_done = False
+        self.closed = False
+    # __init__()
+
+
+    def readable(self):
+        return not self.request_done
+    # readable()
+
+
+    def writable(self):
+        if self.outbuf:
+            return True
+        elif self.reader is not None:
+            return self.reader.pending() or self.reader.finished()
+        return self.stream is not None and self.stream.pump.waiting == "out"
+    # writable()
+
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if not data:
+            return
+        self.inbuf += data
+
+        end = self.inbuf.find("\r\n\r\n")
+        if end < 0:
+            end = self.inbuf.find("\n\n")
+        if end >= 0:
+            self.request_done = True
+            self.handle_request(self.inbuf)
+            self.inbuf = ""
+        elif len(self.inbuf) > self.max_request_size:
+            self.log.error("%s: request too big" % (self.client_address,))
+            self.close()
+    # handle_read()
+
+
+    def handle_request(self, data):
+        handler = self.handler(self, data)
+        try:
+            handler.handle_one_request()
+        except Exception, e:
+            self.log.exception("%s: error handling request: %s" %
+                               (self.client_address, e))
+            self.close()
+            return
+        self.outbuf += handler.wfile.getvalue()
+        if not self.outbuf and self.stream is None and self.reader is None:
+            self.close()
+    # handle_request()
+
+
+    def handle_write(self):
+        if self.outbuf:
+            sent = self.send(self.outbuf)
+            self.outbuf = self.outbuf[sent:]
+            if self.outbuf or self.closed:
+                return
+
+        if self.reader is not None:
+            if self.reader.pending():
+                self.reader.send()
+            if self.reader.finished():
+                self.close()
+        elif self.stream is not None:
+            self.move_stream()
+        else:
+            self.close()
+    # handle_write()
+
+
+    def handle_close(self):
+        self.close()
+    # handle_close()
+
+
+    def start_stream(self, transcoder, pipe):
+        self.stream = StreamOutput(self, transcoder, pipe)
+    # start_stream()
+
+
+    def read_file(self, entry, transcoder, pos=0, end=None):
+        self.reader = FileReader(entry, self, transcoder, pos, end)
+        self.server.add_transcoders(self, self.reader)
+    # read_file()
+
+
+    def join_session(self, session):
+        self.reader = session.join(self)
+        self.server.add_transcoders(self, self.reader)
+    # join_session()
+
+
+    def move_stream(self):
+        if self.closed:
+            return
+        try:
+            more = self.stream.pump.move()
+        except (OSError, socket.error), e:
+            if e.args[0] not in (errno.EPIPE, errno.ECONNRESET):
+                self.log.error("%s: problems handling data: %s" %
+                               (self.client_address, e))
+            more = False
+
+        if not more:
+            self.close()
+    # move_stream()
+
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        stream = self.stream
+        if stream is not None:
+            stream.close()
+            self.log.info("%s: stream finished: %s" %
+                          (self.client_address, stream.pump))
+            self.server.del_transcoders(self, stream.transcoder)
+            stream.transcoder.stop()
+
+        reader = self.reader
+        if reader is not None:
+            self.server.del_transcoders(self, reader)
+            reader.leave()
+        asyncore.dispatcher.close(self)
+    # close()
+# HTTPChannel
+
+
+
+class AsyncServer(asyncore.dispatcher):
+    log = log.getLogger("catota.server")
+    channel = HTTPChannel
+    request_queue_size = 128
+    timeout = None # poll() timeout, seconds
+    share_sessions = True
+
+    def __init__(self, server_address, channel=None, cache=None):
+        asyncore.dispatcher.__init__(self)
+        if channel is not None:
+            self.channel = channel
+        self.cache = cache # catota.cache.TranscodeCache
+        self._transcoders = {}
+        self._sessions = {}
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(self.request_queue_size)
+    # __init__()
+
+
+    def raise_file_limit(self):
+        """Each stream takes 2 descriptors, use as many as allowed."""
+        try:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if hard == resource.RLIM_INFINITY or hard > soft:
+                if hard == resource.RLIM_INFINITY:
+                    hard = 65536
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+                self.log.debug("File descriptor limit: %d" % hard)
+        except (ValueError, resource.error), e:
+            pass
+    # raise_file_limit()
+
+
+    def serve_forever(self):
+        self.log.info("Catota serving HTTP on %s:%s" %
+                      self.socket.getsockname())
+        self.raise_file_limit()
+        try:
+            asyncore.loop(timeout=self.timeout, use_poll=True)
+        except KeyboardInterrupt, e:
+            pass
+
+        self.log.debug("Stopping all remaining transcoders...")
+        self.stop_transcoders()
+        asyncore.close_all()
+        self.log.debug("Transcoders stopped!")
+    # serve_forever()
+
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, addr = pair
+        self.channel(sock, addr, self)
+    # handle_accept()
+
+
+    def server_close(self):
+        """Stop accepting clients and end the streams.
+
+        The loop returns once pending responses are sent.
+        """
+        self.close()
+        for transcoder, channel in self.get_transcoders():
+            channel.close()
+    # server_close()
+
+
+    def stop_transcoders(self):
+        for transcoder, channel in self.get_transcoders():
+            self.log.info("Stop transcoder: %s, client=%s" %
+                          (transcoder, channel.client_address))
+            transcoder.stop()
+    # stop_transcoders()
+
+
+    def get_transcoders(self):
+        return self._transcoders.items()
+    # get_transcoders()
+
+
+    def add_transcoders(self, channel, transcoder):
+        self._transcoders[transcoder] = channel
+    # add_transcoders()
+
+
+    def del_transcoders(self, channel, transcoder):
+        self._transcoders.pop(transcoder, None)
+    # del_transcoders()
+
+
+    def get_sessions(self):
+        return self._sessions.values()
+    # get_sessions()
+
+
+    def find_session(self, key):
+        return self._sessions.get(key)
+    # find_session()
+
+
+    def add_session(self, key, transcoder, pipe, cache_entry=None):
+        session = Session(self, key, transcoder, pipe, cache_entry)
+        self._sessions[key] = session
+        return session
+    # add_session()
+
+
+    def del_session(self, session):
+        if self._sessions.get(session.key) is session:
+            del self._sessions[session.key]
+    # del_session()
+# AsyncServer
+
+
+
+def serve_forever(host="0.0.0.0", port=40000, cache=None):
+    addr = (host, port)
+
+    AsyncRequestHandler.protocol_version = "HTTP/1.0"
+    httpd = AsyncServer(addr, cache=cache)
+    httpd.serve_forever()
+# serve_forever()
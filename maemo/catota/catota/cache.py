@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+__author__ = "Gustavo Sverzut Barbieri"
+__author_email__ = "barbieri@gmail.com"
+__license__ = "GPL"
+__version__ = "0.2"
+
+import os
+import time
+import errno
+import logging as log
+
+try:
+    from hashlib import sha1
+except ImportError, e:
+    from sha import new as sha1
+
+__all__ = ("CacheEntry", "TranscodeCache")
+
+
+class CacheEntry(object):
+    """Transcoded output stored in one file of the cache.
+
+    Entries being written (complete is False) live in a ".part" file
+    and can be read while they grow, size tells how much is there.
+    """
+    def __init__(self, cache, name, size=0, complete=True):
+        self.cache = cache
+        self.name = name
+        self.path = os.path.join(cache.directory, name + ".data")
+        self.size = size
+        self.complete = complete
+        self.aborted = False
+        self.readers = 0
+        self.writer = None # Session writing it
+        self.last_used = time.time()
+        self.fd = None
+        if not complete:
+            self.fd = os.open(self.part_path(),
+                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    # __init__()
+
+
+    def part_path(self):
+        return self.path[:-len(".data")] + ".part"
+    # part_path()
+
+
+    def get_path(self):
+        if self.complete:
+            return self.path
+        return self.part_path()
+    # get_path()
+
+
+    def done(self):
+        return self.complete or self.aborted
+    # done()
+
+
+    def write(self, data):
+        offset = 0
+        while offset < len(data):
+            offset += os.write(self.fd, buffer(data, offset))
+        self.size += len(data)
+    # write()
+
+
+    def finish(self):
+        os.close(self.fd)
+        self.fd = None
+        os.rename(self.part_path(), self.path)
+        self.complete = True
+        self.writer = None
+        self.cache.completed(self)
+    # finish()
+
+
+    def abort(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        try:
+            os.unlink(self.part_path())
+        except OSError, e:
+            pass
+        self.aborted = True
+        self.writer = None
+        self.cache.discard(self)
+    # abort()
+
+
+    def open(self):
+        """Descriptor to read it, counted as a reader until leave()."""
+        fd = os.open(self.get_path(), os.O_RDONLY)
+        self.readers += 1
+        self.touch()
+        return fd
+    # open()
+
+
+    def leave(self, fd):
+        os.close(fd)
+        self.readers -= 1
+        if self.writer is not None:
+            self.writer.check_idle()
+    # leave()
+
+
+    def touch(self):
+        self.last_used = time.time()
+        if self.complete:
+            try:
+                os.utime(self.path, None)
+            except OSError, e:
+                pass
+    # touch()
+
+
+    def __str__(self):
+        return "%s(%s, %d bytes%s)" % \
+               (self.__class__.__name__, self.name, self.size,
+                (not self.complete and ", in progress") or "")
+    # __str__()
+# CacheEntry
+
+
+
+class TranscodeCache(object):
+    """Disk cache of transcoded files, least recently used are evicted.
+
+    Keys are (type, location, location mtime, transcoder name, params),
+    only "file" locations have a mtime so only they are cached. The
+    total size of complete entries is kept under max_bytes, the last
+    use of each entry is its file mtime so the order survives restarts.
+    """
+    log = log.getLogger("catota.cache")
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.total = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+    # __init__()
+
+
+    def _load(self):
+        for f in os.listdir(self.directory):
+            path = os.path.join(self.directory, f)
+            if f.endswith(".part"):
+                # from a previous run, never finished
+                os.unlink(path)
+            elif f.endswith(".data"):
+                st = os.stat(path)
+                entry = CacheEntry(self, f[:-len(".data")], st.st_size)
+                entry.last_used = st.st_mtime
+                self.entries[entry.name] = entry
+                self.total += entry.size
+        self.log.info("Cache %s: %d entries, %d bytes" %
+                      (self.directory, len(self.entries), self.total))
+        self.evict()
+    # _load()
+
+
+    def key(self, transcoder):
+        """Cache key of the transcoder output, None if not cacheable."""
+        type = transcoder.params_first("type", "")
+        location = transcoder.params_first("location", "")
+        if type != "file":
+            return None
+        try:
+            mtime = os.path.getmtime(location)
+        except OSError, e:
+            return None
+        return (type, location, mtime, transcoder.name,
+                transcoder.get_session_key())
+    # key()
+
+
+    def _name(self, key):
+        return sha1(repr(key)).hexdigest()
+    # _name()
+
+
+    def lookup(self, key):
+        """Complete or in progress entry for key, or None."""
+        if key is None:
+            return None
+        return self.entries.get(self._name(key))
+    # lookup()
+
+
+    def create(self, key):
+        """New entry to be written, None if key is not cacheable."""
+        if key is None:
+            return None
+        name = self._name(key)
+        try:
+            entry = CacheEntry(self, name, complete=False)
+        except OSError, e:
+            self.log.error("Could not create cache entry: %s" % e)
+            return None
+        self.entries[name] = entry
+        return entry
+    # create()
+
+
+    def completed(self, entry):
+        self.total += entry.size
+        self.log.info("Cached %s" % entry)
+        self.evict()
+    # completed()
+
+
+    def discard(self, entry):
+        if self.entries.get(entry.name) is entry:
+            del self.entries[entry.name]
+    # discard()
+
+
+    def evict(self):
+        if self.total <= self.max_bytes:
+            return
+        lst = [e for e in self.entries.itervalues() if e.complete]
+        lst.sort(lambda a, b: cmp(a.last_used, b.last_used))
+        for entry in lst:
+            if self.total <= self.max_bytes:
+                break
+            # readers keep their open descriptor
+            try:
+                os.unlink(entry.path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    self.log.error("Could not evict %s: %s" % (entry, e))
+                    continue
+            del self.entries[entry.name]
+            self.total -= entry.size
+            self.log.info("Evicted %s" % entry)
+    # evict()
+
+
+    def __str__(self):
+        return "%s(%s, %d entries, %d of %d bytes)" % \
+               (self.__class__.__name__, self.directory, len(self.entries),
+                self.total, self.max_bytes)
+    # __str__()
+# TranscodeCache
@@ -0,0 +1,66 @@
+import catota.server
+import catota.stream
+import os
+import mimetypes
+
+__all__ = ("TranscoderFile",)
+
+class TranscoderFile(catota.server.Transcoder):
+    """Sends a local file as is, for files the client can already play.
+
+    Being a complete file it is sent with Content-Length and honors
+    Range requests, so clients can seek. Only audio and video files are
+    sent, from inside media_root if it is set.
+    """
+    name = "file"
+    priority = 10
+
+    def __init__(self, params):
+        catota.server.Transcoder.__init__(self, params)
+
+        type = self.params_first("type")
+        location = self.params_first("location")
+        if type != "file":
+            raise ValueError("Transcoder file only handles type=file")
+        if not os.path.isfile(location) or not self.is_media_path(location):
+            raise ValueError("Not a media file: %s" % location)
+        self.path = location
+
+        mimetype = self.get_mimetype()
+        if not mimetype.startswith("video/") and \
+           not mimetype.startswith("audio/"):
+            raise ValueError("Not a media file: %s" % location)
+    # __init__()
+
+
+    def get_mimetype(self):
+        mimetype, encoding = mimetypes.guess_type(self.path)
+        return mimetype or "application/octet-stream"
+    # get_mimetype()
+
+
+    def get_file(self):
+        return self.path
+    # get_file()
+
+
+    def start(self, outfile):
+        outfile.flush()
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            pos = 0
+            try:
+                while True:
+                    n = catota.stream.sendfile(outfile.fileno(), fd, pos,
+                                               1024 * 1024)
+                    if n == 0:
+                        break
+                    pos += n
+            except OSError, e:
+                self.log.error("Problems sending %s: %s" % (self.path, e))
+                return False
+        finally:
+            os.close(fd)
+        return True
+    # start()
+# TranscoderFile
@@ -1,6 +1,8 @@
 import catota.utils
 import catota.server
+import catota.stream
 import os
+import re
 import signal
 import subprocess
 
@@ -8,29 +10,20 @@ __all__ = ("TranscoderMencoder",)
 
 class TranscoderMencoder(catota.server.Transcoder):
     mencoder_path = catota.utils.which("mencoder")
-    def_mencoder_outfile = os.path.join(os.path.sep, "tmp",
-                                        "mencoder-fifo-%(uid)s-%(pid)s")
+    pipe_size = 1024 * 1024
     name = "mencoder"
     priority = -1
+    # start=: seconds or [[hh:]mm:]ss, optionally with a fraction
+    start_re = re.compile(r"^(\d+:){0,2}\d+(\.\d+)?$")
 
     def __init__(self, params):
         catota.server.Transcoder.__init__(self, params)
         self.proc = None
         self.args = None
 
-        vars = {"uid": os.getuid(), "pid": os.getpid()}
-        mencoder_outfile_base = self.def_mencoder_outfile % vars
-        mencoder_outfile = mencoder_outfile_base
-        i = 0
-        while os.path.exists(mencoder_outfile):
-            i += 1
-            mencoder_outfile = mencoder_outfile_base + ".%s" % i
-
-        self.mencoder_outfile = mencoder_outfile
-        os.mkfifo(self.mencoder_outfile)
-
-        args = [self.mencoder_path, "-really-quiet",
-                "-o", self.mencoder_outfile]
+        # output goes to an anonymous pipe (stdout), -really-quiet keeps
+        # mencoder messages out of it
+        args = [self.mencoder_path, "-really-quiet", "-o", "/dev/stdout"]
 
         params_first = self.params_first
 
@@ -38,6 +31,14 @@ class TranscoderMencoder(catota.server.Transcoder):
         location = params_first("location")
         args.append("%s://%s" % (type, location))
 
+        # live output has no length, seeking is done by asking for a
+        # new stream starting at this position
+        start = params_first("start", "")
+        if start:
+            if not self.start_re.match(start):
+                raise ValueError("Invalid start: %r" % start)
+            args.extend(["-ss", start])
+
         mux = params_first("mux", "avi")
         args.extend(["-of", mux])
 
@@ -66,40 +67,54 @@ class TranscoderMencoder(catota.server.Transcoder):
     # __init__()
 
 
-    def _unlink_fifo(self):
-        try:
-            os.unlink(self.mencoder_outfile)
-        except Exception, e:
-            pass
-    # _unlink_fifo()
+    def get_session_key(self):
+        # same command line, same output
+        return (self.name, tuple(self.args))
+    # get_session_key()
 
 
-    def start(self, outfd):
+    def get_sync_marker(self):
+        if self.params_first("mux", "avi") == "mpeg":
+            return "\x00\x00\x01\xba" # MPEG-PS pack header
+        return None
+    # get_sync_marker()
+
+
+    def spawn(self):
         cmd = " ".join(self.args)
         self.log.info("Mencoder: %s" % cmd)
 
         try:
-            self.proc = subprocess.Popen(self.args, close_fds=True)
+            self.proc = subprocess.Popen(self.args, stdout=subprocess.PIPE,
+                                         close_fds=True)
         except Exception, e:
             self.log.error("Error executing mencoder: %s" % cmd)
-            return False
+            return None
 
-        try:
-            fifo_read = open(self.mencoder_outfile)
-        except Exception, e:
-            self.log.error("Error opening fifo: %s" % cmd)
-            return False
+        catota.stream.set_pipe_size(self.proc.stdout.fileno(), self.pipe_size)
+        return self.proc.stdout
+    # spawn()
 
-        try:
-            while self.proc and self.proc.poll() == None:
-                d = fifo_read.read(1024)
-                outfd.write(d)
-        except Exception, e:
-            self.log.error("Problems handling data: %s" % e)
-            self._unlink_fifo()
+
+    def start(self, outfd):
+        stdout = self.spawn()
+        if stdout is None:
             return False
 
-        self._unlink_fifo()
+        outfd.flush()
+        self.pump = catota.stream.StreamPump(stdout.fileno(), outfd.fileno())
+        try:
+            try:
+                self.pump.run()
+            except Exception, e:
+                self.log.error("Problems handling data: %s" % e)
+                self.stop()
+                return False
+        finally:
+            stdout.close()
+            self.log.info("Mencoder finished: %s" % self.pump)
+
+        self.stop()
         return True
     # start()
 
@@ -117,7 +132,5 @@ class TranscoderMencoder(catota.server.Transcoder):
                 pass
 
             self.proc = None
-
-        self._unlink_fifo()
     # stop()
 # TranscoderMencoder
@@ -13,6 +13,7 @@ import socket
 import urlparse
 import cgi
 import catota.utils
+import catota.stream
 import logging as log
 
 __all__ = ("Transcoder", "RequestHandler", "Server", "serve_forever",
@@ -22,6 +23,8 @@ class Transcoder(object):
     log = log.getLogger("catota.transcoder")
     priority = 0   # negative values have higher priorities
     name = None # to be used in requests
+    pump = None # catota.stream.StreamPump moving the output, if any
+    media_root = None # if set, local files must be inside it
 
     def __init__(self, params):
         self.params = params
@@ -56,11 +59,85 @@ class Transcoder(object):
     # start()
 
 
+    def spawn(self):
+        """Start transcoding to a pipe, returns the file to read it from.
+
+        Used by the event loop server (catota.asyncserver). This default
+        runs start() in a thread writing to the pipe, transcoders that
+        can hand out a pipe themselves (ie: process stdout) override it.
+        Returns None on errors.
+        """
+        r, w = os.pipe()
+        outfile = os.fdopen(w, "wb", 0)
+
+        def run():
+            try:
+                self.start(outfile)
+            finally:
+                outfile.close()
+
+        t = threading.Thread(target=run, name=str(self))
+        t.setDaemon(True)
+        t.start()
+        return os.fdopen(r, "rb", 0)
+    # spawn()
+
+
     def stop(self):
         return True
     # stop()
 
 
+    def get_session_key(self):
+        """Transcoders with equal keys produce the same output.
+
+        Clients asking for equal keys share one transcoder (see
+        catota.asyncserver.Session). Override to normalize parameters.
+        """
+        params = [(k, tuple(v)) for k, v in self.params.iteritems()
+                  if k != "transcoder"]
+        params.sort()
+        return (self.__class__.__name__, tuple(params))
+    # get_session_key()
+
+
+    def is_media_path(self, path):
+        """Whether path may be read on behalf of clients."""
+        if self.media_root is None:
+            return True
+        root = os.path.join(os.path.realpath(self.media_root), "")
+        return os.path.realpath(path).startswith(root)
+    # is_media_path()
+
+
+    def get_file(self):
+        """Path of a complete file with the output, or None.
+
+        Such output is sent as is, with Content-Length and byte ranges,
+        without calling start() or spawn().
+        """
+        return None
+    # get_file()
+
+
+    def get_sync_marker(self):
+        """Bytes starting a point where decoding can start, or None.
+
+        Clients joining a shared session late start at the last marker
+        in the buffer instead of its oldest byte.
+        """
+        return None
+    # get_sync_marker()
+
+
+    def get_rate(self):
+        """Output bytes per second sent to the client."""
+        if self.pump is None:
+            return 0.0
+        return self.pump.rate()
+    # get_rate()
+
+
     def __str__(self):
         return '%s("%s://%s", mux="%s", params=%s)' % \
                (self.__class__.__name__,
@@ -298,12 +375,26 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 """)
                 for transcoder, request in tl:
                     self.wfile.write("""\
-      <li>%s: %s:%s <a href="/stop-transcoder.do?request=%s:%s">[STOP]</a></li>
+      <li>%s: %s:%s %.1f KiB/s <a href="/stop-transcoder.do?request=%s:%s">[STOP]</a></li>
 """ % (transcoder, request.client_address[0], request.client_address[1],
+       transcoder.get_rate() / 1024,
        request.client_address[0], request.client_address[1]))
 
                 self.wfile.write("""\
       </ul>
+""")
+
+            sl = self.server.get_sessions()
+            if sl:
+                self.wfile.write("<p>Shared sessions:</p>\n      <ul>\n")
+                for session in sl:
+                    self.wfile.write("""\
+      <li>%s: %d readers, %.1f KiB/s, %d KiB buffered</li>
+""" % (session.transcoder, session.get_n_readers(),
+       session.get_rate() / 1024, session.get_buffered() / 1024))
+                self.wfile.write("      </ul>\n")
+
+            self.wfile.write("""\
       <ul>
 """)
             self._nav_items()
@@ -328,6 +419,107 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     # _get_transcoder()
 
 
+    def get_range(self, size):
+        """First and last byte asked by the Range header.
+
+        Returns None if the whole file must be sent (no Range, multiple
+        or malformed ranges) and False if it can't be satisfied.
+        """
+        value = self.headers.getheader("Range")
+        if not value or not value.startswith("bytes="):
+            return None
+        spec = value[len("bytes="):].strip()
+        if "," in spec or "-" not in spec:
+            return None
+
+        first, last = [x.strip() for x in spec.split("-", 1)]
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            if not last:
+                return None
+            n = int(last) # suffix: last n bytes
+            if n == 0 or size == 0:
+                return False
+            return (max(size - n, 0), size - 1)
+
+        first = int(first)
+        if last:
+            last = int(last)
+            if last < first:
+                return None # invalid, ignored
+        else:
+            last = size - 1
+        if first >= size:
+            return False
+        return (first, min(last, size - 1))
+    # get_range()
+
+
+    def send_file_headers(self, mimetype, size):
+        """Send status and headers of a complete file, honoring Range.
+
+        Returns the first and end (exclusive) byte to send, or None if
+        the range is not satisfiable and 416 was sent.
+        """
+        r = self.get_range(size)
+        if r is False:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            return None
+
+        if r is None:
+            first, last = 0, size - 1
+            self.send_response(200)
+        else:
+            first, last = r
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (first, last, size))
+        self.send_header("Content-Type", mimetype)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        return (first, last + 1)
+    # send_file_headers()
+
+
+    def serve_file(self, body, obj, path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError, e:
+            self.send_error(404, str(e))
+            return
+
+        try:
+            size = os.fstat(fd).st_size
+            r = self.send_file_headers(obj.get_mimetype(), size)
+            if not body or r is None:
+                return
+
+            pos, end = r
+            outfd = self.connection.fileno()
+            self.server.add_transcoders(self, obj)
+            try:
+                while pos < end:
+                    n = catota.stream.sendfile(outfd, fd, pos,
+                                               min(end - pos, 1 << 20))
+                    if n == 0:
+                        break
+                    pos += n
+            except OSError, e:
+                self.log.info("%s: problems sending %s: %s" %
+                              (self.address_string(), path, e))
+            self.server.del_transcoders(self, obj)
+        finally:
+            os.close(fd)
+    # serve_file()
+
+
     def serve_stream(self, body):
         transcoder = self._get_transcoder()
         try:
@@ -336,6 +528,11 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.send_error(500, str(e))
             return
 
+        path = obj.get_file()
+        if path is not None:
+            self.serve_file(body, obj, path)
+            return
+
         self.send_response(200)
         self.send_header("Content-Type", obj.get_mimetype())
         self.send_header('Connection', 'close')
@@ -428,6 +625,12 @@ class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     # get_transcoders()
 
 
+    def get_sessions(self):
+        # every client has its own transcoder, see catota.asyncserver
+        return []
+    # get_sessions()
+
+
     def add_transcoders(self, request, transcoder):
         self._lock.acquire()
         try:
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+__author__ = "Gustavo Sverzut Barbieri"
+__author_email__ = "barbieri@gmail.com"
+__license__ = "GPL"
+__version__ = "0.2"
+
+import os
+import time
+import errno
+import fcntl
+import struct
+import termios
+import logging
+
+__all__ = ("StreamPump", "RingBuffer", "splice", "have_splice", "sendfile",
+           "set_pipe_size", "set_nonblocking", "pipe_pending")
+
+log = logging.getLogger("catota.stream")
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE = 4
+F_SETPIPE_SZ = 1031
+
+try:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                        use_errno=True)
+    _splice = _libc.splice
+    _splice.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+    _splice.restype = ctypes.c_ssize_t
+    have_splice = True
+except Exception, e:
+    _splice = None
+    have_splice = False
+
+try:
+    _sendfile = _libc.sendfile64
+    _sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                          ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    _sendfile.restype = ctypes.c_ssize_t
+except Exception, e:
+    _sendfile = None
+
+
+def splice(fd_in, fd_out, length, flags=SPLICE_F_MOVE | SPLICE_F_MORE):
+    """splice(2) without offsets, one of the descriptors must be a pipe.
+
+    Returns the number of bytes moved, 0 on end of file. Errors are
+    raised as OSError, like os.read() and os.write() do.
+    """
+    while True:
+        n = _splice(fd_in, None, fd_out, None, length, flags)
+        if n >= 0:
+            return n
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+# splice()
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """Send count bytes of file in_fd from offset to out_fd.
+
+    Uses sendfile(2) if available, read and write otherwise. Returns the
+    number of bytes sent, errors are raised as OSError.
+    """
+    if _sendfile is None:
+        os.lseek(in_fd, offset, 0)
+        data = os.read(in_fd, count)
+        if not data:
+            return 0
+        return os.write(out_fd, data)
+
+    off = ctypes.c_int64(offset)
+    while True:
+        n = _sendfile(out_fd, in_fd, ctypes.byref(off), count)
+        if n >= 0:
+            return n
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+# sendfile()
+
+
+def set_pipe_size(fd, size):
+    """Grow the kernel buffer of pipe fd, fewer wakeups per megabyte."""
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+        return True
+    except Exception, e:
+        return False
+# set_pipe_size()
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+# set_nonblocking()
+
+
+def pipe_pending(fd):
+    """Number of bytes waiting to be read from pipe fd."""
+    try:
+        r = fcntl.ioctl(fd, termios.FIONREAD, struct.pack("i", 0))
+        return struct.unpack("i", r)[0]
+    except IOError, e:
+        return 0
+# pipe_pending()
+
+
+class StreamPump(object):
+    """Copies everything from infd to outfd until infd reaches end of file.
+
+    When infd is a pipe and splice(2) is available the data is moved
+    in the kernel, never reaching Python. Otherwise it is read into one
+    reused buffer of chunk_size bytes, big reads keep the number of
+    system calls and Python iterations down.
+
+    run() blocks until the end, event loops use move() instead, with
+    both descriptors in non-blocking mode.
+
+    Statistics (bytes, start_time, end_time and rate()) are kept so
+    transcoders can report the bytes/s of each stream.
+    """
+    chunk_size = 256 * 1024
+    moves_per_call = 16 # move() returns after this, others have a turn
+
+    def __init__(self, infd, outfd, use_splice=None):
+        if use_splice is None:
+            use_splice = have_splice
+        self.infd = infd
+        self.outfd = outfd
+        self.use_splice = use_splice and have_splice
+        self.bytes = 0
+        self.start_time = None
+        self.end_time = None
+        self.waiting = "in"
+        self._pending = None # move(): data read but not written yet
+        self._written = 0
+    # __init__()
+
+
+    def run(self):
+        self.start_time = time.time()
+        try:
+            if self.use_splice:
+                try:
+                    self._run_splice()
+                except OSError, e:
+                    # EINVAL: outfd can't be spliced to (ie: TLS, file
+                    # opened with O_APPEND), copy the rest in userspace
+                    if e.errno != errno.EINVAL:
+                        raise
+                    log.debug("splice() not supported, fallback to read")
+                    self.use_splice = False
+                    self._run_read()
+            else:
+                self._run_read()
+        finally:
+            self.end_time = time.time()
+    # run()
+
+
+    def _run_splice(self):
+        infd = self.infd
+        outfd = self.outfd
+        size = self.chunk_size
+        while True:
+            n = splice(infd, outfd, size)
+            if n == 0:
+                return
+            self.bytes += n
+    # _run_splice()
+
+
+    def _run_read(self):
+        infd = self.infd
+        outfd = self.outfd
+        try:
+            buf = bytearray(self.chunk_size)
+            reader = os.fdopen(os.dup(infd), "rb", 0)
+        except NameError, e:
+            # python < 2.6, no bytearray
+            reader = None
+
+        try:
+            while True:
+                if reader is not None:
+                    n = reader.readinto(buf)
+                    data = buffer(buf, 0, n)
+                else:
+                    data = os.read(infd, self.chunk_size)
+                    n = len(data)
+                if n == 0:
+                    return
+
+                offset = 0
+                while offset < n:
+                    offset += os.write(outfd, buffer(data, offset))
+                self.bytes += n
+        finally:
+            if reader is not None:
+                reader.close()
+    # _run_read()
+
+
+    def move(self):
+        """Move what can be moved now without blocking.
+
+        Returns False once infd reached end of file and everything was
+        written, True otherwise. Then self.waiting tells which
+        descriptor, "in" or "out", must be ready before calling it again.
+        """
+        if self.start_time is None:
+            self.start_time = time.time()
+
+        for i in xrange(self.moves_per_call):
+            try:
+                if self.use_splice:
+                    n = self._move_splice()
+                else:
+                    n = self._move_read()
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return True
+                elif e.errno == errno.EINVAL and self.use_splice:
+                    log.debug("splice() not supported, fallback to read")
+                    self.use_splice = False
+                    continue
+                raise
+
+            if n == 0:
+                self.end_time = time.time()
+                return False
+
+        self.waiting = "out"
+        return True
+    # move()
+
+
+    def _move_splice(self):
+        flags = SPLICE_F_MOVE | SPLICE_F_MORE | SPLICE_F_NONBLOCK
+        try:
+            n = splice(self.infd, self.outfd, self.chunk_size, flags)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                # either the pipe is empty or the socket is full
+                if pipe_pending(self.infd) > 0:
+                    self.waiting = "out"
+                else:
+                    self.waiting = "in"
+            raise
+        self.bytes += n
+        return n
+    # _move_splice()
+
+
+    def _move_read(self):
+        if self._pending is None:
+            self.waiting = "in"
+            data = os.read(self.infd, self.chunk_size)
+            if not data:
+                return 0
+            self._pending = data
+            self._written = 0
+
+        self.waiting = "out"
+        w = os.write(self.outfd, buffer(self._pending, self._written))
+        self._written += w
+        self.bytes += w
+        if self._written == len(self._pending):
+            self._pending = None
+        return w or 1
+    # _move_read()
+
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        end = self.end_time or time.time()
+        return end - self.start_time
+    # elapsed()
+
+
+    def rate(self):
+        """Bytes per second since run() started."""
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes / elapsed
+    # rate()
+
+
+    def __str__(self):
+        return "%s(bytes=%d, %.1f KiB/s, %s)" % \
+               (self.__class__.__name__, self.bytes, self.rate() / 1024,
+                self.use_splice and "splice" or "read")
+    # __str__()
+# StreamPump
+
+
+
+class RingBuffer(object):
+    """Last size bytes of a stream, shared by many readers.
+
+    Positions are absolute stream offsets: data from start to end is
+    available, older data was overwritten. Readers keep their own
+    position and get contiguous pieces with get().
+    """
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray(size)
+        self.start = 0
+        self.end = 0
+    # __init__()
+
+
+    def __len__(self):
+        return self.end - self.start
+    # __len__()
+
+
+    def free(self):
+        return self.size - (self.end - self.start)
+    # free()
+
+
+    def append(self, data):
+        n = len(data)
+        if n > self.size:
+            self.end += n - self.size
+            data = data[-self.size:]
+            n = self.size
+
+        off = self.end % self.size
+        first = min(n, self.size - off)
+        self.data[off:off + first] = data[:first]
+        if first < n:
+            self.data[0:n - first] = data[first:]
+
+        self.end += n
+        if self.end - self.start > self.size:
+            self.start = self.end - self.size
+    # append()
+
+
+    def get(self, pos):
+        """Contiguous available data from position pos, may be partial."""
+        off = pos % self.size
+        length = min(self.end - pos, self.size - off)
+        return buffer(self.data, off, length)
+    # get()
+
+
+    def rfind(self, marker):
+        """Position of the last marker in the buffer, or None."""
+        off = self.start % self.size
+        if off + len(self) <= self.size:
+            data = str(self.data[off:off + len(self)])
+        else:
+            data = str(self.data[off:]) + str(self.data[:self.end % self.size])
+        i = data.rfind(marker)
+        if i < 0:
+            return None
+        return self.start + i
+    # rfind()
+# RingBuffer